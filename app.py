@@ -1,34 +1,172 @@
-from flask import Flask, g
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate, MigrateCommand
-from flask_script import Manager
+import os
+import weakref
+from time import time
+
+from flask import Flask, g, request, current_app
 from flask_argon2 import Argon2
 from flask_mail import Mail
 from flask_login import LoginManager, current_user
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from settings import Configuration, REQUIRED_SETTINGS
+from hashing import PasswordHashService
+from cache import Cache
+from database import RoutingSQLAlchemy
+from querystats import QueryStats
+from metrics import Metrics, GAUGE, HISTOGRAM
+from ratelimit import RateLimiter
+from assets import Assets
+from pagecache import PageCache
+from templating import make_bytecode_cache, warm_templates
 
-from settings import Configuration
+# extensions are bound to app in create_app()
+db = RoutingSQLAlchemy()
+argon2 = Argon2()
+hasher = PasswordHashService()
+mail = Mail()
+login_manager = LoginManager()
+login_manager.login_view = 'base.login'
+user_cache = Cache(config_prefix='USER_CACHE')
+limiter = RateLimiter()
+query_stats = QueryStats()
+assets = Assets()
+page_cache = PageCache()
+metrics = Metrics()
+metrics.define('argon2_hash_seconds', HISTOGRAM, "Password hash & verify time, including queue wait",
+    ('operation',), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+hasher.observer = metrics.observer('argon2_hash_seconds')
+metrics.define('first_request_seconds', HISTOGRAM, "Latency of first request of every process (cold worker)",
+    ('endpoint',))
+# pool stats of this process, see PoolMetrics.snapshot()
+POOL_METRICS = {
+    'connects': "Connections opened by pool",
+    'checkouts': "Connections checked out from pool",
+    'checkins': "Connections returned to pool",
+    'checked_out': "Connections currently checked out",
+    'invalidations': "Connections invalidated",
+    'waits': "Checkouts which waited for pool",
+    'wait_time': "Total seconds spent waiting for pool",
+    'wait_max': "Longest wait for pool in seconds",
+    'pool_size': "Pool size",
+    'overflow': "Connections over pool size",
+}
+for _name, _documentation in POOL_METRICS.items():
+    metrics.define('db_pool_{}'.format(_name), GAUGE, _documentation, ('bind',))
 
-app = Flask(__name__)
-app.config.from_object(Configuration)
+def create_app(config=None):
+    """Create flask app. Database engine is created on first query, and engines which created \
+before fork are disposed in child process, so connections are never shared between workers
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+    Keyword Arguments:
+        config {Object|Dict} -- Config which override `settings.Configuration` (default: {None})
 
-manager = Manager(app)
-manager.add_command('db', MigrateCommand)
+    Returns:
+        Flask -- Flask app
+    """
+    started = time()
+    app = Flask(__name__)
+    app.config.from_object(Configuration)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
 
-argon2 = Argon2(app)
-mail = Mail(app)
+    for name in REQUIRED_SETTINGS:
+        if not app.config.get(name):
+            app.logger.warning("Setting %s not provided, add it to local_settings.py", name)
 
-login_manager = LoginManager(app)
-login_manager.login_view = 'base.login'
+    # must be set before jinja environment is created by extensions
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        bytecode_cache = make_bytecode_cache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+        if bytecode_cache is None:
+            app.logger.warning("Can't create %s, templates are compiled without bytecode cache",
+                app.config['JINJA_BYTECODE_CACHE_DIR'])
+        else:
+            app.jinja_options = dict(app.jinja_options, bytecode_cache=bytecode_cache)
 
-@app.before_request
-def _before_request():
-    """Auto call before page requested
+    db.init_app(app)
+    # Argon2(app) doesn't read ARGON2_* config, so init_app() must be called explicitly
+    argon2.init_app(app)
+    hasher.init_app(app, argon2)
+    mail.init_app(app)
+    login_manager.init_app(app)
+    user_cache.init_app(app)
+    limiter.init_app(app)
+    query_stats.init_app(app)
+    metrics.init_app(app)
+    assets.init_app(app)
+    page_cache.init_app(app)
+
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+    app.first_request_seconds = None
+    app.before_request(_before_request)
+    app.after_request(_after_first_request)
+
+    from modules.base.blueprint import base_app
+    app.register_blueprint(base_app, url_prefix='')
+
+    if app.config['TEMPLATE_WARMUP_ON_START']:
+        names, elapsed = warm_templates(app)
+        app.logger.info("%d templates compiled in %.1fms", len(names), elapsed * 1000)
+
+    _apps.add(app)
+
+    app.startup_time = time() - started
+    if app.startup_time > app.config['STARTUP_TIME_BUDGET']:
+        app.logger.warning("App startup took %.3fs, over budget %.3fs", app.startup_time,
+            app.config['STARTUP_TIME_BUDGET'])
+    return app
 
-    Decorators:
-        app.before_request
+def _dispose_engines():
+    """Drop pooled connections inherited from parent process, child opens its own connections
+    """
+    for app in list(_apps):
+        state = app.extensions.get('sqlalchemy')
+        if state is not None:
+            for connector in list(state.connectors.values()):
+                connector.get_engine().dispose()
+
+# apps made by create_app(), fork hook is registered once for all of them
+_apps = weakref.WeakSet()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_engines)
+
+def _collect_pool_metrics():
+    """Pool stats of every bind used by this process, collected when metrics are scraped
+
+    Returns:
+        List -- (name, labels, value) of every stat
+    """
+    return [('db_pool_{}'.format(name), (bind,), value)
+        for bind, snapshot in db.get_pool_metrics().items()
+        for name, value in snapshot.items() if name in POOL_METRICS]
+
+metrics.register_collector(_collect_pool_metrics)
+
+def _before_request():
+    """Auto call before page requested. `g.user` is `UserPrincipal` when user logged in, \
+use `g.user.user` to get full user record
     """
 
     g.user = current_user
+    g.request_started = time()
+
+def _after_first_request(response):
+    """Record latency of first request handled by this process, which pays for loading templates
+
+    Arguments:
+        response {Response} -- Response of the request
+
+    Returns:
+        Response -- Same response
+    """
+    app = current_app._get_current_object()
+    started = g.get('request_started')
+    if app.first_request_seconds is None and started is not None:
+        app.first_request_seconds = time() - started
+        app.logger.info("First request of process %d (%s) took %.1fms", os.getpid(), request.endpoint,
+            app.first_request_seconds * 1000)
+        metrics.observe('first_request_seconds', app.first_request_seconds, (request.endpoint or 'unknown',))
+    return response
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""Static assets pipeline. `build_assets()` copies static files with content hash in filename, \
+plus gzip (and brotli, when `brotli` package installed) variants, and writes manifest. `Assets` \
+extension serves built files with far-future immutable cache headers
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+from flask import request, url_for, send_file, abort, current_app
+
+from helpers import get_extension_state
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+# already compressed formats are not worth compressing again
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.map', '.svg', '.eot', '.ttf', '.json', '.txt', '.html')
+# files referenced by other files are built first, so reference can be rewritten
+BUILD_ORDER = ('.map', '.css', '.js')
+CSS_URL_PATTERN = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+SOURCE_MAP_PATTERN = re.compile(r'(sourceMappingURL=)(\S+?)(\s*(?:\*/)?\s*)$', re.MULTILINE)
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def fingerprint(path, content):
+	"""Add content hash to filename, e.g. css/app.css -> css/app.1a2b3c4d5e6f.css
+
+	Arguments:
+		path {String} -- Relative path
+		content {Bytes} -- File content
+
+	Returns:
+		String -- Fingerprinted path
+	"""
+	root, ext = posixpath.splitext(path)
+	return '{}.{}{}'.format(root, hashlib.sha256(content).hexdigest()[:12], ext)
+
+def _rewrite_references(path, content, manifest):
+	"""Point url() of CSS & sourceMappingURL to fingerprinted files, relative references are kept \
+relative, so built files work from any url prefix
+
+	Arguments:
+		path {String} -- Relative path of file being built
+		content {Bytes} -- File content
+		manifest {Dict} -- Files already built, original path -> fingerprinted path
+
+	Returns:
+		Bytes -- Rewritten content
+	"""
+	directory = posixpath.dirname(path)
+
+	def resolve(reference):
+		target, suffix = re.match(r'([^?#]*)(.*)', reference).groups()
+		if not target or '://' in target or target.startswith(('/', 'data:')):
+			return reference
+		built = manifest.get(posixpath.normpath(posixpath.join(directory, target)))
+		if built is None:
+			return reference
+		return posixpath.relpath(built, directory or '.') + suffix
+
+	text = content.decode('utf-8')
+	if path.endswith('.css'):
+		text = CSS_URL_PATTERN.sub(lambda match: 'url({0}{1}{0})'.format(match.group(1),
+			resolve(match.group(2))), text)
+	text = SOURCE_MAP_PATTERN.sub(lambda match: match.group(1) + resolve(match.group(2)) + match.group(3), text)
+	return text.encode('utf-8')
+
+def _write(path, content):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'wb') as output_file:
+		output_file.write(content)
+
+def _compress(path, content):
+	"""Write gzip & brotli variants next to file, only when smaller than original
+
+	Arguments:
+		path {String} -- Built file path
+		content {Bytes} -- File content
+
+	Returns:
+		List -- Written encodings
+	"""
+	encodings = []
+	gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+	if len(gzipped) < len(content):
+		_write(path + '.gz', gzipped)
+		encodings.append('gzip')
+	if brotli is not None:
+		compressed = brotli.compress(content)
+		if len(compressed) < len(content):
+			_write(path + '.br', compressed)
+			encodings.append('br')
+	return encodings
+
+def build_assets(static_dir, output_dir):
+	"""Build fingerprinted & precompressed copy of every static file
+
+	Arguments:
+		static_dir {String} -- Source static directory
+		output_dir {String} -- Output directory, skipped when it's inside `static_dir`
+
+	Returns:
+		Dict -- Manifest, original path -> fingerprinted path
+	"""
+	output_dir = os.path.abspath(output_dir)
+	paths = []
+	for root, dirnames, filenames in os.walk(static_dir):
+		dirnames[:] = [name for name in dirnames if os.path.abspath(os.path.join(root, name)) != output_dir]
+		for filename in filenames:
+			paths.append(os.path.relpath(os.path.join(root, filename), static_dir).replace(os.sep, '/'))
+
+	def build_rank(path):
+		ext = posixpath.splitext(path)[1]
+		return (BUILD_ORDER.index(ext) + 1 if ext in BUILD_ORDER else 0, path)
+
+	manifest = {}
+	for path in sorted(paths, key=build_rank):
+		with open(os.path.join(static_dir, path), 'rb') as static_file:
+			content = static_file.read()
+		if path.endswith(('.css', '.js')):
+			content = _rewrite_references(path, content, manifest)
+
+		built = fingerprint(path, content)
+		built_path = os.path.join(output_dir, built)
+		_write(built_path, content)
+		if path.endswith(COMPRESSIBLE_EXTENSIONS):
+			_compress(built_path, content)
+		manifest[path] = built
+
+	_write(os.path.join(output_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+	return manifest
+
+class _Manifest(object):
+	"""Built assets of one app
+	"""
+
+	def __init__(self, directory):
+		"""Load manifest of built assets, nothing loaded when assets are not built
+
+		Arguments:
+			directory {String} -- Directory of built assets
+		"""
+		self.directory = directory
+		try:
+			with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+				self.files = json.load(manifest_file)
+		except (IOError, ValueError):
+			self.files = {}
+		self.built = frozenset(self.files.values())
+
+class Assets(object):
+	"""Serve built assets. Template helper `asset_url()` returns fingerprinted url, or normal \
+static url when assets are not built (development). Manifest is kept per app in `app.extensions`
+	"""
+
+	def __init__(self, app=None):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+		"""
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		"""Load manifest, register assets route & `asset_url` template global
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		app.config.setdefault('ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+		app.config.setdefault('ASSETS_URL_PATH', '/assets')
+		self.load(app.config['ASSETS_DIR'], app)
+		app.add_url_rule('{}/<path:filename>'.format(app.config['ASSETS_URL_PATH']), 'assets',
+			self.send_asset)
+		app.add_template_global(self.asset_url, 'asset_url')
+
+	def load(self, directory, app=None):
+		"""Load manifest of built assets, nothing loaded when assets are not built
+
+		Arguments:
+			directory {String} -- Directory of built assets
+
+		Keyword Arguments:
+			app {Flask} -- Flask app, default to current app (default: {None})
+		"""
+		if app is None:
+			app = current_app._get_current_object()
+		app.extensions['assets'] = _Manifest(directory)
+
+	@property
+	def manifest(self):
+		"""Manifest of current app
+
+		Returns:
+			Dict -- Original path -> fingerprinted path
+		"""
+		return get_extension_state('assets').files
+
+	def asset_url(self, path):
+		"""Url of static file
+
+		Arguments:
+			path {String} -- Path relative to static directory, e.g. 'css/bootstrap.min.css'
+
+		Returns:
+			String -- Fingerprinted url, or static url when file not built
+		"""
+		built = self.manifest.get(path)
+		if built is None:
+			return url_for('static', filename=path)
+		return url_for('assets', filename=built)
+
+	def send_asset(self, filename):
+		"""Serve built file, precompressed variant is chosen from `Accept-Encoding`. File is sent \
+by `send_file()`, which uses `wsgi.file_wrapper` (sendfile) when server provides it
+
+		Arguments:
+			filename {String} -- Fingerprinted path
+
+		Returns:
+			Response -- File response with immutable cache headers
+		"""
+		manifest = get_extension_state('assets')
+		if filename not in manifest.built:
+			abort(404)
+
+		path = os.path.join(manifest.directory, *filename.split('/'))
+		mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+		encoding = None
+		for name, ext in (('br', '.br'), ('gzip', '.gz')):
+			if request.accept_encodings[name] and os.path.exists(path + ext):
+				encoding, path = name, path + ext
+				break
+
+		response = send_file(path, mimetype=mimetype, conditional=True)
+		if encoding is not None:
+			response.headers['Content-Encoding'] = encoding
+		response.headers['Vary'] = 'Accept-Encoding'
+		response.headers['Cache-Control'] = CACHE_CONTROL
+		return response
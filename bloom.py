@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""Process local Bloom filter of column values. Used to skip database lookup when value \
+definitely doesn't exist (e.g. unique email check)
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from flask import current_app
+from sqlalchemy import event, func
+
+class BloomFilter(object):
+	"""Bloom filter, `value in bloom_filter` is False only when value was never added
+	"""
+
+	def __init__(self, capacity, error_rate=0.01):
+		"""Instantiate class object
+
+		Arguments:
+			capacity {Int} -- Expected number of values
+
+		Keyword Arguments:
+			error_rate {Float} -- False positive rate when filter has `capacity` values (default: {0.01})
+		"""
+		self.capacity = max(1, capacity)
+		self.size = int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)) + 1
+		self.hash_count = max(1, int(round(self.size / float(self.capacity) * math.log(2))))
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+		self._lock = threading.Lock()
+
+	def _get_positions(self, value):
+		digest = blake2b(str(value).encode('utf-8'), digest_size=16).digest()
+		first = int.from_bytes(digest[:8], 'little')
+		second = int.from_bytes(digest[8:], 'little') | 1
+		return [(first + idx * second) % self.size for idx in range(self.hash_count)]
+
+	def add(self, value):
+		"""Add value to filter
+
+		Arguments:
+			value {Object} -- Value to be added
+		"""
+		positions = self._get_positions(value)
+		with self._lock:
+			for position in positions:
+				self.bits[position >> 3] |= 1 << (position & 7)
+			self.count += 1
+
+	def __contains__(self, value):
+		return all(self.bits[position >> 3] & (1 << (position & 7))
+			for position in self._get_positions(value))
+
+class ColumnFilter(object):
+	"""Bloom filter of one model column. Warmed from table on first use, updated when record \
+inserted or updated in this process, and warmed again after `ttl` seconds or when it's over capacity, \
+so records inserted by other process are picked up
+	"""
+
+	def __init__(self, model, field_name, error_rate=0.01, ttl=300):
+		"""Instantiate class object
+
+		Arguments:
+			model {Class} -- Model class
+			field_name {String} -- Column name
+
+		Keyword Arguments:
+			error_rate {Float} -- False positive rate (default: {0.01})
+			ttl {Number} -- Seconds until filter warmed again (default: {300})
+		"""
+		self.model = model
+		self.field_name = field_name
+		self.error_rate = error_rate
+		self.ttl = ttl
+		self.bloom_filter = None
+		self.warmed_at = 0
+		self._recent = None
+		self._lock = threading.Lock()
+		self._warm_lock = threading.Lock()
+		event.listen(model, 'after_insert', self._after_change)
+		event.listen(model, 'after_update', self._after_change)
+
+	def _after_change(self, mapper, connection, target):
+		self.add(getattr(target, self.field_name))
+
+	def add(self, value):
+		"""Add value inserted by this process
+
+		Arguments:
+			value {Object} -- Column value, None is ignored
+		"""
+		if value is None:
+			return
+		with self._lock:
+			if self.bloom_filter is not None:
+				self.bloom_filter.add(value)
+			if self._recent is not None:
+				self._recent.append(value)
+
+	def warm(self):
+		"""Load all values of the column, streamed from database
+		"""
+		column = getattr(self.model, self.field_name)
+		session = self.model.query.session
+		with self._lock:
+			self._recent = []
+		count = session.query(func.count(column)).scalar()
+		bloom_filter = BloomFilter(max(1000, count * 2), self.error_rate)
+		for row in session.query(column).yield_per(1000):
+			bloom_filter.add(row[0])
+
+		with self._lock:
+			# values inserted while warming
+			for value in self._recent:
+				bloom_filter.add(value)
+			self._recent = None
+			self.bloom_filter = bloom_filter
+			self.warmed_at = time.time()
+
+	def might_contain(self, value):
+		"""Check value in filter. Expired filter is warmed by one thread, other threads get True \
+(caller queries database) until warming is done, so table is never scanned concurrently
+
+		Arguments:
+			value {Object} -- Value to be checked
+
+		Returns:
+			Boolean -- False when value definitely not in table
+		"""
+		bloom_filter = self.bloom_filter
+		if bloom_filter is None or bloom_filter.count > bloom_filter.capacity or \
+			time.time() - self.warmed_at > self.ttl:
+				if not self._warm_lock.acquire(blocking=False):
+					return True
+				try:
+					self.warm()
+				finally:
+					self._warm_lock.release()
+				bloom_filter = self.bloom_filter
+		return value in bloom_filter
+
+_column_filters = {}
+_column_filters_lock = threading.Lock()
+
+def get_column_filter(model, field_name):
+	"""Get shared filter of model column, created on first use
+
+	Arguments:
+		model {Class} -- Model class
+		field_name {String} -- Column name
+
+	Returns:
+		ColumnFilter -- Filter of the column
+	"""
+	key = (model, field_name)
+	with _column_filters_lock:
+		if key not in _column_filters:
+			_column_filters[key] = ColumnFilter(model, field_name,
+				error_rate=current_app.config.get('BLOOM_FILTER_ERROR_RATE', 0.01),
+				ttl=current_app.config.get('BLOOM_FILTER_TTL', 300))
+		return _column_filters[key]
+
+def add_rows(model, rows):
+	"""Add values of rows inserted without ORM events (e.g. `bulk_insert_mappings`) to every \
+filter of model which already created
+
+	Arguments:
+		model {Class} -- Model class
+		rows {List} -- Inserted rows, dicts of column name -> value
+	"""
+	with _column_filters_lock:
+		column_filters = [column_filter for (filter_model, _), column_filter in _column_filters.items()
+			if filter_model is model]
+	for column_filter in column_filters:
+		for row in rows:
+			column_filter.add(row.get(column_filter.field_name))
+
+def might_exist(model, field_name, value):
+	"""Check whether value may exist in model column. Always True when `BLOOM_FILTER_ENABLED` \
+is not set, so caller must still query database when this return True
+
+	Arguments:
+		model {Class} -- Model class
+		field_name {String} -- Column name
+		value {Object} -- Value to be checked
+
+	Returns:
+		Boolean -- False when value definitely not in table
+	"""
+	if not current_app.config.get('BLOOM_FILTER_ENABLED'):
+		return True
+	return get_column_filter(model, field_name).might_contain(value)
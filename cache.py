@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""Small cache backends with bounded size and TTL. `memory` backend lives in one process, \
+`file` backend is shared by all processes in same machine
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+from helpers import get_extension_state
+
+class MemoryCache(object):
+	"""Per process LRU cache with TTL, safe to use from many threads
+	"""
+
+	def __init__(self, max_size=1024, ttl=60):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			max_size {Int} -- Max number of items, least recently used item is dropped first (default: {1024})
+			ttl {Number} -- Item lifetime in seconds (default: {60})
+		"""
+		self.max_size = max_size
+		self.ttl = ttl
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		"""Get cached value
+
+		Arguments:
+			key {String} -- Cache key
+
+		Returns:
+			Object|None -- Cached value, None when not found or expired
+		"""
+		with self._lock:
+			item = self._items.get(key)
+			if item is None:
+				return None
+			if item[0] < time.time():
+				del self._items[key]
+				return None
+			self._items.move_to_end(key)
+			return item[1]
+
+	def set(self, key, value):
+		"""Store value to cache
+
+		Arguments:
+			key {String} -- Cache key
+			value {Object} -- Value to be cached
+		"""
+		with self._lock:
+			self._items[key] = (time.time() + self.ttl, value)
+			self._items.move_to_end(key)
+			while len(self._items) > self.max_size:
+				self._items.popitem(last=False)
+
+	def delete(self, key):
+		"""Remove value from cache
+
+		Arguments:
+			key {String} -- Cache key
+		"""
+		with self._lock:
+			self._items.pop(key, None)
+
+	def clear(self):
+		"""Remove all values from cache
+		"""
+		with self._lock:
+			self._items.clear()
+
+class FileCache(object):
+	"""Cache stored as pickle files in one directory, so it's shared between processes in same \
+machine. Oldest files are pruned when number of files is bigger than `max_size`
+	"""
+
+	def __init__(self, directory, max_size=1024, ttl=60):
+		"""Instantiate class object
+
+		Arguments:
+			directory {String} -- Directory of cache files
+
+		Keyword Arguments:
+			max_size {Int} -- Max number of files (default: {1024})
+			ttl {Number} -- Item lifetime in seconds (default: {60})
+		"""
+		self.directory = directory
+		self.max_size = max_size
+		self.ttl = ttl
+		if not os.path.isdir(directory):
+			os.makedirs(directory, exist_ok=True)
+
+	def _get_path(self, key):
+		return os.path.join(self.directory, sha1(str(key).encode('utf-8')).hexdigest())
+
+	def get(self, key):
+		"""Get cached value
+
+		Arguments:
+			key {String} -- Cache key
+
+		Returns:
+			Object|None -- Cached value, None when not found or expired
+		"""
+		path = self._get_path(key)
+		try:
+			with open(path, 'rb') as cache_file:
+				expired_at, value = pickle.load(cache_file)
+		except (IOError, EOFError, pickle.PickleError):
+			return None
+		if expired_at < time.time():
+			self.delete(key)
+			return None
+		return value
+
+	def set(self, key, value):
+		"""Store value to cache. File is written to temporary file then renamed, so other \
+process never read half written file
+
+		Arguments:
+			key {String} -- Cache key
+			value {Object} -- Value to be cached
+		"""
+		self._prune()
+		fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+		with os.fdopen(fd, 'wb') as cache_file:
+			pickle.dump((time.time() + self.ttl, value), cache_file, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, self._get_path(key))
+
+	def delete(self, key):
+		"""Remove value from cache
+
+		Arguments:
+			key {String} -- Cache key
+		"""
+		try:
+			os.remove(self._get_path(key))
+		except OSError:
+			pass
+
+	def clear(self):
+		"""Remove all values from cache
+		"""
+		for name in os.listdir(self.directory):
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except OSError:
+				pass
+
+	def _prune(self):
+		"""Remove oldest files when number of files reach `max_size`
+		"""
+		names = os.listdir(self.directory)
+		if len(names) < self.max_size:
+			return
+
+		paths = [os.path.join(self.directory, name) for name in names]
+		paths.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+		for path in paths[:len(paths) - self.max_size + 1]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+class Cache(object):
+	"""Cache extension, backend is chosen from app config with given prefix, \
+e.g. `USER_CACHE_BACKEND`, `USER_CACHE_SIZE`, `USER_CACHE_TTL` & `USER_CACHE_DIR`. Every app has \
+own backend in `app.extensions`, so methods must be called inside app context
+	"""
+
+	def __init__(self, app=None, config_prefix='CACHE'):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+			config_prefix {String} -- Prefix of config variables (default: {'CACHE'})
+		"""
+		self.config_prefix = config_prefix
+		self.extension_name = 'cache_{}'.format(config_prefix.lower())
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		"""Create cache backend from app config
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		config = app.config
+		prefix = self.config_prefix
+		backend = config.get('{}_BACKEND'.format(prefix), 'memory')
+		max_size = config.get('{}_SIZE'.format(prefix), 1024)
+		ttl = config.get('{}_TTL'.format(prefix), 60)
+		if backend == 'file':
+			directory = config.get('{}_DIR'.format(prefix)) or os.path.join(tempfile.gettempdir(),
+				'cache-{}'.format(prefix.lower()))
+			app.extensions[self.extension_name] = FileCache(directory, max_size=max_size, ttl=ttl)
+		elif backend == 'memory':
+			app.extensions[self.extension_name] = MemoryCache(max_size=max_size, ttl=ttl)
+		else:
+			raise ValueError("Unknown cache backend: {}".format(backend))
+
+	@property
+	def backend(self):
+		"""Backend of current app
+
+		Returns:
+			MemoryCache|FileCache -- Cache backend
+		"""
+		return get_extension_state(self.extension_name)
+
+	def get(self, key):
+		return self.backend.get(key)
+
+	def set(self, key, value):
+		self.backend.set(key, value)
+
+	def delete(self, key):
+		self.backend.delete(key)
+
+	def clear(self):
+		self.backend.clear()
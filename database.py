@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""SQLAlchemy extension with pool tuning, pool metrics and read replica routing. Read only queries \
+go to replica, while writes, locking reads and reads after write in the same session go to primary
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import random
+import threading
+import time
+
+from flask import current_app, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select
+
+# pool arguments which are only accepted by QueuePool
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+class PoolMetrics(object):
+	"""Checkout & wait counters of one engine pool
+	"""
+
+	def __init__(self, name):
+		"""Instantiate class object
+
+		Arguments:
+			name {String} -- Bind name, 'primary' or replica bind key
+		"""
+		self.name = name
+		self.engine = None
+		self.connects = 0
+		self.checkouts = 0
+		self.checkins = 0
+		self.invalidations = 0
+		self.waits = 0
+		self.wait_time = 0.0
+		self.wait_max = 0.0
+		self._lock = threading.Lock()
+
+	def attach(self, engine):
+		"""Listen to pool events of engine
+
+		Arguments:
+			engine {Engine} -- SQLAlchemy engine
+		"""
+		self.engine = engine
+		event.listen(engine, 'connect', self._on_connect)
+		event.listen(engine, 'checkout', self._on_checkout)
+		event.listen(engine, 'checkin', self._on_checkin)
+		event.listen(engine, 'invalidate', self._on_invalidate)
+		if isinstance(engine.pool, MeteredQueuePool):
+			engine.pool.metrics = self
+
+	def _on_connect(self, dbapi_connection, connection_record):
+		with self._lock:
+			self.connects += 1
+
+	def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+		with self._lock:
+			self.checkouts += 1
+
+	def _on_checkin(self, dbapi_connection, connection_record):
+		with self._lock:
+			self.checkins += 1
+
+	def _on_invalidate(self, dbapi_connection, connection_record, exception):
+		with self._lock:
+			self.invalidations += 1
+
+	def record_wait(self, seconds):
+		"""Record time spent waiting for free connection in pool
+
+		Arguments:
+			seconds {Float} -- Wait time
+		"""
+		with self._lock:
+			self.waits += 1
+			self.wait_time += seconds
+			self.wait_max = max(self.wait_max, seconds)
+
+	def snapshot(self):
+		"""Current metrics values
+
+		Returns:
+			Dict -- Counters, plus size & overflow of pool when pool is `QueuePool`
+		"""
+		with self._lock:
+			result = {
+				'connects': self.connects,
+				'checkouts': self.checkouts,
+				'checkins': self.checkins,
+				'checked_out': self.checkouts - self.checkins,
+				'invalidations': self.invalidations,
+				'waits': self.waits,
+				'wait_time': self.wait_time,
+				'wait_max': self.wait_max,
+			}
+		pool = self.engine.pool if self.engine is not None else None
+		if isinstance(pool, QueuePool):
+			result['pool_size'] = pool.size()
+			result['overflow'] = pool.overflow()
+		return result
+
+class MeteredQueuePool(QueuePool):
+	"""QueuePool which records how long every checkout waits for connection
+	"""
+
+	metrics = None
+
+	def _do_get(self):
+		started = time.time()
+		try:
+			return super(MeteredQueuePool, self)._do_get()
+		finally:
+			if self.metrics is not None:
+				self.metrics.record_wait(time.time() - started)
+
+	def recreate(self):
+		pool = super(MeteredQueuePool, self).recreate()
+		pool.metrics = self.metrics
+		return pool
+
+class RoutingSession(SignallingSession):
+	"""Session which sends read only queries to one replica (chosen once per session). Session \
+sticks to primary after its first write, and inside `BaseModel.transaction()` scope
+	"""
+
+	def get_bind(self, mapper=None, clause=None):
+		"""Return engine for a given model or statement
+
+		Keyword Arguments:
+			mapper {Mapper} -- Mapper of queried model (default: {None})
+			clause {ClauseElement} -- Statement to be executed (default: {None})
+
+		Returns:
+			Engine -- Primary or replica engine
+		"""
+		replica_binds = getattr(get_state(self.app), 'replica_binds', None)
+		if not replica_binds or not self.is_read_only(clause):
+			if clause is not None and not isinstance(clause, Select):
+				self.info['use_primary'] = True
+				self.info['wrote'] = True
+			return super(RoutingSession, self).get_bind(mapper, clause)
+
+		if mapper is not None and mapper.persist_selectable.info.get('bind_key') is not None:
+			return super(RoutingSession, self).get_bind(mapper, clause)
+
+		bind_key = self.info.get('replica_bind')
+		if bind_key is None:
+			bind_key = self.info['replica_bind'] = random.choice(replica_binds)
+		return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+
+	def is_read_only(self, clause):
+		"""Check whether statement can be sent to replica
+
+		Arguments:
+			clause {ClauseElement} -- Statement to be executed
+
+		Returns:
+			Boolean -- True when statement is plain SELECT outside of write
+		"""
+		if self._flushing or self.info.get('use_primary') or self.info.get('transaction_depth'):
+			return False
+		return isinstance(clause, Select) and clause._for_update_arg is None
+
+class RoutingSQLAlchemy(SQLAlchemy):
+	"""SQLAlchemy extension with `RoutingSession`. Replica URIs in `SQLALCHEMY_REPLICA_URIS` are \
+added to `SQLALCHEMY_BINDS` as `replica_<n>`
+	"""
+
+	def init_app(self, app):
+		"""Register replica binds & read-after-write hooks
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+		app.config.setdefault('SQLALCHEMY_REPLICA_STICKY_SECONDS', 5)
+		binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+		replica_binds = []
+		for idx, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS']):
+			bind_key = 'replica_{}'.format(idx)
+			binds[bind_key] = uri
+			replica_binds.append(bind_key)
+		app.config['SQLALCHEMY_BINDS'] = binds or None
+
+		super(RoutingSQLAlchemy, self).init_app(app)
+		state = get_state(app)
+		state.replica_binds = replica_binds
+		state.pool_metrics = {}
+		state.pool_metrics_lock = threading.Lock()
+		if replica_binds:
+			app.before_request(self._before_request)
+			app.after_request(self._after_request)
+
+	def create_session(self, options):
+		"""Create session factory of `RoutingSession`
+
+		Arguments:
+			options {Dict} -- Keyword arguments of session class
+
+		Returns:
+			sessionmaker -- Session factory
+		"""
+		return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+	def create_engine(self, sa_url, engine_opts):
+		"""Create engine. QueuePool is replaced by `MeteredQueuePool`, and QueuePool only options \
+are dropped when dialect uses other pool (e.g. SQLite)
+
+		Arguments:
+			sa_url {URL} -- Database URL
+			engine_opts {Dict} -- Keyword arguments of `sqlalchemy.create_engine()`
+
+		Returns:
+			Engine -- Created engine
+		"""
+		options = dict(engine_opts)
+		poolclass = options.get('poolclass') or sa_url.get_dialect().get_pool_class(sa_url)
+		if issubclass(poolclass, QueuePool):
+			if poolclass is QueuePool:
+				options['poolclass'] = MeteredQueuePool
+		else:
+			for key in QUEUE_POOL_OPTIONS:
+				options.pop(key, None)
+		return super(RoutingSQLAlchemy, self).create_engine(sa_url, options)
+
+	def get_engine(self, app=None, bind=None):
+		"""Return engine of bind, and start collecting its pool metrics
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+			bind {String} -- Bind key, None = primary (default: {None})
+
+		Returns:
+			Engine -- Engine of bind
+		"""
+		app = self.get_app(app)
+		engine = super(RoutingSQLAlchemy, self).get_engine(app, bind)
+		state = get_state(app)
+		name = bind or 'primary'
+		metrics = state.pool_metrics.get(name)
+		if metrics is None or metrics.engine is not engine:
+			with state.pool_metrics_lock:
+				metrics = state.pool_metrics.get(name)
+				if metrics is None or metrics.engine is not engine:
+					metrics = PoolMetrics(name)
+					metrics.attach(engine)
+					state.pool_metrics[name] = metrics
+		return engine
+
+	def get_pool_metrics(self, app=None):
+		"""Pool metrics of every engine of app which has been used
+
+		Keyword Arguments:
+			app {Flask} -- Flask app, default to current app (default: {None})
+
+		Returns:
+			Dict -- Metrics by bind name
+		"""
+		pool_metrics = get_state(self.get_app(app)).pool_metrics
+		return {name: metrics.snapshot() for name, metrics in list(pool_metrics.items())}
+
+	def _before_request(self):
+		"""Keep using primary for a few seconds after user wrote something, so next page shows \
+the written data even when replica lags behind
+		"""
+		if flask_session.get('_db_primary_until', 0) > time.time():
+			self.session.info['use_primary'] = True
+
+	def _after_request(self, response):
+		"""Remember time of last write in user session
+
+		Arguments:
+			response {Response} -- Response of the request
+
+		Returns:
+			Response -- Same response
+		"""
+		if self.session.registry.has() and self.session.info.get('wrote'):
+			flask_session['_db_primary_until'] = time.time() + \
+				current_app.config['SQLALCHEMY_REPLICA_STICKY_SECONDS']
+		return response
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+	"""Route next reads of session to primary, replica may not have the flushed rows yet
+	"""
+	session.info['use_primary'] = True
+	session.info['wrote'] = True
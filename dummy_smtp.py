@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-in SMTP server, used by tests & benchmark
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import socketserver
+import threading
+
+class DummySMTPHandler(socketserver.StreamRequestHandler):
+	"""Handle one SMTP session, just enough protocol for smtplib to deliver messages
+	"""
+
+	def reply(self, line):
+		self.wfile.write(line + b'\r\n')
+
+	def handle(self):
+		self.server.connections += 1
+		self.reply(b'220 localhost Dummy SMTP')
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				break
+
+			command = line.strip().upper()
+			if command.startswith(b'DATA'):
+				self.reply(b'354 End data with <CR><LF>.<CR><LF>')
+				data = []
+				while True:
+					line = self.rfile.readline()
+					if line in (b'', b'.\r\n', b'.\n'):
+						break
+					data.append(line)
+				self.server.messages.append(b''.join(data))
+				self.reply(b'250 OK')
+			elif command.startswith(b'QUIT'):
+				self.reply(b'221 Bye')
+				break
+			else:
+				self.reply(b'250 OK')
+
+class DummySMTPServer(socketserver.ThreadingTCPServer):
+	"""Local stand-in SMTP server which records received messages
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self):
+		socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), DummySMTPHandler)
+		self.connections = 0
+		self.messages = []
+
+	def __enter__(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+	def __exit__(self, *args):
+		self.shutdown()
+		self.server_close()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""Password hashing service. Argon2 hashing & verification is dispatched to process pool, \
+so CPU heavy work doesn't occupy request thread and scales with CPU count
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import argon2
+from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHash
+from flask import current_app, make_response
+
+from helpers import get_extension_state
+
+_process_hasher = None
+
+def _get_process_hasher(params):
+	"""Get argon2 PasswordHasher of current process, created once per parameters
+
+	Arguments:
+		params {Tuple} -- Argon2 parameters (time_cost, memory_cost, parallelism, hash_len, salt_len, encoding)
+
+	Returns:
+		PasswordHasher -- Argon2 hasher
+	"""
+	global _process_hasher
+	if _process_hasher is None or _process_hasher[0] != params:
+		_process_hasher = (params, argon2.PasswordHasher(*params))
+	return _process_hasher[1]
+
+def _hash_password(params, password):
+	"""Hash password, run inside worker process
+
+	Arguments:
+		params {Tuple} -- Argon2 parameters
+		password {String} -- Plaintext password
+
+	Returns:
+		String -- Hash result
+	"""
+	return _get_process_hasher(params).hash(password)
+
+def _verify_password(params, pw_hash, password):
+	"""Verify password with hash, run inside worker process
+
+	Arguments:
+		params {Tuple} -- Argon2 parameters
+		pw_hash {String} -- Hash to be compared
+		password {String} -- Plaintext password
+
+	Returns:
+		Boolean -- Verify result
+	"""
+	try:
+		return _get_process_hasher(params).verify(pw_hash, password)
+	except (VerifyMismatchError, VerificationError, InvalidHash):
+		return False
+
+def _get_mp_context():
+	"""Start method of worker processes. Pool is created while request threads are running, and \
+fork of multithreaded process may copy lock held by other thread, so workers are started by \
+forkserver (or spawn, when platform has no forkserver)
+
+	Returns:
+		BaseContext -- Multiprocessing context
+	"""
+	if 'forkserver' in multiprocessing.get_all_start_methods():
+		return multiprocessing.get_context('forkserver')
+	return multiprocessing.get_context('spawn')
+
+class HashQueueFull(RuntimeError):
+	"""Raised when hashing queue still full after `PASSWORD_HASH_TIMEOUT`
+	"""
+
+class _HashPool(object):
+	"""Process pool & job queue of one app
+	"""
+
+	def __init__(self, params, workers, queue_size, timeout):
+		"""Instantiate class object
+
+		Arguments:
+			params {Tuple} -- Argon2 parameters
+			workers {Int} -- Number of worker processes, 0 = hash inside calling thread
+			queue_size {Int} -- Max number of pending jobs
+			timeout {Number|None} -- Max seconds to wait for queue slot
+		"""
+		self.params = params
+		self.workers = workers
+		self.timeout = timeout
+		self.slots = threading.BoundedSemaphore(queue_size)
+		self.executor = None
+		self.lock = threading.Lock()
+
+	def get_executor(self):
+		"""Get process pool, created on first use so it's never created before worker fork
+
+		Returns:
+			ProcessPoolExecutor -- Process pool
+		"""
+		if self.executor is None:
+			with self.lock:
+				if self.executor is None:
+					self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_get_mp_context())
+		return self.executor
+
+	def shutdown(self):
+		"""Stop process pool. Pool will be created again on next job
+		"""
+		with self.lock:
+			if self.executor is not None:
+				self.executor.shutdown(wait=True)
+				self.executor = None
+
+class PasswordHashService(object):
+	"""Dispatch argon2 hashing to process pool sized to CPU count. Number of pending jobs is \
+bounded by `PASSWORD_HASH_QUEUE_SIZE`, caller waits (backpressure) when queue is full. \
+Set `PASSWORD_HASH_WORKERS` to 0 to hash inside calling thread. Every app has own pool in \
+`app.extensions`, so methods must be called inside app context
+	"""
+
+	def __init__(self, app=None, argon2_ext=None):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+			argon2_ext {Argon2} -- flask_argon2 extension which holds argon2 parameters (default: {None})
+		"""
+		self.argon2 = argon2_ext
+		# called with (seconds, (operation,)) inside app context when job done, time includes queue wait
+		self.observer = None
+		if app is not None:
+			self.init_app(app, argon2_ext)
+
+	def init_app(self, app, argon2_ext=None):
+		"""Initialize pool of app from app config. Argon2 parameters are read from `argon2_ext` \
+now, so call it right after `argon2_ext.init_app(app)`
+
+		Arguments:
+			app {Flask} -- Flask app
+
+		Keyword Arguments:
+			argon2_ext {Argon2} -- flask_argon2 extension which holds argon2 parameters (default: {None})
+		"""
+		if argon2_ext is not None:
+			self.argon2 = argon2_ext
+		workers = app.config.get('PASSWORD_HASH_WORKERS')
+		if workers is None:
+			workers = os.cpu_count() or 1
+		queue_size = app.config.get('PASSWORD_HASH_QUEUE_SIZE') or max(1, workers) * 4
+		params = (self.argon2.time_cost, self.argon2.memory_cost, self.argon2.parallelism,
+			self.argon2.hash_len, self.argon2.salt_len, self.argon2.encoding)
+
+		previous = app.extensions.get('password_hash')
+		if previous is not None:
+			previous.shutdown()
+		app.extensions['password_hash'] = _HashPool(params, workers, queue_size,
+			app.config.get('PASSWORD_HASH_TIMEOUT'))
+		app.register_error_handler(HashQueueFull, self._queue_full_response)
+
+	def _queue_full_response(self, error):
+		"""Response of request which waited too long for hashing queue, client may retry soon
+
+		Arguments:
+			error {HashQueueFull} -- Raised error
+
+		Returns:
+			Response -- 503 response with `Retry-After` header
+		"""
+		current_app.logger.warning("Password hashing queue is full, request rejected")
+		return make_response("Server is busy, please try again later.", 503,
+			{'Retry-After': str(current_app.config.get('PASSWORD_HASH_RETRY_AFTER', 5))})
+
+	def _get_pool(self, app=None):
+		return get_extension_state('password_hash', app)
+
+	@property
+	def params(self):
+		"""Argon2 parameters of current app, which sent to worker process
+
+		Returns:
+			Tuple -- (time_cost, memory_cost, parallelism, hash_len, salt_len, encoding)
+		"""
+		return self._get_pool().params
+
+	def _submit(self, fn, *args):
+		"""Submit job to process pool of current app, wait when queue is full
+
+		Arguments:
+			fn {Function} -- Job function
+			*args -- Job arguments
+
+		Raises:
+			HashQueueFull -- Raise when no queue slot available after `timeout`
+
+		Returns:
+			Future -- Job result
+		"""
+		started = time.perf_counter()
+		app = current_app._get_current_object()
+		pool = self._get_pool(app)
+		if not pool.workers:
+			future = Future()
+			future.set_result(fn(*args))
+			self._observe(app, fn, started)
+			return future
+
+		if not pool.slots.acquire(timeout=pool.timeout):
+			raise HashQueueFull("Password hashing queue is full")
+		try:
+			future = pool.get_executor().submit(fn, *args)
+		except Exception:
+			pool.slots.release()
+			raise
+		future.add_done_callback(lambda _: pool.slots.release())
+		if self.observer is not None:
+			future.add_done_callback(lambda _: self._observe(app, fn, started))
+		return future
+
+	def _observe(self, app, fn, started):
+		"""Report job time to `observer`
+
+		Arguments:
+			app {Flask} -- App which submitted the job, pushed as app context of observer
+			fn {Function} -- Job function
+			started {Float} -- `time.perf_counter()` when job submitted
+		"""
+		if self.observer is not None:
+			operation = 'verify' if fn is _verify_password else 'hash'
+			with app.app_context():
+				self.observer(time.perf_counter() - started, (operation,))
+
+	def generate_password_hash_async(self, password):
+		"""Hash password in process pool
+
+		Arguments:
+			password {String} -- Password to be hashed
+
+		Raises:
+			ValueError -- Raise when password is empty
+
+		Returns:
+			Future -- Future of hash result
+		"""
+		if not password:
+			raise ValueError('Password must be non-empty.')
+		return self._submit(_hash_password, self.params, password)
+
+	def generate_password_hash(self, password):
+		"""Hash password, wait for the result
+
+		Arguments:
+			password {String} -- Password to be hashed
+
+		Returns:
+			String -- Hash result
+		"""
+		return self.generate_password_hash_async(password).result()
+
+	def check_password_hash_async(self, pw_hash, password):
+		"""Verify password with hash in process pool
+
+		Arguments:
+			pw_hash {String} -- Hash to be compared
+			password {String} -- Password to compare
+
+		Returns:
+			Future -- Future of verify result
+		"""
+		return self._submit(_verify_password, self.params, pw_hash, password)
+
+	def check_password_hash(self, pw_hash, password):
+		"""Verify password with hash, wait for the result
+
+		Arguments:
+			pw_hash {String} -- Hash to be compared
+			password {String} -- Password to compare
+
+		Returns:
+			Boolean -- Verify result
+		"""
+		return self.check_password_hash_async(pw_hash, password).result()
+
+	def needs_rehash(self, pw_hash):
+		"""Check whether hash was made with other argon2 parameters than current config. \
+Only parse the hash, so it's cheap enough to run in request thread
+
+		Arguments:
+			pw_hash {String} -- Hash to be checked
+
+		Returns:
+			Boolean -- True when hash must be generated again
+		"""
+		try:
+			return _get_process_hasher(self.params).check_needs_rehash(pw_hash)
+		except (InvalidHash, ValueError):
+			return True
+
+	def shutdown(self, app=None):
+		"""Stop process pool of app. Pool will be created again on next job
+
+		Keyword Arguments:
+			app {Flask} -- Flask app, default to current app (default: {None})
+		"""
+		self._get_pool(app).shutdown()
@@ -8,7 +8,9 @@ Author:
 
 from re import sub
 from string import ascii_uppercase, ascii_lowercase, digits
-from random import choice
+from random import choice, uniform
+
+from flask import current_app
 
 def slugify(raw_string):
 	"""Get slug string pattern
@@ -21,31 +23,38 @@ def slugify(raw_string):
 	"""
 	return sub(r'[^\w]+', '-', raw_string).lower()
 
-def generate_slug(cls, raw_string):
-	"""Get slug string pattern. First must check to database, because slug usually unique. \
-If slug value same with record in db, slug string will add increment number
+def generate_slug(cls, raw_string, connection=None):
+	"""Get unique slug string pattern. If slug value already used, slug string will add \
+increment number. Index is taken from counter table (see models.allocate_slugs)
 
 	Arguments:
+		cls {Class} -- Model class which has `slug` column
 		raw_string {String} -- String to get slug
 
+	Keyword Arguments:
+		connection {Connection} -- Database connection (default: {None})
+
 	Returns:
 		String -- Result of slug string
 	"""
 	if not hasattr(cls, 'slug'):
 		return None
 
-	slug = slugify(raw_string)
-	obj = getattr(cls, 'slug')
-	model = cls.query.filter(obj.startswith(slug)).order_by(obj.desc()).first()
-	if model:
-		idx_slug = model.slug.split('-')[-1]
-		if idx_slug.isdigit():
-			idx_new = int(idx_slug) + 1
-			return "{0}-{1}".format(slug, idx_new)
+	from models import allocate_slugs
+	return allocate_slugs(cls, [raw_string], connection)[0]
 
-		return "{0}-1".format(slug)
+def normalize_email(email):
+	"""Get normalized email, used to compare email case-insensitively
 
-	return slug
+	Arguments:
+		email {String} -- Raw email
+
+	Returns:
+		String|None -- Normalized email
+	"""
+	if email is None:
+		return None
+	return email.strip().lower()
 
 def generate_random_string(length):
 	"""Generate random string
@@ -58,3 +67,40 @@ def generate_random_string(length):
 	"""
 	char_list = ascii_uppercase + digits + ascii_lowercase
 	return ''.join(choice(char_list) for _ in range(length))
+
+def exponential_backoff(attempt, base_delay, max_delay):
+	"""Get retry delay which doubled on every attempt, capped by `max_delay`. Half of delay is \
+randomized (jitter), so retries of many failed jobs are spread out
+
+	Arguments:
+		attempt {Int} -- Number of failed attempts, start from 1
+		base_delay {Number} -- Delay after first failed attempt, in seconds
+		max_delay {Number} -- Max delay, in seconds
+
+	Returns:
+		Float -- Delay in seconds
+	"""
+	delay = min(max_delay, base_delay * (2 ** max(0, attempt - 1)))
+	return delay / 2.0 + uniform(0, delay / 2.0)
+
+def get_extension_state(name, app=None):
+	"""Get state of extension, which is kept per app in `app.extensions` by `init_app()`
+
+	Arguments:
+		name {String} -- Key in `app.extensions`
+
+	Keyword Arguments:
+		app {Flask} -- Flask app, default to current app (default: {None})
+
+	Raises:
+		RuntimeError -- Raise when extension is not initialized for the app
+
+	Returns:
+		Object -- Extension state
+	"""
+	if app is None:
+		app = current_app._get_current_object()
+	try:
+		return app.extensions[name]
+	except KeyError:
+		raise RuntimeError("Extension {} is not initialized for app {}".format(name, app.name))
@@ -6,10 +6,9 @@ Author:
 	@CakJuice <hd.brandoz@gmail.com>
 """
 
-from app import app
-from modules.base.blueprint import base_app
+from app import create_app
 
-app.register_blueprint(base_app, url_prefix='')
+app = create_app()
 
 if __name__ == '__main__':
 	app.run(port=9999)
@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 
-"""Use to manage database. Integrated with app.manager
+"""Use to manage database. Migration & manage commands are only loaded here, not in app
 
 Author:
 	@CakJuice <hd.brandoz@gmail.com>
 """
 
-from app import manager
-from main import *
+from flask_migrate import Migrate, MigrateCommand
+from flask_script import Manager
+
+from app import create_app, db
 from modules.base.models.user import User
 from modules.base.models.mail import MailOutgoing
+from modules.base.models.token import VerifyToken
+from modules.base.commands import manager as base_manager
+
+app = create_app()
+migrate = Migrate(app, db)
+
+manager = Manager(app)
+manager.add_command('db', MigrateCommand)
+manager.add_command('base', base_manager)
 
 if __name__ == '__main__':
 	manager.run()
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+"""Counters, gauges & histograms exposed in Prometheus text format. Values are kept in process \
+memory, so recording a value only costs one lock & a few dict operations. With `METRICS_DIR` \
+every process writes its values to own file periodically, and the metrics route sums all files
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import atexit
+import glob
+import hmac
+import itertools
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, request, abort, current_app
+
+from helpers import get_extension_state
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# metrics-<app name>-<pid>-<state number>.pickle
+FILE_PATTERN = re.compile(r'^metrics-(.*)-(\d+)-(\d+)\.pickle$')
+# number of state in this process, so every app has own file
+_state_numbers = itertools.count()
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+class Metric(object):
+	"""Definition of one metric
+	"""
+
+	def __init__(self, name, kind, documentation, label_names=(), buckets=None):
+		"""Instantiate class object
+
+		Arguments:
+			name {String} -- Metric name
+			kind {String} -- COUNTER, GAUGE or HISTOGRAM
+			documentation {String} -- Help text
+
+		Keyword Arguments:
+			label_names {Tuple} -- Label names (default: {()})
+			buckets {Tuple} -- Upper bounds of histogram buckets (default: {None})
+		"""
+		self.name = name
+		self.kind = kind
+		self.documentation = documentation
+		self.label_names = tuple(label_names)
+		self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS))
+
+class _MetricsState(object):
+	"""Values of one app, written to own file of every process in multiprocess mode
+	"""
+
+	def __init__(self, name='app', directory=None, flush_interval=5):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			name {String} -- App name, files of same app name are summed (default: {'app'})
+			directory {String} -- `METRICS_DIR`, None = values are not shared (default: {None})
+			flush_interval {Number} -- Seconds between writes to `directory` (default: {5})
+		"""
+		self.name = re.sub(r'[^A-Za-z0-9_.]', '_', name)
+		self.number = next(_state_numbers)
+		self.directory = directory
+		self.flush_interval = flush_interval
+		self.lock = threading.Lock()
+		self.thread = None
+		self.last_flush = time.time()
+		self.reset_values()
+
+	def reset_values(self):
+		self.counters = {}
+		self.gauges = {}
+		self.histograms = {}
+
+	def after_fork(self):
+		"""Values copied from parent process belong to parent, child starts from zero. Files of \
+dead workers are removed, so their values are not summed forever
+		"""
+		self.lock = threading.Lock()
+		self.reset_values()
+		self.thread = None
+		self.prune()
+
+	def prune(self):
+		"""Remove files of processes which no longer running
+		"""
+		if not self.directory:
+			return
+		try:
+			filenames = os.listdir(self.directory)
+		except OSError:
+			return
+		for filename in filenames:
+			match = FILE_PATTERN.match(filename)
+			if match is None or _is_running(int(match.group(2))):
+				continue
+			try:
+				os.remove(os.path.join(self.directory, filename))
+			except OSError:
+				pass
+
+	def maybe_start_flush(self):
+		"""Start background flush in multiprocess mode, started on first value so it's never \
+started before worker fork
+		"""
+		if self.directory and self.thread is None:
+			with self.lock:
+				if self.thread is None:
+					self.thread = threading.Thread(target=self._run, daemon=True)
+					self.thread.start()
+
+	def _run(self):
+		"""Background loop which writes values of this process periodically
+		"""
+		while True:
+			time.sleep(max(0.1, self.last_flush + self.flush_interval - time.time()))
+			if time.time() - self.last_flush >= self.flush_interval:
+				try:
+					self.flush()
+				except OSError:
+					# values are kept in memory, written again on next flush
+					self.last_flush = time.time()
+
+	def get_path(self):
+		return os.path.join(self.directory, 'metrics-{}-{}-{}.pickle'.format(self.name, os.getpid(),
+			self.number))
+
+	def get_paths(self):
+		"""Files of this app written by every process
+
+		Returns:
+			List -- File paths
+		"""
+		return glob.glob(os.path.join(glob.escape(self.directory),
+			'metrics-{}-*.pickle'.format(glob.escape(self.name))))
+
+	def flush(self):
+		"""Write counters & histograms of this process to `directory`
+		"""
+		if not self.directory:
+			return
+		with self.lock:
+			values = (dict(self.counters), {key: [list(histogram[0]), histogram[1]]
+				for key, histogram in self.histograms.items()})
+			self.last_flush = time.time()
+		fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+		with os.fdopen(fd, 'wb') as metrics_file:
+			pickle.dump(values, metrics_file, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, self.get_path())
+
+class Metrics(object):
+	"""Metrics extension. Records request count, status code & latency of every endpoint, \
+other modules define their own metrics with `define()`. Definitions & collectors are shared, \
+values are kept per app in `app.extensions`, so recording must happen inside app context
+	"""
+
+	def __init__(self, app=None):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+		"""
+		self._metrics = {}
+		self._collectors = []
+		self._states = weakref.WeakSet()
+		self.define('http_requests_total', COUNTER, "Number of handled requests",
+			('endpoint', 'method', 'status'))
+		self.define('http_request_duration_seconds', HISTOGRAM, "Request latency",
+			('endpoint',))
+		if hasattr(os, 'register_at_fork'):
+			os.register_at_fork(after_in_child=self._after_fork)
+		atexit.register(self._flush_all)
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		"""Create values of app, register request hooks & metrics route
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		app.config.setdefault('METRICS_ENABLED', True)
+		app.config.setdefault('METRICS_ROUTE', '/metrics')
+		app.config.setdefault('METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+		app.config.setdefault('METRICS_TOKEN', None)
+		app.config.setdefault('METRICS_DIR', None)
+		app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+		directory = app.config['METRICS_DIR']
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		state = _MetricsState(app.name, directory, app.config['METRICS_FLUSH_INTERVAL'])
+		app.extensions['metrics'] = state
+		self._states.add(state)
+		if not app.config['METRICS_ENABLED']:
+			return
+
+		app.before_request(self._before_request)
+		app.after_request(self._after_request)
+		app.add_url_rule(app.config['METRICS_ROUTE'], 'metrics', self._metrics_view)
+
+	def _get_state(self):
+		return get_extension_state('metrics')
+
+	def define(self, name, kind, documentation, label_names=(), buckets=None):
+		"""Define metric, defining same name again keeps the first definition
+
+		Arguments:
+			name {String} -- Metric name
+			kind {String} -- COUNTER, GAUGE or HISTOGRAM
+			documentation {String} -- Help text
+
+		Keyword Arguments:
+			label_names {Tuple} -- Label names (default: {()})
+			buckets {Tuple} -- Upper bounds of histogram buckets (default: {None})
+
+		Returns:
+			Metric -- Metric definition
+		"""
+		return self._metrics.setdefault(name, Metric(name, kind, documentation, label_names, buckets))
+
+	def register_collector(self, collector):
+		"""Register function which returns gauge values when metrics are scraped, e.g. values \
+queried from database. Collected values are not shared between processes
+
+		Arguments:
+			collector {Function} -- Function which returns list of (name, labels, value)
+		"""
+		self._collectors.append(collector)
+
+	def inc(self, name, labels=(), value=1):
+		"""Increase counter
+
+		Arguments:
+			name {String} -- Metric name
+
+		Keyword Arguments:
+			labels {Tuple} -- Label values, same order as `label_names` (default: {()})
+			value {Float} -- Increment (default: {1})
+		"""
+		key = (name, labels)
+		state = self._get_state()
+		with state.lock:
+			state.counters[key] = state.counters.get(key, 0) + value
+		state.maybe_start_flush()
+
+	def set_gauge(self, name, value, labels=()):
+		"""Set gauge value of this process
+
+		Arguments:
+			name {String} -- Metric name
+			value {Float} -- Gauge value
+
+		Keyword Arguments:
+			labels {Tuple} -- Label values (default: {()})
+		"""
+		state = self._get_state()
+		with state.lock:
+			state.gauges[(name, labels)] = value
+
+	def observe(self, name, value, labels=()):
+		"""Add value to histogram
+
+		Arguments:
+			name {String} -- Metric name
+			value {Float} -- Observed value, e.g. seconds
+
+		Keyword Arguments:
+			labels {Tuple} -- Label values (default: {()})
+		"""
+		buckets = self._metrics[name].buckets
+		index = bisect_left(buckets, value)
+		key = (name, labels)
+		state = self._get_state()
+		with state.lock:
+			histogram = state.histograms.get(key)
+			if histogram is None:
+				histogram = state.histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+			histogram[0][index] += 1
+			histogram[1] += value
+		state.maybe_start_flush()
+
+	def observer(self, name):
+		"""Make callback which adds value to histogram, for code which doesn't know this extension
+
+		Arguments:
+			name {String} -- Metric name
+
+		Returns:
+			Function -- Callback with (value, labels) arguments
+		"""
+		return lambda value, labels=(): self.observe(name, value, labels)
+
+	@contextmanager
+	def timer(self, name, labels=()):
+		"""Observe run time of block in seconds, also when block raises exception
+
+		Arguments:
+			name {String} -- Metric name
+
+		Keyword Arguments:
+			labels {Tuple} -- Label values (default: {()})
+		"""
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - started, labels)
+
+	def _before_request(self):
+		g.metrics_started = time.perf_counter()
+
+	def _after_request(self, response):
+		"""Record count, status code & latency of request
+
+		Arguments:
+			response {Response} -- Response of the request
+
+		Returns:
+			Response -- Same response
+		"""
+		started = g.get('metrics_started')
+		if started is not None:
+			endpoint = request.endpoint or 'unknown'
+			self.inc('http_requests_total', (endpoint, request.method, str(response.status_code)))
+			self.observe('http_request_duration_seconds', time.perf_counter() - started, (endpoint,))
+		return response
+
+	def _is_allowed(self):
+		"""Check access of metrics route. Request with `Authorization: Bearer <METRICS_TOKEN>` is \
+always allowed. Otherwise client must be in `METRICS_ALLOWED_IPS` and connect directly, request \
+forwarded by reverse proxy is refused because its remote address is the proxy
+
+		Returns:
+			Boolean -- True when metrics may be shown
+		"""
+		token = current_app.config['METRICS_TOKEN']
+		if token:
+			authorization = request.headers.get('Authorization', '')
+			if hmac.compare_digest(authorization.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')):
+				return True
+		if 'X-Forwarded-For' in request.headers or 'Forwarded' in request.headers:
+			return False
+		return request.remote_addr in current_app.config['METRICS_ALLOWED_IPS']
+
+	def _metrics_view(self):
+		"""Metrics route, only answered when `_is_allowed()`
+
+		Returns:
+			Tuple -- Metrics in Prometheus text format
+		"""
+		if not self._is_allowed():
+			abort(404)
+		return self.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+	def _after_fork(self):
+		for state in list(self._states):
+			state.after_fork()
+
+	def _flush_all(self):
+		"""Write values of every app when process exits
+		"""
+		for state in list(self._states):
+			try:
+				state.flush()
+			except OSError:
+				pass
+
+	def flush(self):
+		"""Write counters & histograms of current app in this process to `METRICS_DIR`
+		"""
+		self._get_state().flush()
+
+	def collect(self):
+		"""Collect values of all processes (or this process only when `METRICS_DIR` not set)
+
+		Returns:
+			Tuple -- Counters, gauges & histograms
+		"""
+		state = self._get_state()
+		if not state.directory:
+			with state.lock:
+				return (dict(state.counters), dict(state.gauges), {key: [list(histogram[0]), histogram[1]]
+					for key, histogram in state.histograms.items()})
+
+		state.flush()
+		counters, histograms = {}, {}
+		for path in state.get_paths():
+			try:
+				with open(path, 'rb') as metrics_file:
+					process_counters, process_histograms = pickle.load(metrics_file)
+			except (IOError, EOFError, pickle.PickleError):
+				continue
+			for key, value in process_counters.items():
+				counters[key] = counters.get(key, 0) + value
+			for key, (counts, total) in process_histograms.items():
+				histogram = histograms.setdefault(key, [[0] * len(counts), 0.0])
+				histogram[0] = [left + right for left, right in zip(histogram[0], counts)]
+				histogram[1] += total
+		with state.lock:
+			gauges = dict(state.gauges)
+		return counters, gauges, histograms
+
+	def render(self):
+		"""Render metrics in Prometheus text format
+
+		Returns:
+			String -- Metrics text
+		"""
+		counters, gauges, histograms = self.collect()
+		for collector in self._collectors:
+			for name, labels, value in collector():
+				gauges[(name, labels)] = value
+
+		lines = []
+		for name, metric in sorted(self._metrics.items()):
+			values = {COUNTER: counters, GAUGE: gauges, HISTOGRAM: histograms}[metric.kind]
+			keys = sorted(key for key in values if key[0] == name)
+			lines.append('# HELP {} {}'.format(name, metric.documentation))
+			lines.append('# TYPE {} {}'.format(name, metric.kind))
+			for key in keys:
+				labels = list(zip(metric.label_names, key[1]))
+				if metric.kind != HISTOGRAM:
+					lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(values[key])))
+					continue
+
+				counts, total = values[key]
+				cumulative = 0
+				for bound, count in zip(metric.buckets + (float('inf'),), counts):
+					cumulative += count
+					lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + [('le', bound)]),
+						cumulative))
+				lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(total)))
+				lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+		return '\n'.join(lines) + '\n'
+
+	def reset(self):
+		"""Remove values of current app in this process
+		"""
+		state = self._get_state()
+		with state.lock:
+			state.reset_values()
+
+def _is_running(pid):
+	"""Check whether process exists
+
+	Arguments:
+		pid {Int} -- Process id
+
+	Returns:
+		Boolean -- False when process no longer exists
+	"""
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except OSError:
+		# e.g. process of other user
+		return True
+	return True
+
+def _format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(name, _format_value(value) if isinstance(value, float)
+		else str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+		for name, value in labels) + '}'
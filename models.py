@@ -6,14 +6,221 @@ Author:
 	@CakJuice <hd.brandoz@gmail.com>
 """
 
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy.exc import IntegrityError
+
 from app import db
+from helpers import slugify
 
 class BaseModel(object):
 	"""Mixin class with db.Model
 	"""
 
-	def save(self):
-		"""Save (commit) data to database
+	def save(self, commit=True):
+		"""Save data to database. Inside `transaction()` scope, or when `commit` is False, data is \
+only flushed and committed later. Cached copy of this record is invalidated on commit
+
+		Keyword Arguments:
+			commit {Boolean} -- Commit data to database (default: {True})
+		"""
+		BaseModel.save_all([self], commit=commit)
+
+	def invalidate_cache(self):
+		"""Remove cached copy of this record. Override in model which is cached
+		"""
+		pass
+
+	@staticmethod
+	def save_all(records, commit=True):
+		"""Save many records with single flush & commit
+
+		Arguments:
+			records {List} -- Records to be saved
+
+		Keyword Arguments:
+			commit {Boolean} -- Commit data to database, ignored inside `transaction()` scope (default: {True})
+		"""
+		session = db.session()
+		session.add_all(records)
+		session.info.setdefault('saved_records', []).extend(records)
+		if commit and not session.info.get('transaction_depth'):
+			session.commit()
+		else:
+			session.flush()
+
+	@staticmethod
+	@contextmanager
+	def transaction():
+		"""Transaction scope. Every `save()` inside the scope (including nested scope) is committed \
+once when outermost scope ends, or rolled back when exception raised
+
+		Yields:
+			Session -- Current session
+		"""
+		session = db.session()
+		depth = session.info.get('transaction_depth', 0)
+		session.info['transaction_depth'] = depth + 1
+		try:
+			yield session
+			if not depth:
+				session.commit()
+		except Exception:
+			if not depth:
+				session.rollback()
+			raise
+		finally:
+			session.info['transaction_depth'] = depth
+
+@db.event.listens_for(db.session, 'before_commit')
+def _before_commit(session):
+	"""Invalidate cache of saved records, flush first so generated values are available
+	"""
+	records = session.info.pop('saved_records', None)
+	if records:
+		session.flush()
+		for record in records:
+			record.invalidate_cache()
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+	session.info.pop('saved_records', None)
+
+class SlugCounter(db.Model):
+	"""Number of slugs which already allocated for every base slug of every table. Used by \
+`allocate_slugs()` so new slug is found by primary key lookup instead of scanning slugs
+	"""
+
+	__tablename__ = 'cj_base_slug_counter'
+
+	table_name = db.Column(db.String(64), primary_key=True)
+	slug = db.Column(db.String(128), primary_key=True)
+	count = db.Column(db.Integer, nullable=False, default=0)
+
+	def __repr__(self):
+		"""Representation name
 		"""
-		db.session.add(self)
-		db.session.commit()
+		return '<SlugCounter: {0}.{1}>'.format(self.table_name, self.slug)
+
+def _count_existing_slugs(connection, cls, slug):
+	"""Count slug which already used before counter exists, only run once for every base slug
+
+	Arguments:
+		connection {Connection} -- Database connection
+		cls {Class} -- Model class which has `slug` column
+		slug {String} -- Base slug
+
+	Returns:
+		Int -- Next slug index
+	"""
+	column = cls.__table__.c.slug
+	rows = connection.execute(db.select([column]).where(db.or_(
+		column == slug, column.startswith(slug + '-', autoescape=True))))
+	count = 0
+	for row in rows:
+		idx_slug = row[0][len(slug) + 1:]
+		if row[0] == slug:
+			count = max(count, 1)
+		elif idx_slug.isdigit():
+			count = max(count, int(idx_slug) + 1)
+	return count
+
+def _reserve_slugs(connection, cls, slug, amount):
+	"""Atomically reserve slug indexes from counter. Counter row is locked by UPDATE until \
+transaction ends, so concurrent signups never get the same index
+
+	Arguments:
+		connection {Connection} -- Database connection
+		cls {Class} -- Model class which has `slug` column
+		slug {String} -- Base slug
+		amount {Int} -- Number of indexes to be reserved
+
+	Returns:
+		Int -- First reserved index
+	"""
+	counter = SlugCounter.__table__
+	where = db.and_(counter.c.table_name == cls.__tablename__, counter.c.slug == slug)
+	while True:
+		result = connection.execute(counter.update().where(where).values(count=counter.c.count + amount))
+		if result.rowcount:
+			count = connection.execute(db.select([counter.c.count]).where(where)).scalar()
+			return count - amount
+
+		start = _count_existing_slugs(connection, cls, slug)
+		try:
+			with connection.begin_nested():
+				connection.execute(counter.insert().values(table_name=cls.__tablename__,
+					slug=slug, count=start + amount))
+			return start
+		except IntegrityError:
+			# other transaction created the counter first, reserve from it
+			continue
+
+def _claim_slugs(connection, cls, slugs):
+	"""Claim suffixed slugs, e.g. "name-1", which can also be base slug of other name. Counter \
+row of every slug is the claim, so two transactions (one from base "name", one from base \
+"name-1") never take the same slug: second insert of counter row waits for first transaction \
+then fails on primary key
+
+	Arguments:
+		connection {Connection} -- Database connection
+		cls {Class} -- Model class which has `slug` column
+		slugs {List} -- Candidate slugs
+
+	Returns:
+		Set -- Claimed slugs, other slugs are already used
+	"""
+	counter = SlugCounter.__table__
+	used = set(row[0] for row in connection.execute(db.select([counter.c.slug]).where(db.and_(
+		counter.c.table_name == cls.__tablename__, counter.c.slug.in_(slugs)))))
+	claimed = set()
+	for slug in slugs:
+		if slug in used:
+			continue
+		# slugs used before counter exists, counter is seeded with them for next allocation
+		start = _count_existing_slugs(connection, cls, slug)
+		try:
+			with connection.begin_nested():
+				connection.execute(counter.insert().values(table_name=cls.__tablename__,
+					slug=slug, count=max(start, 1)))
+		except IntegrityError:
+			continue
+		if start == 0:
+			claimed.add(slug)
+	return claimed
+
+def allocate_slugs(cls, raw_strings, connection=None):
+	"""Allocate unique slugs for many strings at once. Counter is updated once for every \
+base slug, so bulk import doesn't need one query per row
+
+	Arguments:
+		cls {Class} -- Model class which has `slug` column
+		raw_strings {List} -- Strings to get slug
+
+	Keyword Arguments:
+		connection {Connection} -- Database connection, default to current session connection (default: {None})
+
+	Returns:
+		List -- Slugs, same order with `raw_strings`
+	"""
+	if connection is None:
+		connection = db.session.connection()
+
+	groups = OrderedDict()
+	for idx, raw_string in enumerate(raw_strings):
+		groups.setdefault(slugify(raw_string), []).append(idx)
+
+	results = [None] * len(raw_strings)
+	for slug, indexes in groups.items():
+		pending = list(indexes)
+		while pending:
+			start = _reserve_slugs(connection, cls, slug, len(pending))
+			candidates = [slug if start + offset == 0 else '{0}-{1}'.format(slug, start + offset)
+				for offset in range(len(pending))]
+			# index 0 is protected by counter of this base slug, suffixed slug must be claimed
+			claimed = _claim_slugs(connection, cls, [candidate for candidate in candidates if candidate != slug])
+			for candidate in candidates:
+				if candidate == slug or candidate in claimed:
+					results[pending.pop(0)] = candidate
+	return results
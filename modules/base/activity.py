@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""Write-behind tracking of `User.last_request_at`. Latest request time of every user is kept \
+in memory, then written to database in one bulk UPDATE
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import atexit
+import os
+import threading
+import time
+import weakref
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+from app import db
+from helpers import get_extension_state
+from .models.user import User
+
+class _ActivityBuffer(object):
+	"""Pending request times of one app
+	"""
+
+	def __init__(self, app):
+		"""Instantiate class object
+
+		Arguments:
+			app {Flask} -- Flask app, pushed as app context when buffer is written
+		"""
+		self.app = app
+		self.flush_interval = app.config.get('USER_ACTIVITY_FLUSH_INTERVAL', 60)
+		self.max_pending = app.config.get('USER_ACTIVITY_MAX_PENDING', 1000)
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.thread = None
+		self.last_flush = time.time()
+
+	def after_fork(self):
+		"""Background thread is not copied to child process, it's started again on next request
+		"""
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def touch(self, user_id, request_at):
+		with self.lock:
+			self.pending[user_id] = request_at
+			if self.thread is None:
+				# started on first request, so it's never started before worker fork
+				self.thread = threading.Thread(target=self._run, daemon=True)
+				self.thread.start()
+			need_flush = len(self.pending) >= self.max_pending
+		if need_flush:
+			self.flush()
+
+	def _run(self):
+		"""Background loop which flush the buffer periodically
+		"""
+		while True:
+			time.sleep(max(1.0, self.last_flush + self.flush_interval - time.time()))
+			if time.time() - self.last_flush >= self.flush_interval:
+				self.flush()
+
+	def flush(self):
+		"""Write buffered request times in one bulk UPDATE. When writing fails, times are put back \
+to buffer to be written on next flush
+
+		Returns:
+			Int -- Number of updated users
+		"""
+		with self.lock:
+			pending, self.pending = self.pending, {}
+			self.last_flush = time.time()
+		if not pending:
+			return 0
+
+		table = User.__table__
+		# keep updated_at, activity is not a change of user data
+		statement = table.update().where(table.c.id == bindparam('user_id')).values(
+			last_request_at=bindparam('request_at'), updated_at=table.c.updated_at)
+		rows = [{'user_id': user_id, 'request_at': request_at} for user_id, request_at in pending.items()]
+		try:
+			with self.app.app_context():
+				with db.engine.begin() as connection:
+					connection.execute(statement, rows)
+		except Exception:
+			with self.lock:
+				for user_id, request_at in pending.items():
+					self.pending.setdefault(user_id, request_at)
+			self.app.logger.exception("Failed to write last_request_at of %d user(s)", len(rows))
+			return 0
+		return len(rows)
+
+class ActivityTracker(object):
+	"""Buffer of latest request time per user id. Buffer is flushed every `USER_ACTIVITY_FLUSH_INTERVAL` \
+seconds by background thread, when it has `USER_ACTIVITY_MAX_PENDING` users, and when process exits. \
+Every app has own buffer in `app.extensions`
+	"""
+
+	def __init__(self, app=None):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+		"""
+		self._buffers = weakref.WeakSet()
+		atexit.register(self._flush_all)
+		if hasattr(os, 'register_at_fork'):
+			os.register_at_fork(after_in_child=self._after_fork)
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		"""Create buffer of app from app config
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		previous = app.extensions.get('activity_tracker')
+		if previous is not None:
+			previous.flush()
+		buffer = _ActivityBuffer(app)
+		app.extensions['activity_tracker'] = buffer
+		self._buffers.add(buffer)
+
+	def touch(self, user_id, request_at=None):
+		"""Record request time of user in buffer of current app, only the latest time is kept
+
+		Arguments:
+			user_id {Int} -- User id
+
+		Keyword Arguments:
+			request_at {Datetime} -- Request time, default to now (default: {None})
+		"""
+		get_extension_state('activity_tracker').touch(user_id, request_at or datetime.now())
+
+	def flush(self, app=None):
+		"""Write buffered request times of app in one bulk UPDATE
+
+		Keyword Arguments:
+			app {Flask} -- Flask app, default to current app (default: {None})
+
+		Returns:
+			Int -- Number of updated users
+		"""
+		return get_extension_state('activity_tracker', app).flush()
+
+	def _flush_all(self):
+		for buffer in list(self._buffers):
+			buffer.flush()
+
+	def _after_fork(self):
+		for buffer in list(self._buffers):
+			buffer.after_fork()
+
+# bound to app when base blueprint registered
+activity_tracker = ActivityTracker()
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of auth flows in base modules. Requests are sent through WSGI app (test client) by \
+concurrent threads, against local database & stand-in SMTP server. Run with \
+`python manage.py base benchmark`
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import logging
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import g
+
+from app import create_app, db, hasher
+from dummy_smtp import DummySMTPServer
+from helpers import normalize_email
+from .activity import activity_tracker
+from .models.user import User, admin_registry
+from .models.mail import MailOutgoing
+from .models.token import VerifyToken
+
+PASSWORD = 'benchmark'
+
+class Scenario(object):
+	"""One benchmarked flow. `prepare()` makes data of every request before timing starts, \
+`setup()` runs untimed right before each request, `run()` sends the timed request
+	"""
+
+	def __init__(self, name, run, expected_status=302, prepare=None, setup=None):
+		"""Instantiate class object
+
+		Arguments:
+			name {String} -- Scenario name
+			run {Function} -- Send timed request, called with (client, state)
+
+		Keyword Arguments:
+			expected_status {Int} -- Status code of successful request (default: {302})
+			prepare {Function} -- Make state of every request, called with (count) (default: {None})
+			setup {Function} -- Untimed step before request, called with (client, state) (default: {None})
+		"""
+		self.name = name
+		self.run = run
+		self.expected_status = expected_status
+		self.prepare = prepare or (lambda count: [None] * count)
+		self.setup = setup
+
+def _insert_users(prefix, count, status, password_hash):
+	"""Insert users directly, so preparing data doesn't hash password for every user
+
+	Arguments:
+		prefix {String} -- Prefix of email & slug
+		count {Int} -- Number of users
+		status {Int} -- User status
+		password_hash {String} -- Password hash of all users
+
+	Returns:
+		List -- (id, email) of inserted users
+	"""
+	now = datetime.now()
+	emails = ['{}-{}@example.com'.format(prefix, idx) for idx in range(count)]
+	db.session.bulk_insert_mappings(User, [{
+		'email': email,
+		'email_normalized': normalize_email(email),
+		'name': 'Benchmark {}'.format(idx),
+		'password_hash': password_hash,
+		'slug': '{}-{}'.format(prefix, idx),
+		'is_admin': False,
+		'status': status,
+		'created_at': now,
+		'updated_at': now,
+	} for idx, email in enumerate(emails)])
+	db.session.commit()
+	ids = dict(db.session.query(User.email, User.id).filter(User.email.in_(emails)))
+	return [(ids[email], email) for email in emails]
+
+def make_scenarios(password_hash):
+	"""Scenarios of base blueprint routes
+
+	Arguments:
+		password_hash {String} -- Hash of `PASSWORD`, shared by prepared users
+
+	Returns:
+		List -- Scenarios in run order
+	"""
+	def prepare_signup(count):
+		return ['signup-{}-{}@example.com'.format(int(time.time()), idx) for idx in range(count)]
+
+	def run_signup(client, email):
+		return client.post('/signup/', data={'email': email, 'name': 'Benchmark',
+			'password': PASSWORD, 'password_confirm': PASSWORD})
+
+	def prepare_verify(count):
+		users = _insert_users('verify-{}'.format(int(time.time())), count, User.STATUS_NOT_ACTIVE,
+			password_hash)
+		expires_at = VerifyToken.get_expires_at()
+		tokens, rows = [], []
+		for user_id, _ in users:
+			token, token_hash = VerifyToken.generate_token()
+			tokens.append(token)
+			rows.append({'user_id': user_id, 'token_hash': token_hash, 'expires_at': expires_at,
+				'created_at': datetime.now()})
+		db.session.bulk_insert_mappings(VerifyToken, rows)
+		db.session.commit()
+		return tokens
+
+	def prepare_active(count):
+		return [email for _, email in _insert_users('active-{}'.format(int(time.time())), count,
+			User.STATUS_ACTIVE, password_hash)]
+
+	def prepare_not_active(count):
+		return [email for _, email in _insert_users('resend-{}'.format(int(time.time())), count,
+			User.STATUS_NOT_ACTIVE, password_hash)]
+
+	def run_login(client, email):
+		return client.post('/login/', data={'email': email, 'password': PASSWORD})
+
+	def setup_login(client, email):
+		client.cookie_jar.clear()
+
+	return [
+		Scenario('homepage', lambda client, state: client.get('/'), expected_status=200),
+		Scenario('signup', run_signup, prepare=prepare_signup),
+		Scenario('verify', lambda client, token: client.get('/verify/{}/'.format(token)),
+			prepare=prepare_verify),
+		Scenario('login', run_login, prepare=prepare_active, setup=setup_login),
+		Scenario('logout', lambda client, state: client.get('/logout/'), prepare=prepare_active,
+			setup=lambda client, email: run_login(client, email)),
+		Scenario('resend_verify', lambda client, email: client.post('/resend-verify/', data={'email': email}),
+			prepare=prepare_not_active),
+	]
+
+def percentile(values, percent):
+	"""Nearest-rank percentile
+
+	Arguments:
+		values {List} -- Sorted values
+		percent {Float} -- Percentile, 0 - 100
+
+	Returns:
+		Float -- Percentile value, 0 when there is no value
+	"""
+	if not values:
+		return 0.0
+	index = max(0, min(len(values) - 1, int(math.ceil(percent / 100.0 * len(values))) - 1))
+	return values[index]
+
+def _run_chunk(app, scenario, states):
+	"""Send requests of one thread with its own test client
+
+	Arguments:
+		app {Flask} -- Benchmarked app
+		scenario {Scenario} -- Benchmarked scenario
+		states {List} -- State of every request
+
+	Returns:
+		Tuple -- Latencies (seconds), query counts & number of failed requests
+	"""
+	client = app.test_client()
+	latencies, queries, errors = [], [], 0
+	for state in states:
+		if scenario.setup is not None:
+			scenario.setup(client, state)
+		with client:
+			started = time.perf_counter()
+			response = scenario.run(client, state)
+			latencies.append(time.perf_counter() - started)
+			queries.append(g.get('query_count', 0))
+		if response.status_code != scenario.expected_status:
+			errors += 1
+	return latencies, queries, errors
+
+def _measure_allocations(app, scenario, states):
+	"""Measure peak of memory allocated while handling request, one request at a time
+
+	Arguments:
+		app {Flask} -- Benchmarked app
+		scenario {Scenario} -- Benchmarked scenario
+		states {List} -- State of every request
+
+	Returns:
+		Float -- Mean allocation peak per request in KiB
+	"""
+	if not states:
+		return 0.0
+	client = app.test_client()
+	peaks = []
+	tracemalloc.start()
+	try:
+		for state in states:
+			if scenario.setup is not None:
+				scenario.setup(client, state)
+			tracemalloc.reset_peak()
+			before = tracemalloc.get_traced_memory()[0]
+			scenario.run(client, state)
+			peaks.append(tracemalloc.get_traced_memory()[1] - before)
+	finally:
+		tracemalloc.stop()
+	return sum(peaks) / len(peaks) / 1024.0
+
+def run_scenario(app, scenario, requests, concurrency, alloc_requests):
+	"""Run one scenario
+
+	Arguments:
+		app {Flask} -- Benchmarked app
+		scenario {Scenario} -- Benchmarked scenario
+		requests {Int} -- Number of timed requests
+		concurrency {Int} -- Number of threads
+		alloc_requests {Int} -- Number of extra requests measured for allocations
+
+	Returns:
+		Dict -- Throughput, latency percentiles (ms), queries & allocations per request
+	"""
+	states = scenario.prepare(requests + alloc_requests)
+	chunks = [states[idx:requests:concurrency] for idx in range(concurrency)]
+	started = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		results = list(executor.map(lambda chunk: _run_chunk(app, scenario, chunk), chunks))
+	elapsed = time.perf_counter() - started
+
+	latencies = sorted(latency * 1000 for result in results for latency in result[0])
+	queries = [count for result in results for count in result[1]]
+	return {
+		'requests': len(latencies),
+		'errors': sum(result[2] for result in results),
+		'seconds': elapsed,
+		'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+		'latency_ms': {
+			'p50': percentile(latencies, 50),
+			'p95': percentile(latencies, 95),
+			'p99': percentile(latencies, 99),
+			'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+			'max': latencies[-1] if latencies else 0.0,
+		},
+		'queries_per_request': sum(queries) / len(queries) if queries else 0.0,
+		'alloc_kb_per_request': _measure_allocations(app, scenario, states[requests:]),
+	}
+
+def _deliver_outbox(app):
+	"""Deliver mails queued by scenarios to stand-in SMTP server
+
+	Arguments:
+		app {Flask} -- Benchmarked app
+
+	Returns:
+		Dict -- Number of delivered mails & delivery rate
+	"""
+	with DummySMTPServer() as server:
+		state = app.extensions['mail']
+		state.server, state.port = server.server_address
+		state.use_ssl = state.use_tls = state.suppress = False
+		state.username = None
+		started = time.perf_counter()
+		while MailOutgoing.deliver_outgoing(batch_size=100, max_workers=4)[0]:
+			pass
+		elapsed = time.perf_counter() - started
+	return {
+		'mails': len(server.messages),
+		'throughput': len(server.messages) / elapsed if elapsed > 0 else 0.0,
+	}
+
+def run_benchmark(requests=200, concurrency=4, scenario_names=None, database_uri=None, alloc_requests=20):
+	"""Build benchmark app then run scenarios. Rate limit is disabled, so every request reaches \
+the view. Without `database_uri`, temporary SQLite database is used and removed afterwards
+
+	Keyword Arguments:
+		requests {Int} -- Number of timed requests per scenario (default: {200})
+		concurrency {Int} -- Number of threads (default: {4})
+		scenario_names {List} -- Scenarios to run, None = all (default: {None})
+		database_uri {String} -- Empty database, tables are created & data is left (default: {None})
+		alloc_requests {Int} -- Number of extra requests measured for allocations (default: {20})
+
+	Returns:
+		Dict -- Benchmark meta data & result of every scenario
+	"""
+	directory = None
+	if database_uri is None:
+		directory = tempfile.mkdtemp(prefix='benchmark-')
+		database_uri = 'sqlite:///{}'.format(os.path.join(directory, 'benchmark.db'))
+
+	app = create_app({
+		'SQLALCHEMY_DATABASE_URI': database_uri,
+		'SQLALCHEMY_REPLICA_URIS': [],
+		'WTF_CSRF_ENABLED': False,
+		'RATELIMIT_ENABLED': False,
+		'METRICS_DIR': None,
+		'MAIL_PASSWORD': None,
+		'MAIL_DEBUG': False,
+		'DEBUG': False,
+	})
+	# per request logs would be measured too
+	app.logger.setLevel(logging.WARNING)
+	try:
+		with app.app_context():
+			db.create_all()
+			admin_registry.invalidate()
+			password_hash = hasher.generate_password_hash(PASSWORD)
+			admin = User(email='admin@example.com', name='Admin', password_hash=password_hash)
+			admin.save()
+
+			scenarios = [scenario for scenario in make_scenarios(password_hash)
+				if not scenario_names or scenario.name in scenario_names]
+			results = {}
+			for scenario in scenarios:
+				results[scenario.name] = run_scenario(app, scenario, requests, concurrency, alloc_requests)
+			outbox = _deliver_outbox(app)
+			time_cost, memory_cost, parallelism = hasher.params[:3]
+	finally:
+		activity_tracker.flush(app)
+		hasher.shutdown(app)
+		if directory is not None:
+			with app.app_context():
+				db.get_engine(app).dispose()
+			shutil.rmtree(directory, ignore_errors=True)
+
+	return {
+		'meta': {
+			'created_at': datetime.now().isoformat(),
+			'python': platform.python_version(),
+			'machine': platform.machine(),
+			'cpu_count': os.cpu_count(),
+			'database': database_uri.split(':', 1)[0],
+			'requests': requests,
+			'concurrency': concurrency,
+			'argon2': {'time_cost': time_cost, 'memory_cost': memory_cost, 'parallelism': parallelism},
+		},
+		'scenarios': results,
+		'outbox': outbox,
+	}
+
+def compare(result, baseline, tolerance=0.2):
+	"""Compare result with saved baseline. Latency & throughput may differ by `tolerance`, \
+queries per request may not grow
+
+	Arguments:
+		result {Dict} -- Benchmark result
+		baseline {Dict} -- Saved benchmark result
+
+	Keyword Arguments:
+		tolerance {Float} -- Allowed relative difference (default: {0.2})
+
+	Returns:
+		List -- Description of every regression
+	"""
+	regressions = []
+	for name, current in result['scenarios'].items():
+		base = baseline.get('scenarios', {}).get(name)
+		if base is None:
+			continue
+		if current['latency_ms']['p95'] > base['latency_ms']['p95'] * (1 + tolerance):
+			regressions.append("{0}: p95 {1:.1f} ms, baseline {2:.1f} ms".format(name,
+				current['latency_ms']['p95'], base['latency_ms']['p95']))
+		if current['throughput'] < base['throughput'] * (1 - tolerance):
+			regressions.append("{0}: {1:.1f} req/s, baseline {2:.1f} req/s".format(name,
+				current['throughput'], base['throughput']))
+		if current['queries_per_request'] > base['queries_per_request'] + 0.5:
+			regressions.append("{0}: {1:.1f} queries/request, baseline {2:.1f}".format(name,
+				current['queries_per_request'], base['queries_per_request']))
+	return regressions
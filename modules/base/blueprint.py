@@ -8,17 +8,36 @@ Author:
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash, g
 from flask_login import login_user, logout_user
+from sqlalchemy.exc import IntegrityError
 
+from app import limiter, page_cache
+
+from .activity import activity_tracker
 from .forms import SignupForm, LoginForm, ResendVerifyForm
 from .models.user import User
+from .models.token import VerifyToken
 
 base_app = Blueprint('base', __name__, template_folder='templates')
+base_app.record(lambda state: activity_tracker.init_app(state.app))
+
+@base_app.before_app_request
+def _track_activity():
+	"""Record request time of logged in user, written to `last_request_at` by `activity_tracker`
+
+	Decorators:
+		base_app.before_app_request
+	"""
+	if g.user.is_authenticated:
+		activity_tracker.touch(g.user.id)
 
 @base_app.route('/')
+@page_cache.cached
 def homepage():
 	return render_template('base/homepage.html')
 
 @base_app.route('/signup/', methods=['GET', 'POST'])
+@limiter.limit('signup', per_ip=(10, 3600), per_email=(3, 3600))
+@page_cache.cached
 def signup():
 	"""Handle route user signup
 
@@ -32,11 +51,18 @@ will redirect to 'base.homepage'
 	if request.method == 'POST':
 		form = SignupForm(request.form)
 		if form.validate():
-			user = form.save_user()
-			if not user.is_admin:
-				user.send_verification_mail()
-			flash("Signup success. Please check your email to verify your account.", 'success')
-			return redirect(url_for('base.homepage'))
+			try:
+				with User.transaction():
+					user = form.save_user()
+					if not user.is_admin:
+						user.send_verification_mail()
+			except IntegrityError:
+				# email inserted by other request after validation, or not known yet by bloom filter
+				form.email.errors.append("Data email sudah ada!")
+				flash("Terjadi kesalahan!", 'danger')
+			else:
+				flash("Signup success. Please check your email to verify your account.", 'success')
+				return redirect(url_for('base.homepage'))
 		else:
 			flash("Terjadi kesalahan!", 'danger')
 	else:
@@ -57,16 +83,19 @@ def verify(verify_code):
 		Redirect -- Redirecting user after verify. If valid, user redirect to 'base.login'. \
 If not valid, user redirect to 'base.homepage' and get error message.
 	"""
-	user = User.query.filter_by(verify_code=verify_code, status=User.STATUS_NOT_ACTIVE).first()
-	if user is None:
-		flash("Anda tidak diperkenankan melakukan ini!", 'danger')
-		return redirect(url_for('base.homepage'))
+	with User.transaction():
+		user = VerifyToken.consume(verify_code)
+		if user is None or user.status != User.STATUS_NOT_ACTIVE:
+			flash("Anda tidak diperkenankan melakukan ini!", 'danger')
+			return redirect(url_for('base.homepage'))
 
-	user.set_verified()
+		user.set_verified()
 	flash("Status anda telah diverifikasi!", 'success')
 	return redirect(url_for('base.login'))
 
 @base_app.route('/resend-verify/', methods=['GET', 'POST'])
+@limiter.limit('resend_verify', per_ip=(10, 3600), per_email=(3, 3600))
+@page_cache.cached
 def resend_verify():
 	"""Handle route user resend verification account
 
@@ -90,6 +119,8 @@ will redirect to 'base.homepage'
 	return render_template('base/resend_verify.html', form=form)
 
 @base_app.route('/login/', methods=['GET', 'POST'])
+@limiter.limit('login', per_ip=(20, 60), per_email=(5, 60))
+@page_cache.cached
 def login():
 	"""Handle route user login
 
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+"""Manage commands in base modules. Registered to app.manager as `base`
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import csv
+import json
+import os
+import re
+import time
+
+import argon2
+from flask import current_app
+from flask_script import Manager
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import MultiDict
+
+from app import db
+from helpers import normalize_email
+from .forms import ImportUserForm
+from .models.user import User
+from .models.mail import MailOutgoing
+
+manager = Manager(usage="Commands of base modules")
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=50,
+	help="Max number of mails claimed in one batch")
+@manager.option('-w', '--workers', dest='workers', type=int, default=4,
+	help="Number of threads which sending mail")
+@manager.option('-i', '--interval', dest='interval', type=float, default=5.0,
+	help="Seconds to wait when outbox is empty")
+@manager.option('--once', dest='once', action='store_true', default=False,
+	help="Process one batch then exit")
+def outbox(batch_size, workers, interval, once):
+	"""Deliver pending outgoing mails from `cj_base_mail_outgoing`
+
+	Arguments:
+		batch_size {Int} -- Max number of mails claimed in one batch
+		workers {Int} -- Number of threads which sending mail
+		interval {Float} -- Seconds to wait when outbox is empty
+		once {Boolean} -- Process one batch then exit
+	"""
+	while True:
+		count, rate = MailOutgoing.deliver_outgoing(batch_size=batch_size, max_workers=workers)
+		if count:
+			print("[OUTBOX] {0} mail(s) processed, {1:.1f} msg/s".format(count, rate))
+		if once:
+			break
+		if count < batch_size:
+			time.sleep(interval)
+
+def _measure_argon2(time_cost, memory_cost, parallelism, rounds):
+	"""Measure median time of hashing with given argon2 parameters
+
+	Arguments:
+		time_cost {Int} -- Argon2 time cost
+		memory_cost {Int} -- Argon2 memory cost, in KiB
+		parallelism {Int} -- Argon2 parallelism
+		rounds {Int} -- Number of measurement
+
+	Returns:
+		Float -- Median hashing time in milliseconds
+	"""
+	password_hasher = argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost,
+		parallelism=parallelism)
+	timings = []
+	for _ in range(rounds):
+		started = time.time()
+		password_hasher.hash('calibration')
+		timings.append((time.time() - started) * 1000)
+	return sorted(timings)[len(timings) // 2]
+
+def write_local_settings(values):
+	"""Write setting variables to local_settings.py, replace variable which already exists
+
+	Arguments:
+		values {Dict} -- Variable name and value to be written
+	"""
+	path = os.path.join(current_app.config['APPLICATION_DIR'], 'local_settings.py')
+	content = ''
+	if os.path.exists(path):
+		with open(path) as settings_file:
+			content = settings_file.read()
+
+	for name, value in sorted(values.items()):
+		line = '{0} = {1!r}'.format(name, value)
+		pattern = re.compile(r'^{}\s*=.*$'.format(name), re.MULTILINE)
+		if pattern.search(content):
+			content = pattern.sub(line, content)
+		else:
+			if content and not content.endswith('\n'):
+				content += '\n'
+			content += line + '\n'
+
+	with open(path, 'w') as settings_file:
+		settings_file.write(content)
+
+@manager.option('-t', '--target-ms', dest='target_ms', type=float, default=250.0,
+	help="Target latency of one hash, in milliseconds")
+@manager.option('-m', '--max-memory', dest='max_memory', type=int, default=262144,
+	help="Max argon2 memory cost, in KiB")
+@manager.option('-p', '--parallelism', dest='parallelism', type=int, default=None,
+	help="Argon2 parallelism (default: number of CPU)")
+@manager.option('-r', '--rounds', dest='rounds', type=int, default=3,
+	help="Number of measurement for every parameter set")
+@manager.option('--dry-run', dest='dry_run', action='store_true', default=False,
+	help="Only print the chosen parameters")
+def calibrate_argon2(target_ms, max_memory, parallelism, rounds, dry_run):
+	"""Benchmark argon2 on current machine, then choose strongest parameters which still \
+under target latency. Result is written to local_settings.py so it's loaded by Configuration. \
+Existing hashes are upgraded when user logs in.
+
+	Arguments:
+		target_ms {Float} -- Target latency of one hash, in milliseconds
+		max_memory {Int} -- Max argon2 memory cost, in KiB
+		parallelism {Int|None} -- Argon2 parallelism
+		rounds {Int} -- Number of measurement for every parameter set
+		dry_run {Boolean} -- Only print the chosen parameters
+	"""
+	parallelism = parallelism or os.cpu_count() or 1
+	# argon2 requires memory cost of at least 8 KiB per lane
+	min_memory = 8 * parallelism
+	memory_cost = max(min_memory, max_memory)
+	elapsed = _measure_argon2(1, memory_cost, parallelism, rounds)
+	while elapsed > target_ms and memory_cost > min_memory:
+		memory_cost = max(min_memory, memory_cost // 2)
+		elapsed = _measure_argon2(1, memory_cost, parallelism, rounds)
+	print("[ARGON2] t=1 m={0} p={1}: {2:.1f} ms".format(memory_cost, parallelism, elapsed))
+
+	time_cost = 1
+	while True:
+		next_elapsed = _measure_argon2(time_cost + 1, memory_cost, parallelism, rounds)
+		print("[ARGON2] t={0} m={1} p={2}: {3:.1f} ms".format(time_cost + 1, memory_cost,
+			parallelism, next_elapsed))
+		if next_elapsed > target_ms:
+			break
+		time_cost += 1
+		elapsed = next_elapsed
+
+	values = {
+		'ARGON2_TIME_COST': time_cost,
+		'ARGON2_MEMORY_COST': memory_cost,
+		'ARGON2_PARALLELISM': parallelism,
+	}
+	print("[ARGON2] Chosen {0} ({1:.1f} ms)".format(values, elapsed))
+	if not dry_run:
+		write_local_settings(values)
+		print("[ARGON2] Written to local_settings.py, restart app to apply")
+
+def _read_rows(path, file_format):
+	"""Stream rows from CSV (with header) or JSONL file
+
+	Arguments:
+		path {String} -- File path
+		file_format {String} -- 'csv' or 'jsonl'
+
+	Yields:
+		Tuple -- Line number and row dict
+	"""
+	with open(path, newline='') as import_file:
+		if file_format == 'csv':
+			reader = csv.DictReader(import_file)
+			for row in reader:
+				yield reader.line_num, row
+		else:
+			for line_no, line in enumerate(import_file, 1):
+				if line.strip():
+					yield line_no, json.loads(line)
+
+def _import_batch(batch, seen_emails, send_verify):
+	"""Skip emails already used then create users of one batch
+
+	Arguments:
+		batch {List} -- Valid rows of one batch
+		seen_emails {Set} -- Emails already imported from this file
+		send_verify {Boolean} -- Queue verification mail
+
+	Returns:
+		Int -- Number of created users
+	"""
+	emails = [normalize_email(values['email']) for values in batch]
+	existing = set(row[0] for row in User.query.with_entities(User.email_normalized).filter(
+		User.email_normalized.in_(emails)))
+	values_list = []
+	for values, email in zip(batch, emails):
+		if email in existing or email in seen_emails:
+			print("[IMPORT] Skip {}: email already used".format(values['email']))
+			continue
+		seen_emails.add(email)
+		values_list.append(values)
+	return User.bulk_create(values_list, send_verification=send_verify)
+
+@manager.option('path', help="CSV (with email,name,password header) or JSONL file")
+@manager.option('-f', '--format', dest='file_format', choices=['csv', 'jsonl'], default=None,
+	help="File format, default from file extension")
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500,
+	help="Number of users inserted in one batch")
+@manager.option('--send-verify', dest='send_verify', action='store_true', default=False,
+	help="Queue verification mail for imported users")
+@manager.option('--base-url', dest='base_url', default='http://localhost/',
+	help="Base url of verification link")
+def import_users(path, file_format, batch_size, send_verify, base_url):
+	"""Bulk import users from file. Rows are validated with the same rules as signup form, \
+invalid rows are skipped
+
+	Arguments:
+		path {String} -- CSV or JSONL file path
+		file_format {String|None} -- 'csv' or 'jsonl'
+		batch_size {Int} -- Number of users inserted in one batch
+		send_verify {Boolean} -- Queue verification mail for imported users
+		base_url {String} -- Base url of verification link
+	"""
+	file_format = file_format or ('csv' if path.endswith('.csv') else 'jsonl')
+	started = time.time()
+	created = skipped = 0
+	seen_emails = set()
+	batch = []
+	with current_app.test_request_context(base_url=base_url):
+		for line_no, row in _read_rows(path, file_format):
+			row.setdefault('password_confirm', row.get('password'))
+			form = ImportUserForm(formdata=MultiDict(row), meta={'csrf': False})
+			if not form.validate():
+				print("[IMPORT] Skip row {0}: {1}".format(line_no, form.errors))
+				skipped += 1
+				continue
+
+			batch.append({'email': form.email.data, 'name': form.name.data, 'password': form.password.data})
+			if len(batch) >= batch_size:
+				count = _import_batch(batch, seen_emails, send_verify)
+				created += count
+				skipped += len(batch) - count
+				batch = []
+
+		if batch:
+			count = _import_batch(batch, seen_emails, send_verify)
+			created += count
+			skipped += len(batch) - count
+
+	elapsed = time.time() - started
+	print("[IMPORT] {0} user(s) created, {1} skipped, {2:.1f} rows/s".format(created, skipped,
+		(created + skipped) / elapsed if elapsed > 0 else 0))
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+	help="Number of users updated in one transaction")
+def backfill_email_normalized(batch_size):
+	"""Fill `email_normalized` of existing users. Rows are updated by primary key in small \
+transactions, so table is never locked for long. Users whose normalized email is already used \
+(same email with different case) are reported and left empty
+
+	Arguments:
+		batch_size {Int} -- Number of users updated in one transaction
+	"""
+	table = User.__table__
+	statement = table.update().where(table.c.id == bindparam('user_id')).values(
+		email_normalized=bindparam('email_normalized'), updated_at=table.c.updated_at)
+	last_id = 0
+	updated = 0
+	while True:
+		rows = db.session.execute(db.select([table.c.id, table.c.email]).where(db.and_(
+			table.c.id > last_id, table.c.email_normalized == None
+		)).order_by(table.c.id).limit(batch_size)).fetchall()
+		db.session.commit()
+		if not rows:
+			break
+		last_id = rows[-1][0]
+
+		values = [{'user_id': row[0], 'email_normalized': normalize_email(row[1])} for row in rows]
+		try:
+			with db.engine.begin() as connection:
+				connection.execute(statement, values)
+			updated += len(values)
+		except IntegrityError:
+			for value in values:
+				try:
+					with db.engine.begin() as connection:
+						connection.execute(statement, value)
+					updated += 1
+				except IntegrityError:
+					print("[BACKFILL] Skip user {0}: {1} already used".format(value['user_id'],
+						value['email_normalized']))
+		print("[BACKFILL] {0} user(s) updated, last id {1}".format(updated, last_id))
+
+@manager.option('-n', '--requests', dest='requests', type=int, default=200,
+	help="Number of timed requests per scenario")
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=4,
+	help="Number of threads which sending requests")
+@manager.option('-s', '--scenarios', dest='scenarios', default=None,
+	help="Comma separated scenarios (homepage,signup,verify,login,logout,resend_verify)")
+@manager.option('-d', '--database-uri', dest='database_uri', default=None,
+	help="Empty database to use, default temporary SQLite database")
+@manager.option('-o', '--output', dest='output', default=None,
+	help="Save result as JSON baseline")
+@manager.option('--baseline', dest='baseline', default=None,
+	help="Compare result with saved JSON baseline, exit with error on regression")
+@manager.option('--tolerance', dest='tolerance', type=float, default=0.2,
+	help="Allowed relative difference of latency & throughput from baseline")
+def benchmark(requests, concurrency, scenarios, database_uri, output, baseline, tolerance):
+	"""Benchmark auth flows of base modules, report throughput, latency percentiles, queries \
+and allocations per request
+
+	Arguments:
+		requests {Int} -- Number of timed requests per scenario
+		concurrency {Int} -- Number of threads which sending requests
+		scenarios {String|None} -- Comma separated scenarios, None = all
+		database_uri {String|None} -- Empty database to use
+		output {String|None} -- Save result as JSON baseline
+		baseline {String|None} -- Compare result with saved JSON baseline
+		tolerance {Float} -- Allowed relative difference of latency & throughput from baseline
+
+	Returns:
+		Int -- Exit code, 1 when regression found
+	"""
+	from .benchmarks import run_benchmark, compare
+
+	result = run_benchmark(requests=requests, concurrency=concurrency,
+		scenario_names=scenarios.split(',') if scenarios else None, database_uri=database_uri)
+	print("[BENCHMARK] {0} requests per scenario, concurrency {1}".format(requests, concurrency))
+	print("{0:<14}{1:>10}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}{7:>8}".format('scenario', 'req/s',
+		'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'alloc KB', 'errors'))
+	for name, stats in result['scenarios'].items():
+		latency = stats['latency_ms']
+		print("{0:<14}{1:>10.1f}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>10.1f}{7:>8}".format(name,
+			stats['throughput'], latency['p50'], latency['p95'], latency['p99'],
+			stats['queries_per_request'], stats['alloc_kb_per_request'], stats['errors']))
+	print("[BENCHMARK] outbox: {0} mail(s), {1:.1f} msg/s".format(result['outbox']['mails'],
+		result['outbox']['throughput']))
+
+	if output:
+		with open(output, 'w') as output_file:
+			json.dump(result, output_file, indent=2, sort_keys=True)
+		print("[BENCHMARK] Saved to {}".format(output))
+
+	if baseline:
+		with open(baseline) as baseline_file:
+			regressions = compare(result, json.load(baseline_file), tolerance=tolerance)
+		for regression in regressions:
+			print("[BENCHMARK] Regression {}".format(regression))
+		if regressions:
+			return 1
+		print("[BENCHMARK] No regression against {}".format(baseline))
+
+@manager.option('-o', '--output', dest='output', default=None,
+	help="Output directory, default ASSETS_DIR")
+def build_assets(output):
+	"""Build fingerprinted, gzip & brotli compressed copy of static files, restart app to load \
+new manifest
+
+	Arguments:
+		output {String|None} -- Output directory, None = `ASSETS_DIR`
+	"""
+	from assets import build_assets as build, brotli
+
+	output = output or current_app.config['ASSETS_DIR']
+	manifest = build(current_app.static_folder, output)
+	print("[ASSETS] {0} file(s) built to {1}{2}".format(len(manifest), output,
+		'' if brotli is not None else " (brotli not installed, gzip only)"))
+
+@manager.option('--measure', dest='measure', action='store_true', default=False,
+	help="Also compare cold load of all templates from source & from bytecode cache")
+def warm_templates(measure):
+	"""Compile every template to bytecode cache, so new workers load compiled templates from disk
+
+	Arguments:
+		measure {Boolean} -- Compare cold load from source & from bytecode cache
+	"""
+	from templating import warm_templates as warm, measure_template_load
+
+	bytecode_cache = current_app.jinja_env.bytecode_cache
+	if bytecode_cache is None:
+		print("[TEMPLATES] JINJA_BYTECODE_CACHE_DIR not set or not writable, nothing to warm")
+		return 1
+
+	names, elapsed = warm(current_app)
+	print("[TEMPLATES] {0} template(s) compiled to {1} in {2:.1f} ms".format(len(names),
+		current_app.config['JINJA_BYTECODE_CACHE_DIR'], elapsed * 1000))
+	if measure:
+		print("[TEMPLATES] Cold load of all templates: {0:.1f} ms from source, {1:.1f} ms from bytecode cache".format(
+			measure_template_load(current_app) * 1000, measure_template_load(current_app, bytecode_cache) * 1000))
@@ -9,6 +9,7 @@ Author:
 import wtforms
 from flask_wtf import FlaskForm
 
+from helpers import normalize_email
 from validators import SameValue, UniqueValue
 from .models.user import User
 
@@ -22,7 +23,8 @@ class SignupForm(FlaskForm):
 		validators.Email(),
 		validators.DataRequired(),
 		validators.Length(max=128),
-		UniqueValue(User, 'email')
+		UniqueValue(User, 'email_normalized', message="Data email sudah ada!", normalizer=normalize_email,
+			fallback=User.not_backfilled_email)
 	])
 	name = wtforms.StringField("Name", validators=[
 		validators.DataRequired(),
@@ -50,6 +52,14 @@ class SignupForm(FlaskForm):
 		user.save()
 		return user
 
+class ImportUserForm(SignupForm):
+	"""To validate imported user with the same rules as SignupForm. Email uniqueness is checked \
+for whole batch by import command, instead of one query per row
+	"""
+
+	email = wtforms.StringField("Email", validators=[validator for validator in \
+		SignupForm.email.kwargs['validators'] if not isinstance(validator, UniqueValue)])
+
 class LoginForm(FlaskForm):
 	"""To handle Signup user form
 	"""
@@ -125,7 +135,7 @@ class ResendVerifyForm(FlaskForm):
 			return False
 
 		has_error = False
-		self.user = User.query.filter_by(email=self.email.data).first()
+		self.user = User.get_by_email(self.email.data)
 		if self.user is None:
 			self.email.errors.append("Email not found!")
 			has_error = True
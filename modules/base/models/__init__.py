@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+"""Models in base modules. Every model module is imported with this package, so all tables \
+and model metrics (SMTP send time, outbox depth) are registered when app is created
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+from . import user, token, mail
@@ -6,26 +6,40 @@ Author:
 	@CakJuice <hd.brandoz@gmail.com>
 """
 
-from datetime import datetime
-from smtplib import SMTPException
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from smtplib import SMTPException, SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError
 
-from flask import g
+from flask import g, current_app
 from flask_mail import Message
-from app import app, db, mail
+from app import db, mail, metrics
+from metrics import GAUGE, HISTOGRAM
 from models import BaseModel
-from .user import User
+from helpers import exponential_backoff
+from .user import User, admin_registry
+
+metrics.define('smtp_send_seconds', HISTOGRAM, "Time to send one mail to SMTP server")
+metrics.define('outbox_depth', GAUGE, "Number of mails in cj_base_mail_outgoing by status", ('status',))
 
 class MailOutgoing(db.Model, BaseModel):
     """MailOutgoing model, mixin inherit `db.Model` from `flask_sqlalchemy` & `BaseModel` from models.py
     """
 
     __tablename__ = 'cj_base_mail_outgoing'
+    __table_args__ = (
+        db.Index('ix_cj_base_mail_outgoing_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
 
     STATUS_CANCELED = -1
     STATUS_OUTGOING = 0
     STATUS_SEND = 1
     STATUS_RECEIVED = 2
     STATUS_FAILED = 3
+    STATUS_PROCESSING = 4
+
+    CLAIM_TIMEOUT = timedelta(minutes=10)
 
     def generate_user_id(self):
         """Generate user id. If mail created manually, user id generated from session.
@@ -36,19 +50,21 @@ class MailOutgoing(db.Model, BaseModel):
         """
         if hasattr(g, 'user') and hasattr(g.user, 'id') and g.user.id:
             return g.user.id
-        user = User.query.filter_by(is_admin=True).first()
-        return user.id
+        return admin_registry.get_id(self.connection)
 
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(255), nullable=False)
-    email_from = db.Column(db.String(255), nullable=False, default=app.config['MAIL_USERNAME'])
+    email_from = db.Column(db.String(255), nullable=False, default=lambda: current_app.config['MAIL_USERNAME'])
     email_to = db.Column(db.Text, nullable=False)
     email_cc = db.Column(db.Text)
     body = db.Column(db.Text, nullable=False)
     body_html = db.Column(db.Text)
     status = db.Column(db.SmallInteger, default=STATUS_OUTGOING,
-        doc="-1 = canceled, 0 = outgoing, 1 = send, 2 = received, 3 = delivery failed")
+        doc="-1 = canceled, 0 = outgoing, 1 = send, 2 = received, 3 = delivery failed, 4 = processing")
     send_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.now,
+        doc="When outgoing mail is due, or when failed mail will be re-queued. Null = never retried")
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     created_by = db.Column(db.Integer, db.ForeignKey('{}.id'.format(User.__tablename__), ondelete='CASCADE'),
@@ -61,10 +77,13 @@ class MailOutgoing(db.Model, BaseModel):
         """
         return '<MailOutgoing: {}>'.format(self.subject)
 
-    def send_email(self):
-        """Sending email then update status to STATUS_SEND when success
+    def build_message(self):
+        """Build `flask_mail.Message` from this outgoing mail
+
+        Returns:
+            Message -- Message which ready to be sent
         """
-        message = Message(
+        return Message(
             subject=self.subject,
             body=self.body,
             html=self.body_html,
@@ -72,11 +91,259 @@ class MailOutgoing(db.Model, BaseModel):
             recipients=[self.email_to]
         )
 
+    def send_email(self):
+        """Sending email then update status to STATUS_SEND when success
+        """
         try:
-            mail.send(message)
-            self.status = self.STATUS_SEND
-            self.send_at = datetime.now()
-            self.save()
+            with metrics.timer('smtp_send_seconds'):
+                mail.send(self.build_message())
+            self.set_delivery_result(datetime.now())
         except SMTPException:
-            self.status = self.STATUS_FAILED
-            self.save()
+            self.set_delivery_result(None)
+        self.save()
+
+    def set_delivery_result(self, send_at, counted=False):
+        """Update status after delivery attempt. Failed mail is scheduled to be re-queued with \
+exponential backoff, until `MAIL_RETRY_MAX_ATTEMPTS` reached
+
+        Arguments:
+            send_at {Datetime|None} -- Time when mail was sent, None when delivery failed
+
+        Keyword Arguments:
+            counted {Boolean} -- Attempt already counted when mail was claimed (default: {False})
+        """
+        if not counted:
+            self.attempts = (self.attempts or 0) + 1
+        if send_at is not None:
+            self.status = self.STATUS_SEND
+            self.send_at = send_at
+            self.next_attempt_at = None
+            return
+
+        self.status = self.STATUS_FAILED
+        config = current_app.config
+        if self.attempts < config['MAIL_RETRY_MAX_ATTEMPTS']:
+            delay = exponential_backoff(self.attempts, config['MAIL_RETRY_BASE_DELAY'],
+                config['MAIL_RETRY_MAX_DELAY'])
+            self.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+        else:
+            self.next_attempt_at = None
+
+    @classmethod
+    def requeue_failed(cls):
+        """Re-queue failed mails which retry time has come, in one indexed bulk update
+
+        Returns:
+            Int -- Number of re-queued mails
+        """
+        count = cls.query.filter(
+            cls.status == cls.STATUS_FAILED,
+            cls.next_attempt_at <= datetime.now()
+        ).update({cls.status: cls.STATUS_OUTGOING}, synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def claim_outgoing(cls, limit):
+        """Claim due mails for delivery by setting status to STATUS_PROCESSING. Rows already \
+locked by other worker are skipped. Claim is valid for `CLAIM_TIMEOUT`, after that the row \
+is due again, so mails of crashed worker are not lost. Attempt is counted when claimed, so mail \
+which crashes worker every time is failed after `MAIL_RETRY_MAX_ATTEMPTS` claims
+
+        Arguments:
+            limit {Int} -- Max number of mails to be claimed
+
+        Returns:
+            List -- Claimed mails
+        """
+        now = datetime.now()
+        outgoing_mails = cls.query.filter(
+            cls.status.in_([cls.STATUS_OUTGOING, cls.STATUS_PROCESSING]),
+            cls.next_attempt_at <= now
+        ).order_by(cls.next_attempt_at).limit(limit).with_for_update(skip_locked=True).all()
+
+        claimed = []
+        max_attempts = current_app.config['MAIL_RETRY_MAX_ATTEMPTS']
+        for outgoing_mail in outgoing_mails:
+            if (outgoing_mail.attempts or 0) >= max_attempts:
+                outgoing_mail.status = cls.STATUS_FAILED
+                outgoing_mail.next_attempt_at = None
+                continue
+            outgoing_mail.attempts = (outgoing_mail.attempts or 0) + 1
+            outgoing_mail.status = cls.STATUS_PROCESSING
+            outgoing_mail.next_attempt_at = now + cls.CLAIM_TIMEOUT
+            claimed.append(outgoing_mail)
+        # claimed rows belong to this worker, keep them loaded so send_batch() doesn't refresh every row
+        session = db.session()
+        expire_on_commit = session.expire_on_commit
+        session.expire_on_commit = False
+        try:
+            session.commit()
+        finally:
+            session.expire_on_commit = expire_on_commit
+        return claimed
+
+    @classmethod
+    def send_batch(cls, outgoing_mails, max_workers=1):
+        """Deliver many mails at once. Mails are split to `max_workers` threads, every thread keeps \
+one SMTP connection open for all of its mails and reconnects when connection fails. \
+Status of all mails is written in single commit, mail which can't be built or sent is failed \
+alone without stopping the batch
+
+        Arguments:
+            outgoing_mails {List} -- Mails claimed by `claim_outgoing()`, attempt already counted
+
+        Keyword Arguments:
+            max_workers {Int} -- Number of threads (and SMTP connections) which sending mail (default: {1})
+
+        Returns:
+            Float -- Delivery rate in messages/second
+        """
+        if not outgoing_mails:
+            return 0.0
+
+        started = time.time()
+        messages = []
+        for outgoing_mail in outgoing_mails:
+            try:
+                messages.append(outgoing_mail.build_message())
+            except Exception:
+                current_app.logger.exception("Failed to build mail %s", outgoing_mail.id)
+                messages.append(None)
+        max_workers = max(1, min(max_workers, len(messages)))
+        chunks = [messages[idx::max_workers] for idx in range(max_workers)]
+        apps = [current_app._get_current_object()] * max_workers
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            chunk_results = list(executor.map(_deliver_messages, apps, chunks))
+
+        results = [None] * len(messages)
+        for idx, chunk_result in enumerate(chunk_results):
+            results[idx::max_workers] = chunk_result
+
+        for outgoing_mail, send_at in zip(outgoing_mails, results):
+            outgoing_mail.set_delivery_result(send_at, counted=True)
+        db.session.commit()
+
+        elapsed = time.time() - started
+        return len(messages) / elapsed if elapsed > 0 else float(len(messages))
+
+    @classmethod
+    def deliver_outgoing(cls, batch_size=50, max_workers=4):
+        """Re-queue failed mails which are due, claim one batch of pending mails then deliver \
+them with `send_batch()`
+
+        Keyword Arguments:
+            batch_size {Int} -- Max number of mails claimed in one batch (default: {50})
+            max_workers {Int} -- Number of threads which sending mail (default: {4})
+
+        Returns:
+            Tuple -- Number of processed mails and delivery rate in messages/second
+        """
+        cls.requeue_failed()
+        outgoing_mails = cls.claim_outgoing(batch_size)
+        rate = cls.send_batch(outgoing_mails, max_workers=max_workers)
+        return len(outgoing_mails), rate
+
+    @classmethod
+    def count_by_status(cls):
+        """Count mails of every status, with one grouped query on indexed status column
+
+        Returns:
+            Dict -- Number of mails by status
+        """
+        rows = db.session.query(cls.status, db.func.count(cls.id)).group_by(cls.status).all()
+        return dict(rows)
+
+class SMTPConnection(object):
+    """Reusable SMTP connection of one outbox worker. Connection is opened on first message \
+and reopened once when it fails in the middle of batch
+    """
+
+    def __init__(self):
+        """Instantiate class object
+        """
+        self.connection = None
+
+    def send(self, message):
+        """Send message through opened connection
+
+        Arguments:
+            message {Message} -- Message to be sent
+
+        Raises:
+            SMTPException|socket.error -- Raise when message still can't be sent after reconnect
+        """
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = mail.connect().__enter__()
+            try:
+                with metrics.timer('smtp_send_seconds'):
+                    self.connection.send(message)
+                return
+            except (SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError):
+                raise
+            except (SMTPException, socket.error):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        """Close connection, ignore error when connection already broken
+        """
+        if self.connection is not None:
+            try:
+                self.connection.__exit__(None, None, None)
+            except (SMTPException, socket.error):
+                pass
+            self.connection = None
+
+def _deliver_messages(app, messages):
+    """Send messages from outbox worker thread using one SMTP connection
+
+    Arguments:
+        app {Flask} -- Flask app, pushed as app context of the thread
+        messages {List} -- Messages to be sent, None for mail which can't be built
+
+    Returns:
+        List -- Time when each message was sent, or None when delivery failed
+    """
+    results = []
+    with app.app_context():
+        connection = SMTPConnection()
+        try:
+            for message in messages:
+                if message is None:
+                    results.append(None)
+                    continue
+                try:
+                    connection.send(message)
+                    results.append(datetime.now())
+                except (SMTPException, socket.error):
+                    results.append(None)
+                except Exception:
+                    # e.g. bad header, one broken mail must not fail the whole batch
+                    app.logger.exception("Failed to send mail to %s", ', '.join(message.recipients))
+                    connection.close()
+                    results.append(None)
+        finally:
+            connection.close()
+    return results
+
+def _collect_outbox_depth():
+    """Outbox depth gauge, collected when metrics are scraped
+
+    Returns:
+        List -- (name, labels, value) of every status
+    """
+    status_names = {
+        MailOutgoing.STATUS_CANCELED: 'canceled',
+        MailOutgoing.STATUS_OUTGOING: 'outgoing',
+        MailOutgoing.STATUS_SEND: 'send',
+        MailOutgoing.STATUS_RECEIVED: 'received',
+        MailOutgoing.STATUS_FAILED: 'failed',
+        MailOutgoing.STATUS_PROCESSING: 'processing',
+    }
+    counts = MailOutgoing.count_by_status()
+    return [('outbox_depth', (name,), counts.get(status, 0)) for status, name in status_names.items()]
+
+metrics.register_collector(_collect_outbox_depth)
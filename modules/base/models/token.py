@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Verification token model in base modules
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import hmac
+import re
+import secrets
+from datetime import datetime, timedelta
+from hashlib import sha256
+
+from flask import current_app
+from app import db
+from models import BaseModel
+from .user import User
+
+class VerifyToken(db.Model, BaseModel):
+    """One-time & expiring verification token of user. Only hash of the token is stored. \
+Token is signed with `SECRET_KEY`, so malformed or forged token is rejected without query
+    """
+
+    __tablename__ = 'cj_base_verify_token'
+
+    # nonce is 16 random bytes from `secrets`, base64 url encoded
+    NONCE_LENGTH = 22
+    SIGNATURE_LENGTH = 10
+    TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{22}[0-9a-f]{10}$')
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('{}.id'.format(User.__tablename__), ondelete='CASCADE'),
+        nullable=False, index=True)
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    used_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    user = db.relationship(User)
+
+    def __repr__(self):
+        """Representation name
+        """
+        return '<VerifyToken: {}>'.format(self.user_id)
+
+    @staticmethod
+    def sign(nonce):
+        """Get signature of token nonce
+
+        Arguments:
+            nonce {String} -- Random part of token
+
+        Returns:
+            String -- Signature
+        """
+        return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'), nonce.encode('utf-8'),
+            sha256).hexdigest()[:VerifyToken.SIGNATURE_LENGTH]
+
+    @staticmethod
+    def hash_token(token):
+        """Get hash of token which stored in database
+
+        Arguments:
+            token {String} -- Plaintext token
+
+        Returns:
+            String -- Token hash
+        """
+        return sha256(token.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def check_signature(cls, token):
+        """Check token format and signature, without query
+
+        Arguments:
+            token {String} -- Plaintext token
+
+        Returns:
+            Boolean -- True when token may be valid
+        """
+        if not token or not cls.TOKEN_PATTERN.match(token):
+            return False
+        nonce, signature = token[:cls.NONCE_LENGTH], token[cls.NONCE_LENGTH:]
+        return hmac.compare_digest(cls.sign(nonce), signature)
+
+    @classmethod
+    def generate_token(cls):
+        """Generate new signed token
+
+        Returns:
+            Tuple -- Plaintext token and its hash
+        """
+        nonce = secrets.token_urlsafe(16)
+        token = nonce + cls.sign(nonce)
+        return token, cls.hash_token(token)
+
+    @classmethod
+    def get_expires_at(cls):
+        """Get expired time of token created now
+
+        Returns:
+            Datetime -- Expired time
+        """
+        return datetime.now() + timedelta(seconds=current_app.config['VERIFY_TOKEN_TTL'])
+
+    @classmethod
+    def issue(cls, user):
+        """Create new token of user, previous tokens of the user can't be used anymore. \
+Saved without commit, so it's committed together with the caller
+
+        Arguments:
+            user {Recordset} -- User data
+
+        Returns:
+            String -- Plaintext token, only available here
+        """
+        cls.query.filter(cls.user_id == user.id, cls.used_at == None).update(
+            {cls.used_at: datetime.now()}, synchronize_session=False)
+        token, token_hash = cls.generate_token()
+        cls(user_id=user.id, token_hash=token_hash, expires_at=cls.get_expires_at()).save(commit=False)
+        return token
+
+    @classmethod
+    def consume(cls, token):
+        """Find user of valid token then mark the token as used. Malformed or forged token is \
+rejected without query, valid token is found by unique index of `token_hash`
+
+        Arguments:
+            token {String} -- Plaintext token
+
+        Returns:
+            Recordset|None -- User of token, None when token not valid
+        """
+        if not cls.check_signature(token):
+            return None
+
+        verify_token = cls.query.filter(
+            cls.token_hash == cls.hash_token(token),
+            cls.used_at == None,
+            cls.expires_at > datetime.now()
+        ).first()
+        if verify_token is None:
+            return None
+
+        verify_token.used_at = datetime.now()
+        verify_token.save(commit=False)
+        return verify_token.user
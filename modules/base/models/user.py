@@ -6,12 +6,15 @@ Author:
 	@CakJuice <hd.brandoz@gmail.com>
 """
 
+import threading
 from datetime import datetime
 
 from flask import url_for
-from app import db, argon2, login_manager
-from models import BaseModel
-from helpers import generate_random_string, generate_slug as slugify
+from sqlalchemy.orm import validates
+from app import db, hasher, login_manager, user_cache
+from models import BaseModel, allocate_slugs
+from bloom import add_rows
+from helpers import generate_slug as slugify, normalize_email
 
 class User(db.Model, BaseModel):
     """User model, mixin inherit `db.Model` from `flask_sqlalchemy` & `BaseModel` from models.py
@@ -45,19 +48,25 @@ Terima kasih.
         """
         name = self.current_parameters.get('name')
         if name:
-            return slugify(User, name)
+            return slugify(User, name, self.connection)
         return None
 
     def check_status_admin(self):
-        """Check status `is_admin` user. If `is_admin` already available it will be return `False`
+        """Check status `is_admin` user. If `is_admin` already available it will be return `False`. \
+Admin is taken from `admin_registry`, so it's not queried on every insert
 
         Returns:
             Boolean -- Result user query
         """
-        user = User.query.filter_by(is_admin=True).first()
-        if user is None:
-            return True
-        return False
+        return admin_registry.claim(self.connection)
+
+    def generate_email_normalized(self):
+        """Generate normalized email from email value, used by insert which bypass `set_email()`
+
+        Returns:
+            String|None -- Normalized email
+        """
+        return normalize_email(self.current_parameters.get('email'))
 
     def check_status_active(self):
         """Check `status` user. If `self.is_admin` then `status' auto active
@@ -72,13 +81,14 @@ Terima kasih.
 
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(128), nullable=False, unique=True)
+    email_normalized = db.Column(db.String(128), unique=True, default=generate_email_normalized,
+        doc="Lowercase email, used for every email lookup")
     password_hash = db.Column(db.String(255), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     slug = db.Column(db.String(128), nullable=False, unique=True, default=generate_slug)
     is_admin = db.Column(db.Boolean, default=check_status_admin)
     status = db.Column(db.SmallInteger, default=check_status_active,
         doc="1 = active, 0 = not active, -1 = deleted")
-    verify_code = db.Column(db.String(32), default=lambda: generate_random_string(32))
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     last_request_at = db.Column(db.DateTime)
@@ -88,6 +98,20 @@ Terima kasih.
         """
         return '<User: {}>'.format(self.name)
 
+    @validates('email')
+    def set_email(self, key, email):
+        """Keep `email_normalized` in sync when email changed
+
+        Arguments:
+            key {String} -- Field name
+            email {String} -- New email
+
+        Returns:
+            String -- Email to be stored
+        """
+        self.email_normalized = normalize_email(email)
+        return email
+
     # flask-login interface
     def get_id(self):
         return self.id
@@ -111,7 +135,7 @@ Terima kasih.
         Returns:
             String -- Hash result
         """
-        return argon2.generate_password_hash(plaintext)
+        return hasher.generate_password_hash(plaintext)
 
     def check_password(self, raw_password):
         """Verify input password with `password_hash`
@@ -122,11 +146,44 @@ Terima kasih.
         Returns:
             Boolean -- Verify result
         """
-        return argon2.check_password_hash(self.password_hash, raw_password)
+        return hasher.check_password_hash(self.password_hash, raw_password)
+
+    @staticmethod
+    def not_backfilled_email(email_normalized):
+        """Filter of users which not backfilled yet (`email_normalized` is NULL), matched by \
+lowercased `email`. Only needed until `manage.py base backfill_email_normalized` is done
+
+        Arguments:
+            email_normalized {String} -- Normalized email
+
+        Returns:
+            BinaryExpression -- Filter clause
+        """
+        return db.and_(User.email_normalized == None, db.func.lower(User.email) == email_normalized)
+
+    @staticmethod
+    def get_by_email(email):
+        """Find user by email case-insensitively, using unique index of `email_normalized`. \
+Users which not backfilled yet (`email_normalized` is NULL) are found by lowercased `email`. \
+Bloom filter is not used here, filter of this process may miss user created by other process
+
+        Arguments:
+            email {String} -- User email
+
+        Returns:
+            Recordset|None -- User data
+        """
+        email_normalized = normalize_email(email)
+        user = User.query.filter_by(email_normalized=email_normalized).first()
+        if user is None and email_normalized:
+            # slower scan, only until `manage.py base backfill_email_normalized` is done
+            user = User.query.filter(User.not_backfilled_email(email_normalized)).first()
+        return user
 
     @staticmethod
     def authenticate(email, password):
-        """Check user authenticate when login
+        """Check user authenticate when login. When password hash was made with outdated argon2 \
+parameters, password is hashed again with current parameters
 
         Arguments:
             email {String} -- Input email from user
@@ -135,39 +192,282 @@ Terima kasih.
         Returns:
             Recordset|Boolean -- Auth result, if user found then return user data, else return false
         """
-        user = User.query.filter_by(email=email, status=User.STATUS_ACTIVE).first()
-        if user and user.check_password(password):
+        user = User.get_by_email(email)
+        if user and user.status == User.STATUS_ACTIVE and user.check_password(password):
+            if hasher.needs_rehash(user.password_hash):
+                user.password_hash = User.make_password(password)
+                user.save()
             return user
         return False
 
+    def invalidate_cache(self):
+        """Remove user from `user_cache`, so changes (e.g. status) are applied on next request
+        """
+        if self.id is not None:
+            user_cache.delete(str(self.id))
+        if self.is_admin or self.id == admin_registry.admin_id:
+            admin_registry.invalidate()
+
     def set_verified(self):
-        """Update data status user when user verified account
+        """Update data status user when user verified account. Cached user is invalidated by `save()`
         """
         self.status = User.STATUS_ACTIVE
         self.save()
 
     def resend_verification_mail(self):
-        """Generate new verification code then resend verification mail
+        """Generate new verification token then resend verification mail, committed once
         """
-        self.verify_code = generate_random_string(32)
-        self.save()
-        self.send_verification_mail()
+        with self.transaction():
+            self.send_verification_mail()
 
     def send_verification_mail(self):
-        """Sending verification email after user signup.
+        """Queue verification email with new verification token. Mail will be delivered by outbox \
+worker (`python manage.py base outbox`)
         """
         from .mail import MailOutgoing
+        from .token import VerifyToken
+
+        token = VerifyToken.issue(self)
+        outgoing_mail = MailOutgoing(**User.get_verification_mail(self.name, self.email, token))
+        outgoing_mail.save()
+
+    @classmethod
+    def get_verification_mail(cls, name, email, token):
+        """Get values of verification mail
+
+        Arguments:
+            name {String} -- User name
+            email {String} -- User email
+            token {String} -- Plaintext verification token
+
+        Returns:
+            Dict -- Column values of `MailOutgoing`
+        """
+        verify_url = url_for('base.verify', verify_code=token, _external=True)
+        return {
+            'subject': "Verifikasi Pendaftaran User",
+            'email_to': email,
+            'body': cls.VERIFY_BODY.format(name, verify_url),
+            'body_html': cls.VERIFY_BODY_HTML.format(name, verify_url),
+        }
+
+    @staticmethod
+    def bulk_create(values_list, send_verification=False):
+        """Create many users with bulk insert in single commit. Passwords are hashed in parallel \
+by `hasher` and slugs are allocated at once
+
+        Arguments:
+            values_list {List} -- Dicts with `email`, `name` & `password` (plaintext)
+
+        Keyword Arguments:
+            send_verification {Boolean} -- Queue verification mail for created users (default: {False})
+
+        Returns:
+            Int -- Number of created users
+        """
+        from .mail import MailOutgoing
+        from .token import VerifyToken
+
+        if not values_list:
+            return 0
+
+        futures = [hasher.generate_password_hash_async(values['password']) for values in values_list]
+        slugs = allocate_slugs(User, [values['name'] for values in values_list])
+        now = datetime.now()
+        rows = []
+        for values, future, slug in zip(values_list, futures, slugs):
+            is_admin = admin_registry.claim()
+            rows.append({
+                'email': values['email'],
+                'email_normalized': normalize_email(values['email']),
+                'name': values['name'],
+                'password_hash': future.result(),
+                'slug': slug,
+                'is_admin': is_admin,
+                'status': User.STATUS_ACTIVE if is_admin else User.STATUS_NOT_ACTIVE,
+                'created_at': now,
+                'updated_at': now,
+            })
+        db.session.bulk_insert_mappings(User, rows)
+        # bulk insert doesn't fire after_insert, which keeps bloom filters up to date
+        add_rows(User, rows)
+
+        if send_verification:
+            rows = [row for row in rows if not row['is_admin']]
+            user_ids = dict(db.session.query(User.email_normalized, User.id).filter(
+                User.email_normalized.in_([row['email_normalized'] for row in rows])))
+            tokens, mails = [], []
+            expires_at = VerifyToken.get_expires_at()
+            for row in rows:
+                token, token_hash = VerifyToken.generate_token()
+                tokens.append({'user_id': user_ids[row['email_normalized']], 'token_hash': token_hash,
+                    'expires_at': expires_at, 'created_at': now})
+                mails.append(User.get_verification_mail(row['name'], row['email'], token))
+            db.session.bulk_insert_mappings(VerifyToken, tokens)
+            db.session.bulk_insert_mappings(MailOutgoing, mails)
+        db.session.commit()
+        return len(values_list)
+
+class AdminRegistry(object):
+    """Cache id of admin (system) user, which used as default of `User.is_admin` and \
+`created_by` / `updated_by` of automatic records. Only found admin is cached, so first user \
+still become admin, and only once even in bulk insert
+    """
+
+    def __init__(self):
+        """Instantiate class object
+        """
+        self.admin_id = None
+        self._claimed = False
+        self._lock = threading.Lock()
+
+    def get_id(self, connection=None):
+        """Get admin user id, query database only when not cached yet
+
+        Keyword Arguments:
+            connection {Connection} -- Database connection, default to current session (default: {None})
+
+        Returns:
+            Int|None -- Admin user id, None when no admin yet
+        """
+        if self.admin_id is None:
+            query = db.select([User.id]).where(User.is_admin == True).order_by(User.id).limit(1)
+            if connection is None:
+                connection = db.session.connection()
+            self.admin_id = connection.execute(query).scalar()
+        return self.admin_id
+
+    def claim(self, connection=None):
+        """Check whether new user must become admin. Return True only once when no admin found, \
+until the admin is saved or the transaction rolled back
 
-        outgoing_mail = MailOutgoing(
-            subject="Verifikasi Pendaftaran User",
-            email_to=self.email,
-            body=self.VERIFY_BODY.format(self.name, url_for('base.verify',
-                verify_code=self.verify_code, _external=True)),
-            body_html=self.VERIFY_BODY_HTML.format(self.name,
-                url_for('base.verify', verify_code=self.verify_code, _external=True))
-        )
-        outgoing_mail.send_email()
+        Keyword Arguments:
+            connection {Connection} -- Database connection (default: {None})
+
+        Returns:
+            Boolean -- True when new user must become admin
+        """
+        with self._lock:
+            if self._claimed or self.get_id(connection) is not None:
+                return False
+            self._claimed = True
+            return True
+
+    def invalidate(self):
+        """Forget cached admin, call when admin user changed
+        """
+        with self._lock:
+            self.admin_id = None
+            self._claimed = False
+
+admin_registry = AdminRegistry()
+
+@db.event.listens_for(User, 'after_insert')
+def _after_insert_user(mapper, connection, target):
+    if target.is_admin:
+        admin_registry.invalidate()
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    if admin_registry.admin_id is None:
+        admin_registry.invalidate()
+
+class UserPrincipal(object):
+    """Compact & immutable identity of logged in user which stored in `g.user`. Full `User` \
+record is only loaded when view access `principal.user`
+    """
+
+    __slots__ = ('id', 'name', 'slug', 'is_admin', 'status', '_user')
+
+    def __init__(self, id, name, slug, is_admin, status):
+        """Instantiate class object
+
+        Arguments:
+            id {Int} -- User id
+            name {String} -- User name
+            slug {String} -- User slug
+            is_admin {Boolean} -- User is admin
+            status {Int} -- User status
+        """
+        for key, value in zip(self.__slots__, (id, name, slug, is_admin, status, None)):
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("UserPrincipal is immutable")
+
+    def __repr__(self):
+        """Representation name
+        """
+        return '<UserPrincipal: {}>'.format(self.name)
+
+    @classmethod
+    def from_user(cls, user):
+        """Create principal from user record
+
+        Arguments:
+            user {Recordset} -- User data
+
+        Returns:
+            UserPrincipal -- Principal of user
+        """
+        return cls(user.id, user.name, user.slug, user.is_admin, user.status)
+
+    def to_tuple(self):
+        """Get principal values, used to store principal in `user_cache`
+
+        Returns:
+            Tuple -- (id, name, slug, is_admin, status)
+        """
+        return (self.id, self.name, self.slug, self.is_admin, self.status)
+
+    @property
+    def user(self):
+        """Full user record, loaded on first access
+
+        Returns:
+            Recordset -- User data
+        """
+        if self._user is None:
+            object.__setattr__(self, '_user', User.query.get(self.id))
+        return self._user
+
+    # flask-login interface
+    def get_id(self):
+        return self.id
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_active(self):
+        return self.status == User.STATUS_ACTIVE
+
+    @property
+    def is_anonymous(self):
+        return False
 
 @login_manager.user_loader
 def _user_loader(user_id):
-    return User.query.get(int(user_id))
+    """Load principal of logged in user, from `user_cache` when available. Only active user \
+is loaded (and cached), so deleted or deactivated user is logged out on next request
+
+    Arguments:
+        user_id {String} -- User id from session
+
+    Returns:
+        UserPrincipal|None -- Principal of user, None when user not found or not active
+    """
+    key = str(user_id)
+    values = user_cache.get(key)
+    if values is not None:
+        principal = UserPrincipal(*values)
+        return principal if principal.is_active else None
+
+    user = User.query.get(int(user_id))
+    if user is None or user.status != User.STATUS_ACTIVE:
+        return None
+
+    principal = UserPrincipal.from_user(user)
+    user_cache.set(key, principal.to_tuple())
+    return principal
@@ -1,9 +1,36 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
 import unittest
+from datetime import datetime, timedelta
+
+from argon2 import PasswordHasher
+from flask import Flask, g, request
+from markupsafe import Markup
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import QueuePool
 
 from main import app
-from test_helpers import DummyTest
-from .models.user import User
+from settings import Configuration
+from app import db, hasher, user_cache, limiter, query_stats, metrics, assets, page_cache
+from assets import build_assets
+from pagecache import fragment_key
+from templating import make_bytecode_cache, measure_template_load
+from metrics import Metrics, COUNTER, HISTOGRAM
+from querystats import QueryBudgetExceeded
+from models import allocate_slugs
+from helpers import generate_slug
+from bloom import BloomFilter, get_column_filter, might_exist
+from cache import FileCache
+from ratelimit import SharedBackend
+from test_helpers import DummyTest, DummyStore
+from .activity import activity_tracker
+from .benchmarks import run_benchmark, compare, percentile
+from .models.user import User, UserPrincipal, admin_registry
 from .models.mail import MailOutgoing
+from .models.token import VerifyToken
 
 class BaseTest(unittest.TestCase, DummyTest):
 	def setUp(self):
@@ -20,12 +47,396 @@ class BaseTest(unittest.TestCase, DummyTest):
 		self.dummy_get_signup1()
 		response = self.dummy_get_signup2()
 		assert 'success' in str(response.data)
-		user = User.query.get(2)
-		mail = MailOutgoing.query.filter_by(email_to=user.email).first()
-		assert mail is not None
-		assert mail.status == MailOutgoing.STATUS_SEND
-		response = self.app.get('/verify/{}/'.format(user.verify_code), follow_redirects=True)
+		with app.app_context():
+			user = User.query.get(2)
+			mail = MailOutgoing.query.filter_by(email_to=user.email).first()
+			assert mail is not None
+			assert mail.status == MailOutgoing.STATUS_OUTGOING
+			verify_url = re.search(r'/verify/[\w-]+/', mail.body).group(0)
+		response = self.app.get(verify_url, follow_redirects=True)
 		assert 'login' in str(response.data)
+		with app.app_context():
+			assert User.query.get(2).status == User.STATUS_ACTIVE
+
+	def test_verify_token(self):
+		self.dummy_get_signup1()
+		self.dummy_get_signup2()
+		with app.test_request_context():
+			user = User.query.get(2)
+			token = VerifyToken.issue(user)
+			db.session.commit()
+			old_token = VerifyToken.query.filter_by(user_id=user.id).first()
+			assert old_token.used_at is not None
+			assert VerifyToken.query.count() == 2
+
+			assert len(token) == 32 and VerifyToken.check_signature(token)
+			assert not VerifyToken.check_signature('x' * 32)
+			assert not VerifyToken.check_signature(token[:-1] + ('0' if token[-1] != '0' else '1'))
+			assert VerifyToken.consume('x' * 32) is None
+			assert VerifyToken.consume(token).id == user.id
+			db.session.commit()
+			assert VerifyToken.consume(token) is None
+
+		response = self.app.get('/verify/{}/'.format('ngawurcode'), follow_redirects=True)
+		assert 'danger' in str(response.data)
+
+	def test_outbox_deliver(self):
+		self.dummy_get_signup1()
+		self.dummy_get_signup2()
+		with app.app_context():
+			assert MailOutgoing.deliver_outgoing(batch_size=10, max_workers=2)[0] == 1
+			assert len(self.mail_outbox) == 1
+			mail = MailOutgoing.query.first()
+			assert mail.status == MailOutgoing.STATUS_SEND
+			assert mail.send_at is not None
+			assert MailOutgoing.deliver_outgoing(batch_size=10, max_workers=2)[0] == 0
+
+	def test_outbox_batch_queries(self):
+		self.dummy_get_signup1()
+		with app.app_context():
+			for idx in range(5):
+				MailOutgoing(subject="Test {}".format(idx), email_to='test@cakjuice.com', body="Test").save()
+			g.query_count = 0
+			assert MailOutgoing.deliver_outgoing(batch_size=10, max_workers=2)[0] == 5
+			# requeue, claim select, claim update, status update, no refresh per mail
+			assert g.query_count <= 6
+
+	def test_outbox_poison_mail(self):
+		self.dummy_get_signup1()
+		with app.app_context():
+			mails = [MailOutgoing(subject=subject, email_to='test@cakjuice.com', body="Test")
+				for subject in ("Test 1", "Bad\nheader", "Test 2")]
+			for mail in mails:
+				mail.save()
+			assert MailOutgoing.deliver_outgoing(batch_size=10)[0] == 3
+			assert len(self.mail_outbox) == 2
+			assert [mail.status for mail in mails] == [MailOutgoing.STATUS_SEND, MailOutgoing.STATUS_FAILED,
+				MailOutgoing.STATUS_SEND]
+			assert mails[1].attempts == 1
+
+			# worker crashed on every claim, mail is failed when retry limit reached
+			mails[1].status = MailOutgoing.STATUS_PROCESSING
+			mails[1].attempts = app.config['MAIL_RETRY_MAX_ATTEMPTS']
+			mails[1].next_attempt_at = datetime.now() - timedelta(seconds=1)
+			mails[1].save()
+			assert MailOutgoing.claim_outgoing(10) == []
+			assert MailOutgoing.query.get(mails[1].id).status == MailOutgoing.STATUS_FAILED
+			assert MailOutgoing.query.get(mails[1].id).next_attempt_at is None
+
+	def test_send_batch_reuse_connection(self):
+		self.dummy_get_signup1()
+		with app.app_context(), self.dummy_smtp_server() as server:
+			mails = [MailOutgoing(subject="Test {}".format(idx), email_to='test@cakjuice.com',
+				body="Test") for idx in range(6)]
+			for mail in mails:
+				mail.save()
+			rate = MailOutgoing.send_batch(mails, max_workers=2)
+			assert rate > 0
+			assert server.connections == 2
+			assert len(server.messages) == 6
+			assert all(mail.status == MailOutgoing.STATUS_SEND for mail in mails)
+
+	def test_failed_mail_requeue(self):
+		self.dummy_get_signup1()
+		self.dummy_get_signup2()
+		with app.app_context():
+			mail = MailOutgoing.query.first()
+			mail.set_delivery_result(None)
+			mail.save()
+			assert mail.status == MailOutgoing.STATUS_FAILED
+			assert mail.attempts == 1
+			assert mail.next_attempt_at > datetime.now()
+			assert MailOutgoing.requeue_failed() == 0
+
+			mail.next_attempt_at = datetime.now() - timedelta(seconds=1)
+			mail.save()
+			assert MailOutgoing.requeue_failed() == 1
+			assert MailOutgoing.query.get(mail.id).status == MailOutgoing.STATUS_OUTGOING
+
+			mail.attempts = app.config['MAIL_RETRY_MAX_ATTEMPTS']
+			mail.set_delivery_result(None)
+			assert mail.next_attempt_at is None
+
+	def test_password_hash_service(self):
+		with app.app_context():
+			pw_hash = hasher.generate_password_hash_async('cakjuice').result()
+			assert hasher.check_password_hash(pw_hash, 'cakjuice')
+			assert not hasher.check_password_hash_async(pw_hash, 'weladalah').result()
+
+	def test_password_hash_queue_full(self):
+		self.dummy_get_signup1()
+		pool = app.extensions['password_hash']
+		timeout, pool.timeout = pool.timeout, 0.01
+		acquired = 0
+		try:
+			while pool.slots.acquire(blocking=False):
+				acquired += 1
+			response = self.app.post('/login/', data={'email': 'support@cakjuice.com', 'password': 'cakjuice'})
+			assert response.status_code == 503
+			assert response.headers['Retry-After'] == str(app.config['PASSWORD_HASH_RETRY_AFTER'])
+		finally:
+			for _ in range(acquired):
+				pool.slots.release()
+			pool.timeout = timeout
+		assert 'Logout' in str(self.dummy_login1().data)
+
+	def test_login_rehash_outdated_password(self):
+		self.dummy_get_signup1()
+		with app.app_context():
+			user = User.query.get(1)
+			user.password_hash = PasswordHasher(time_cost=1, memory_cost=1024, parallelism=1).hash('cakjuice')
+			user.save()
+			old_hash = user.password_hash
+			assert User.authenticate('support@cakjuice.com', 'cakjuice')
+			assert user.password_hash != old_hash
+			assert not hasher.needs_rehash(user.password_hash)
+			assert User.authenticate('support@cakjuice.com', 'cakjuice')
+
+	def test_user_loader_cache(self):
+		self.dummy_get_signup1()
+		response = self.dummy_login1()
+		assert 'Logout' in str(response.data)
+		with app.app_context():
+			assert user_cache.get('1') is not None
+		response = self.app.get('/')
+		assert 'Logout' in str(response.data)
+
+		with app.app_context():
+			user = User.query.get(1)
+			user.status = User.STATUS_DELETED
+			user.save()
+			assert user_cache.get('1') is None
+
+	def test_deleted_user_logged_out(self):
+		self.dummy_get_signup1()
+		self.dummy_login1()
+		assert 'id="nav-item-logout"' in self.app.get('/').get_data(as_text=True)
+		with app.app_context():
+			user = User.query.get(1)
+			user.status = User.STATUS_DELETED
+			user.save()
+		response = self.app.get('/')
+		assert 'id="nav-item-login"' in response.get_data(as_text=True)
+		with app.app_context():
+			assert user_cache.get('1') is None
+
+	def test_user_principal(self):
+		self.dummy_get_signup1()
+		with app.app_context():
+			principal = UserPrincipal.from_user(User.query.get(1))
+			assert principal.is_authenticated and principal.is_active
+			assert not hasattr(principal, '__dict__')
+			with self.assertRaises(AttributeError):
+				principal.name = 'Other'
+			assert principal.user.email == 'support@cakjuice.com'
+
+	def test_file_cache(self):
+		with tempfile.TemporaryDirectory() as directory:
+			cache = FileCache(directory, max_size=2, ttl=60)
+			cache.set('1', {'name': 'Cak Juice'})
+			assert cache.get('1') == {'name': 'Cak Juice'}
+			assert FileCache(directory).get('1') == {'name': 'Cak Juice'}
+			cache.set('2', 2)
+			cache.set('3', 3)
+			assert len(os.listdir(directory)) == 2
+			cache.delete('3')
+			assert cache.get('3') is None
+
+	def test_allocate_slugs(self):
+		self.dummy_get_signup1()
+		with app.app_context():
+			slugs = allocate_slugs(User, ['Support Cak Juice'] * 11 + ['Support Cak Juice 1', 'Cak'])
+			db.session.commit()
+			assert slugs[0] == 'support-cak-juice-1'
+			assert slugs[9] == 'support-cak-juice-10'
+			assert slugs[10] == 'support-cak-juice-11'
+			assert slugs[11] == 'support-cak-juice-1-1'
+			assert slugs[12] == 'cak'
+			assert generate_slug(User, 'Support Cak Juice') == 'support-cak-juice-12'
+
+			# "cak-1" allocated as base slug but its row not inserted yet, like other transaction
+			assert allocate_slugs(User, ['Cak 1']) == ['cak-1']
+			assert allocate_slugs(User, ['Cak', 'Cak']) == ['cak-2', 'cak-3']
+
+	def test_admin_registry(self):
+		with app.app_context():
+			users = [User(email='user{}@cakjuice.com'.format(idx), name='User', password_hash='x')
+				for idx in range(3)]
+			db.session.add_all(users)
+			db.session.commit()
+			assert [user.is_admin for user in users] == [True, False, False]
+			assert admin_registry.get_id() == users[0].id
+
+	def test_transaction_scope(self):
+		self.dummy_get_signup1()
+		commits = []
+		on_commit = lambda session: commits.append(session)
+		with app.app_context():
+			db.event.listen(db.session, 'after_commit', on_commit)
+			try:
+				user = User.query.get(1)
+				with User.transaction():
+					user.name = 'Changed'
+					user.save()
+					with MailOutgoing.transaction():
+						MailOutgoing(subject="Test", email_to=user.email, body="Test").save()
+					assert not commits
+				assert len(commits) == 1
+
+				with self.assertRaises(ValueError):
+					with User.transaction():
+						user.name = 'Rollback'
+						user.save()
+						raise ValueError()
+				assert User.query.get(1).name == 'Changed'
+			finally:
+				db.event.remove(db.session, 'after_commit', on_commit)
+
+	def test_bulk_create_users(self):
+		self.dummy_get_signup1()
+		with app.test_request_context():
+			count = User.bulk_create([
+				{'email': 'import{}@cakjuice.com'.format(idx), 'name': 'Import User', 'password': 'cakjuice'}
+				for idx in range(3)
+			], send_verification=True)
+			assert count == 3
+			users = User.query.filter(User.email.startswith('import')).order_by(User.id).all()
+			assert [user.slug for user in users] == ['import-user', 'import-user-1', 'import-user-2']
+			assert not any(user.is_admin for user in users)
+			assert users[0].check_password('cakjuice')
+			assert MailOutgoing.query.filter(MailOutgoing.email_to.startswith('import')).count() == 3
+
+	def test_activity_tracker(self):
+		self.dummy_get_signup1()
+		self.dummy_login1()
+		self.app.get('/')
+		with app.app_context():
+			assert User.query.get(1).last_request_at is None
+			assert activity_tracker.flush() == 1
+			assert User.query.get(1).last_request_at is not None
+			assert activity_tracker.flush() == 0
+
+	def test_bloom_filter(self):
+		bloom_filter = BloomFilter(100)
+		for idx in range(100):
+			bloom_filter.add('user{}@cakjuice.com'.format(idx))
+		assert all('user{}@cakjuice.com'.format(idx) in bloom_filter for idx in range(100))
+		assert sum('other{}@cakjuice.com'.format(idx) in bloom_filter for idx in range(1000)) < 50
+
+	def test_unique_email_bloom_filter(self):
+		self.dummy_get_signup1()
+		app.config['BLOOM_FILTER_ENABLED'] = True
+		try:
+			with app.app_context():
+				assert might_exist(User, 'email', 'support@cakjuice.com')
+				assert not might_exist(User, 'email', 'hello@cakjuice.com')
+			response = self.dummy_get_signup2()
+			assert 'success' in str(response.data)
+			with app.app_context():
+				assert might_exist(User, 'email', 'hello@cakjuice.com')
+			response = self.dummy_get_signup2()
+			assert 'sudah ada' in str(response.data)
+
+			with app.app_context():
+				# expired filter is warmed by other thread, unknown value is checked by query meanwhile
+				column_filter = get_column_filter(User, 'email_normalized')
+				column_filter.warmed_at = 0
+				with column_filter._warm_lock:
+					assert might_exist(User, 'email_normalized', 'import@cakjuice.com')
+				assert not might_exist(User, 'email_normalized', 'import@cakjuice.com')
+				User.bulk_create([{'email': 'import@cakjuice.com', 'name': 'Import', 'password': 'cakjuice'}])
+				assert might_exist(User, 'email_normalized', 'import@cakjuice.com')
+				# inserted by other process, not in filter of this process yet
+				assert not might_exist(User, 'email_normalized', 'other@cakjuice.com')
+				db.session.execute(User.__table__.insert(), {'email': 'other@cakjuice.com',
+					'email_normalized': 'other@cakjuice.com', 'name': 'Other', 'slug': 'other',
+					'password_hash': 'x'})
+				assert User.get_by_email('Other@cakjuice.com') is not None
+				db.session.commit()
+			# filter of this process doesn't know the email, duplicate is caught by unique index
+			response = self.app.post('/signup/', data={
+				'email': 'other@cakjuice.com',
+				'name': 'Other Cak Juice',
+				'password': 'cakjuice',
+				'password_confirm': 'cakjuice'
+			}, follow_redirects=True)
+			assert response.status_code == 200
+			assert 'sudah ada' in str(response.data)
+		finally:
+			app.config['BLOOM_FILTER_ENABLED'] = False
+
+	def test_email_case_insensitive(self):
+		self.dummy_get_signup1()
+		response = self.app.post('/login/', data={
+			'email': 'Support@CakJuice.com',
+			'password': 'cakjuice'
+		}, follow_redirects=True)
+		assert 'Logout' in str(response.data)
+
+		response = self.app.post('/signup/', data={
+			'email': 'SUPPORT@cakjuice.com',
+			'name': 'Other Cak Juice',
+			'password': 'cakjuice',
+			'password_confirm': 'cakjuice'
+		}, follow_redirects=True)
+		assert 'sudah ada' in str(response.data)
+		with app.app_context():
+			assert User.query.get(1).email_normalized == 'support@cakjuice.com'
+			# user created before email_normalized column, not backfilled yet
+			db.session.execute(User.__table__.update().values(email_normalized=None))
+			assert User.get_by_email('SUPPORT@cakjuice.com').id == 1
+			assert User.get_by_email('hello@cakjuice.com') is None
+			db.session.commit()
+		# case variant of not backfilled email is not allowed to signup
+		response = self.app.post('/signup/', data={
+			'email': 'Support@CakJuice.com',
+			'name': 'Other Cak Juice',
+			'password': 'cakjuice',
+			'password_confirm': 'cakjuice'
+		}, follow_redirects=True)
+		assert 'sudah ada' in str(response.data)
+		with app.app_context():
+			assert User.query.count() == 1
+
+	def test_login_rate_limit(self):
+		self.dummy_get_signup1()
+		for _ in range(5):
+			response = self.app.post('/login/', data={'email': 'support@cakjuice.com', 'password': 'salah123'})
+			assert response.status_code == 200
+		response = self.app.post('/login/', data={'email': 'Support@cakjuice.com', 'password': 'salah123'})
+		assert response.status_code == 429
+		response = self.app.post('/login/', data={'email': 'hello@cakjuice.com', 'password': 'salah123'})
+		assert response.status_code == 200
+
+	def test_signup_rate_limit(self):
+		for _ in range(3):
+			assert self.dummy_get_signup1().status_code == 200
+		assert self.dummy_get_signup1().status_code == 429
+		assert self.dummy_get_signup2().status_code == 200
+
+	def test_rate_limit_behind_proxy(self):
+		with self.dummy_create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'PROXY_FIX_X_FOR': 1}) as other_app:
+			other_app.add_url_rule('/client-ip/', 'client_ip', lambda: request.remote_addr)
+			client = other_app.test_client()
+			# only last hop is trusted, address added by client itself is ignored
+			response = client.get('/client-ip/', headers={'X-Forwarded-For': '198.51.100.1, 203.0.113.7'},
+				environ_base={'REMOTE_ADDR': '10.0.0.1'})
+			assert response.get_data(as_text=True) == '203.0.113.7'
+
+	def test_rate_limit_shared_backend(self):
+		# two processes, each one has own app with backend on same store
+		store = DummyStore()
+		apps = [Flask(__name__), Flask(__name__)]
+		for item in apps:
+			limiter.init_app(item)
+			item.extensions['ratelimit'] = SharedBackend(store)
+		results = []
+		for idx in range(4):
+			with apps[idx % 2].app_context():
+				results.append(limiter.is_allowed('login:ip:127.0.0.1', 3, 60))
+		assert results == [True, True, True, False]
+		with app.app_context():
+			assert limiter.is_allowed('login:ip:127.0.0.1', 1, 60)
 
 	# def test_post_signup_fail_required(self):
 	# 	response = self.app.post('/signup/', data={
@@ -70,4 +481,278 @@ class BaseTest(unittest.TestCase, DummyTest):
 
 	def test_get_verify_not_found(self):
 		response = self.app.get('/verify/')
-		assert response.status_code == 404
\ No newline at end of file
+		assert response.status_code == 404
+
+	def test_create_app(self):
+		with self.dummy_create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}) as other_app:
+			assert other_app.config['SQLALCHEMY_DATABASE_URI'] == 'sqlite://'
+			assert other_app.startup_time < other_app.config['STARTUP_TIME_BUDGET']
+			assert 'base' in other_app.blueprints
+			assert not other_app.extensions['sqlalchemy'].connectors
+			# other app has own extension state, test app is not rebound to it
+			with app.app_context():
+				user_cache.set('other', 1)
+			with other_app.app_context():
+				assert user_cache.get('other') is None
+			assert app.extensions['password_hash'] is not other_app.extensions['password_hash']
+			with app.app_context():
+				assert user_cache.get('other') == 1
+
+	def test_read_replica_routing(self):
+		with tempfile.TemporaryDirectory() as directory:
+			config = {
+				'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}/primary.db'.format(directory),
+				'SQLALCHEMY_REPLICA_URIS': ['sqlite:///{}/replica.db'.format(directory)],
+				'SQLALCHEMY_ENGINE_OPTIONS': dict(Configuration.SQLALCHEMY_ENGINE_OPTIONS, poolclass=QueuePool),
+			}
+			with self.dummy_create_app(config) as other_app:
+				with other_app.app_context():
+					db.create_all()
+					replica = db.get_engine(other_app, bind='replica_0')
+					db.Model.metadata.create_all(replica)
+					replica.execute(User.__table__.insert(), email='replica@cakjuice.com',
+						email_normalized='replica@cakjuice.com', name='Replica', password_hash='x')
+
+				with other_app.app_context():
+					assert User.query.get(1).email == 'replica@cakjuice.com'
+					user = User(email='primary@cakjuice.com', name='Primary', password_hash='x')
+					user.save()
+					assert User.query.get(1).email == 'primary@cakjuice.com'
+
+				with other_app.app_context():
+					assert User.query.get(1).email == 'replica@cakjuice.com'
+					assert User.query.with_for_update().get(1).email == 'primary@cakjuice.com'
+					db.session.rollback()
+
+				metrics = db.get_pool_metrics(other_app)
+				assert metrics['primary']['checkouts'] > 0
+				assert metrics['primary']['waits'] > 0
+				assert metrics['replica_0']['checkouts'] > 0
+				assert metrics['replica_0']['checked_out'] == 0
+				db.get_engine(other_app).dispose()
+				replica.dispose()
+
+	def test_query_stats(self):
+		self.dummy_get_signup1()
+		self.dummy_login1()
+		with app.app_context():
+			user_cache.clear()
+			query_stats.reset()
+		with self.app:
+			self.app.get('/')
+			assert g.query_count == 1
+			assert g.query_time > 0
+			assert query_stats.get_endpoint_stats()['base.homepage']['queries'] == 1
+
+		app.config.update(QUERY_BUDGETS={'base.signup': 5}, QUERY_BUDGET_ASSERT=True)
+		try:
+			with self.assertRaises(QueryBudgetExceeded):
+				self.dummy_get_signup2()
+		finally:
+			app.config.update(QUERY_BUDGETS={}, QUERY_BUDGET_ASSERT=False)
+
+	def test_query_stats_failed_statement(self):
+		with app.app_context():
+			with db.engine.connect() as connection:
+				for _ in range(3):
+					with self.assertRaises(DBAPIError):
+						connection.execute('SELECT * FROM not_a_table')
+				assert not connection.info.get('query_started')
+
+	def test_metrics(self):
+		self.dummy_get_signup1()
+		self.dummy_get_signup2()
+		self.dummy_login1()
+		response = self.app.get('/metrics')
+		assert response.status_code == 200
+		text = response.data.decode()
+		assert 'http_requests_total{endpoint="base.signup",method="POST",status="302"}' in text
+		assert 'http_request_duration_seconds_bucket{endpoint="base.login",le="+Inf"}' in text
+		assert 'argon2_hash_seconds_count{operation="verify"}' in text
+		assert 'outbox_depth{status="outgoing"} 1\n' in text
+		assert 'db_pool_checkouts{bind="primary"}' in text
+
+		response = self.app.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+		assert response.status_code == 404
+		# behind reverse proxy remote address is the proxy
+		response = self.app.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'})
+		assert response.status_code == 404
+		app.config['METRICS_TOKEN'] = 'secret'
+		try:
+			response = self.app.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7',
+				'Authorization': 'Bearer secret'})
+			assert response.status_code == 200
+			response = self.app.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'},
+				headers={'Authorization': 'Bearer other'})
+			assert response.status_code == 404
+		finally:
+			app.config['METRICS_TOKEN'] = None
+
+	def test_model_metrics_registered_at_init(self):
+		# fresh process, mail model is otherwise imported on first signup only
+		output = subprocess.check_output([sys.executable, '-c', "from app import create_app, metrics; "
+			"create_app(); print(sorted(metrics._metrics), len(metrics._collectors))"],
+			cwd=app.root_path, universal_newlines=True)
+		assert "'outbox_depth'" in output and "'smtp_send_seconds'" in output
+		# outbox depth & pool stats
+		assert output.strip().endswith(' 2')
+
+	def test_metrics_multiprocess(self):
+		extension = Metrics()
+		extension.define('jobs_total', COUNTER, "Jobs")
+		extension.define('job_seconds', HISTOGRAM, "Job time", buckets=(0.1, 1.0))
+		with tempfile.TemporaryDirectory() as directory:
+			# two processes, each one has own app writing to same directory
+			processes = [Flask(__name__), Flask(__name__)]
+			for process in processes:
+				process.config['METRICS_DIR'] = directory
+				extension.init_app(process)
+				with process.app_context():
+					extension.inc('jobs_total')
+					extension.observe('job_seconds', 0.5)
+			# every app writes own file, named by app name, pid & app number
+			with processes[1].app_context():
+				extension.flush()
+
+			with processes[0].app_context():
+				extension.inc('jobs_total')
+				text = extension.render()
+			assert 'jobs_total 3\n' in text
+			assert 'job_seconds_bucket{le="0.1"} 0\n' in text
+			assert 'job_seconds_bucket{le="1.0"} 2\n' in text
+			assert 'job_seconds_count 2\n' in text
+			assert len(os.listdir(directory)) == 2
+
+			# file of dead worker is removed when forked worker starts
+			process = subprocess.Popen([sys.executable, '-c', 'pass'])
+			process.wait()
+			dead_path = os.path.join(directory, 'metrics-{}-{}-0.pickle'.format(processes[0].name, process.pid))
+			os.rename(processes[1].extensions['metrics'].get_path(), dead_path)
+			processes[0].extensions['metrics'].after_fork()
+			assert not os.path.exists(dead_path)
+			assert os.path.exists(processes[0].extensions['metrics'].get_path())
+
+	def test_benchmark(self):
+		result = run_benchmark(requests=4, concurrency=2, alloc_requests=1,
+			scenario_names=['homepage', 'verify', 'login'])
+		assert list(result['scenarios']) == ['homepage', 'verify', 'login']
+		for stats in result['scenarios'].values():
+			assert stats['requests'] == 4
+			assert stats['errors'] == 0
+			assert stats['latency_ms']['p50'] <= stats['latency_ms']['p99']
+			assert stats['alloc_kb_per_request'] > 0
+		assert result['scenarios']['verify']['queries_per_request'] > 0
+
+		baseline = {'scenarios': {'login': dict(result['scenarios']['login'], queries_per_request=0)}}
+		assert len(compare(result, baseline)) == 1
+		assert percentile([1, 2, 3, 4], 50) == 2 and percentile([1, 2, 3, 4], 99) == 4
+
+	def test_rollback_between_tests(self):
+		self.dummy_get_signup1()
+		self.dummy_teardown()
+		self.dummy_setup()
+		with app.app_context():
+			assert User.query.count() == 0
+			assert User.query.get(1) is None
+
+	def test_assets(self):
+		with tempfile.TemporaryDirectory() as directory:
+			manifest = build_assets(app.static_folder, directory)
+			css = manifest['css/fontawesome-all.min.css']
+			assert re.match(r'css/fontawesome-all\.min\.[0-9a-f]{12}\.css$', css)
+			with open(os.path.join(directory, css)) as css_file:
+				assert 'url(../{})'.format(manifest['webfonts/fa-solid-900.woff2']) in css_file.read()
+
+			assets.load(directory, app)
+			try:
+				response = self.app.get('/')
+				assert '/assets/{}'.format(manifest['css/bootstrap.min.css']) in response.get_data(as_text=True)
+
+				url = '/assets/{}'.format(css)
+				response = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+				assert response.headers['Content-Encoding'] == 'gzip'
+				assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+				assert response.headers['Vary'] == 'Accept-Encoding'
+				assert response.mimetype == 'text/css'
+				response.close()
+
+				response = self.app.get(url)
+				assert 'Content-Encoding' not in response.headers
+				response.close()
+				assert self.app.get('/assets/css/bootstrap.min.css').status_code == 404
+			finally:
+				assets.load(app.config['ASSETS_DIR'], app)
+
+	def test_page_cache(self):
+		response = self.app.get('/login/')
+		assert response.headers['X-Page-Cache'] == 'MISS'
+		assert self.app.get('/login/').headers['X-Page-Cache'] == 'HIT'
+		assert 'X-Page-Cache' not in self.app.get('/login/?next=/').headers
+
+		# flashed message must be shown, so page is rendered again
+		self.app.get('/logout/')
+		response = self.app.get('/login/')
+		assert 'X-Page-Cache' not in response.headers
+		assert "You&#39;re not logged in!" in response.get_data(as_text=True)
+
+		with app.app_context():
+			page_cache.invalidate('/login/')
+		assert self.app.get('/login/').headers['X-Page-Cache'] == 'MISS'
+
+		self.dummy_get_signup1()
+		self.dummy_login1()
+		response = self.app.get('/login/')
+		assert 'X-Page-Cache' not in response.headers
+		assert 'id="nav-item-logout"' in response.get_data(as_text=True)
+
+	def test_page_cache_csrf_token(self):
+		app.config['WTF_CSRF_ENABLED'] = True
+		try:
+			tokens = []
+			for _ in range(2):
+				with app.test_client() as client:
+					response = client.get('/signup/')
+					token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+						response.get_data(as_text=True)).group(1)
+					assert token == g.csrf_token
+					tokens.append(token)
+			assert response.headers['X-Page-Cache'] == 'HIT'
+			assert tokens[0] != tokens[1]
+		finally:
+			app.config['WTF_CSRF_ENABLED'] = False
+
+	def test_fragment_cache(self):
+		with app.app_context():
+			page_cache.fragments.set(fragment_key('navbar', False), Markup('<nav id="cached-navbar"></nav>'))
+		assert 'id="cached-navbar"' in self.app.get('/').get_data(as_text=True)
+		with app.app_context():
+			page_cache.invalidate_fragment('navbar', False)
+			page_cache.invalidate()
+		response = self.app.get('/')
+		assert 'id="nav-item-signup"' in response.get_data(as_text=True)
+		with app.app_context():
+			assert page_cache.fragments.get(fragment_key('navbar', False)) is not None
+
+	def test_template_bytecode_cache(self):
+		with tempfile.TemporaryDirectory() as directory:
+			with self.dummy_create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'JINJA_BYTECODE_CACHE_DIR': directory,
+					'TEMPLATE_WARMUP_ON_START': True}) as other_app:
+				names = other_app.jinja_env.list_templates()
+				assert 'layouts/navbar.html' in names and 'base/login.html' in names
+				assert len(os.listdir(directory)) == len(names)
+				assert measure_template_load(other_app, other_app.jinja_env.bytecode_cache) > 0
+
+				assert other_app.first_request_seconds is None
+				assert other_app.test_client().get('/').status_code == 200
+				assert other_app.first_request_seconds > 0
+				with other_app.app_context():
+					assert ('first_request_seconds', ('base.homepage',)) in metrics.collect()[2]
+
+	def test_template_bytecode_cache_unwritable(self):
+		with tempfile.NamedTemporaryFile() as not_directory:
+			directory = os.path.join(not_directory.name, 'cache')
+			assert make_bytecode_cache(directory) is None
+			with self.dummy_create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+					'JINJA_BYTECODE_CACHE_DIR': directory}) as other_app:
+				assert other_app.jinja_env.bytecode_cache is None
+				assert other_app.test_client().get('/').status_code == 200
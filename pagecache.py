@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""Cache of rendered output. Whole page of anonymous GET is cached by path & locale with \
+`page_cache.cached`, and template blocks are cached with `{% cache 'name', key %}...{% endcache %}`
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+from functools import wraps
+
+from flask import g, request, session, current_app, make_response
+from flask_wtf.csrf import generate_csrf
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from cache import Cache
+from helpers import get_extension_state
+
+# per session CSRF token is replaced with placeholder in cached page, and put back on every hit
+CSRF_PLACEHOLDER = b'__page_cache_csrf_token__'
+
+class FragmentCacheExtension(Extension):
+	"""Jinja tag `{% cache 'navbar', g.user.is_authenticated %}...{% endcache %}`, every \
+argument is part of the cache key. Block is rendered normally when fragment cache disabled
+	"""
+	tags = set(['cache'])
+
+	def __init__(self, environment):
+		super(FragmentCacheExtension, self).__init__(environment)
+		environment.extend(fragment_cache=None)
+
+	def parse(self, parser):
+		lineno = next(parser.stream).lineno
+		args = [parser.parse_expression()]
+		while parser.stream.skip_if('comma'):
+			args.append(parser.parse_expression())
+		body = parser.parse_statements(['name:endcache'], drop_needle=True)
+		return nodes.CallBlock(self.call_method('_cache_support', [nodes.List(args)]), [], [],
+			body).set_lineno(lineno)
+
+	def _cache_support(self, key_parts, caller):
+		cache = self.environment.fragment_cache
+		if cache is None:
+			return caller()
+
+		key = fragment_key(*key_parts)
+		value = cache.get(key)
+		if value is None:
+			value = caller()
+			cache.set(key, value)
+		return value
+
+def fragment_key(*key_parts):
+	"""Cache key of template fragment
+
+	Arguments:
+		*key_parts -- Arguments of `{% cache %}` tag
+
+	Returns:
+		String -- Cache key
+	"""
+	return 'fragment:' + ':'.join(str(part) for part in key_parts)
+
+class PageCache(object):
+	"""Page & fragment cache extension. Backends are made by `Cache` with `PAGE_CACHE_*` & \
+`FRAGMENT_CACHE_*` config, so memory is bounded by size & TTL of each backend
+	"""
+
+	def __init__(self, app=None):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+		"""
+		self.pages = Cache(config_prefix='PAGE_CACHE')
+		self.fragments = Cache(config_prefix='FRAGMENT_CACHE')
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		"""Create cache backends from app config & register `{% cache %}` tag
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		app.config.setdefault('PAGE_CACHE_ENABLED', True)
+		app.config.setdefault('PAGE_CACHE_LOCALES', ())
+		app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+		self.pages.init_app(app)
+		self.fragments.init_app(app)
+		app.jinja_env.add_extension(FragmentCacheExtension)
+		if app.config['FRAGMENT_CACHE_ENABLED']:
+			app.jinja_env.fragment_cache = get_extension_state(self.fragments.extension_name, app)
+		else:
+			app.jinja_env.fragment_cache = None
+
+	@property
+	def locales(self):
+		return tuple(current_app.config['PAGE_CACHE_LOCALES'])
+
+	def _get_locale(self):
+		"""Locale of request, chosen from `PAGE_CACHE_LOCALES` by Accept-Language header
+
+		Returns:
+			String|None -- Locale, None when no locale configured or matched
+		"""
+		if not self.locales:
+			return None
+		return request.accept_languages.best_match(self.locales)
+
+	def _get_key(self, path, locale):
+		return 'page:{}:{}'.format(locale or '', path)
+
+	def _is_cacheable_request(self):
+		"""Only anonymous GET without query string & flashed message is served from cache
+
+		Returns:
+			Boolean -- True when page may be served from cache
+		"""
+		return (current_app.config['PAGE_CACHE_ENABLED'] and request.method in ('GET', 'HEAD')
+			and not request.args and not g.user.is_authenticated and '_flashes' not in session)
+
+	def cached(self, view):
+		"""Decorator to cache whole page of anonymous visitors. Response has `X-Page-Cache` \
+header, HIT or MISS
+
+		Arguments:
+			view {Function} -- View function
+
+		Returns:
+			Function -- Wrapped view
+		"""
+		@wraps(view)
+		def wrapper(*args, **kwargs):
+			if not self._is_cacheable_request():
+				return view(*args, **kwargs)
+
+			key = self._get_key(request.path, self._get_locale())
+			page = self.pages.get(key)
+			if page is not None:
+				body, status, content_type = page
+				if CSRF_PLACEHOLDER in body:
+					body = body.replace(CSRF_PLACEHOLDER, generate_csrf().encode('utf-8'))
+				response = make_response(body, status)
+				response.content_type = content_type
+				response.headers['X-Page-Cache'] = 'HIT'
+				return response
+
+			response = make_response(view(*args, **kwargs))
+			# view may have logged in user or flashed message, that page belongs to one visitor
+			if (response.status_code == 200 and not response.direct_passthrough
+					and self._is_cacheable_request()):
+				body = response.get_data()
+				token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+				if token:
+					body = body.replace(token.encode('utf-8'), CSRF_PLACEHOLDER)
+				self.pages.set(key, (body, response.status_code, response.content_type))
+			response.headers['X-Page-Cache'] = 'MISS'
+			return response
+		return wrapper
+
+	def invalidate(self, path=None):
+		"""Remove cached page of every locale, or all pages
+
+		Keyword Arguments:
+			path {String} -- Request path, e.g. '/login/' (default: {None})
+		"""
+		if path is None:
+			self.pages.clear()
+			return
+		for locale in self.locales + (None,):
+			self.pages.delete(self._get_key(path, locale))
+
+	def invalidate_fragment(self, *key_parts):
+		"""Remove cached fragment, or all fragments when no key given
+
+		Arguments:
+			*key_parts -- Arguments of `{% cache %}` tag, e.g. ('navbar', False)
+		"""
+		if not key_parts:
+			self.fragments.clear()
+			return
+		self.fragments.delete(fragment_key(*key_parts))
+
+	def clear(self):
+		"""Remove all cached pages & fragments
+		"""
+		self.pages.clear()
+		self.fragments.clear()
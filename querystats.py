@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Count & time SQL statements of every request with SQLAlchemy engine events. Totals are put in \
+`g.query_count` & `g.query_time`, then added to per endpoint aggregates
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import threading
+import time
+
+from flask import g, request, has_app_context, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from helpers import get_extension_state
+
+class QueryBudgetExceeded(AssertionError):
+	"""Raised in testing when endpoint issues more queries than its budget in `QUERY_BUDGETS`
+	"""
+	pass
+
+class _EndpointStats(object):
+	"""Aggregates of every endpoint of one app
+	"""
+
+	def __init__(self):
+		self.stats = {}
+		self.lock = threading.Lock()
+
+class QueryStats(object):
+	"""Per request SQL statistics
+	"""
+
+	def __init__(self, app=None):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+		"""
+		self._listening = False
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		"""Register request hooks, engine events are registered once for all engines. Endpoint \
+aggregates are kept per app in `app.extensions`
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		app.config.setdefault('QUERY_STATS_ENABLED', True)
+		app.config.setdefault('QUERY_SLOW_THRESHOLD', 0.5)
+		app.config.setdefault('QUERY_BUDGETS', {})
+		app.config.setdefault('QUERY_BUDGET_ASSERT', False)
+		app.extensions['query_stats'] = _EndpointStats()
+		if not app.config['QUERY_STATS_ENABLED']:
+			return
+
+		app.before_request(self._before_request)
+		app.after_request(self._after_request)
+		if not self._listening:
+			event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+			event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+			event.listen(Engine, 'handle_error', self._handle_error)
+			self._listening = True
+
+	def _before_request(self):
+		"""Reset counters of current request
+		"""
+		g.query_count = 0
+		g.query_time = 0.0
+
+	def _after_request(self, response):
+		"""Add request totals to endpoint aggregates, and check query budget of endpoint
+
+		Arguments:
+			response {Response} -- Response of the request
+
+		Raises:
+			QueryBudgetExceeded -- Raise in testing when `QUERY_BUDGET_ASSERT` enabled & budget exceeded
+
+		Returns:
+			Response -- Same response
+		"""
+		endpoint = request.endpoint or request.path
+		count = g.get('query_count', 0)
+		elapsed = g.get('query_time', 0.0)
+		endpoints = get_extension_state('query_stats')
+		with endpoints.lock:
+			stats = endpoints.stats.setdefault(endpoint, {'requests': 0, 'queries': 0, 'time': 0.0,
+				'max_queries': 0})
+			stats['requests'] += 1
+			stats['queries'] += count
+			stats['time'] += elapsed
+			stats['max_queries'] = max(stats['max_queries'], count)
+			average = stats['queries'] / stats['requests']
+
+		current_app.logger.debug("%s: %d queries in %.1fms (avg %.1f queries over %d requests)",
+			endpoint, count, elapsed * 1000, average, stats['requests'])
+
+		budget = current_app.config['QUERY_BUDGETS'].get(endpoint)
+		if budget is not None and count > budget:
+			message = "{} issued {} queries, budget is {}".format(endpoint, count, budget)
+			if current_app.testing and current_app.config['QUERY_BUDGET_ASSERT']:
+				raise QueryBudgetExceeded(message)
+			current_app.logger.warning(message)
+		return response
+
+	def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault('query_started', []).append(time.time())
+
+	def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		elapsed = time.time() - conn.info['query_started'].pop()
+		if not has_app_context():
+			return
+
+		g.query_count = g.get('query_count', 0) + 1
+		g.query_time = g.get('query_time', 0.0) + elapsed
+		threshold = current_app.config.get('QUERY_SLOW_THRESHOLD')
+		if threshold is not None and elapsed > threshold:
+			current_app.logger.warning("Slow query (%.1fms): %s", elapsed * 1000, statement)
+
+	def _handle_error(self, exception_context):
+		"""Failed statement never reaches after_cursor_execute, drop its start time so list of \
+pooled connection doesn't grow
+		"""
+		connection = exception_context.connection
+		# statement which failed before executed (e.g. connect error) has no start time
+		if connection is None or exception_context.execution_context is None or \
+			exception_context.statement is None:
+				return
+		started = connection.info.get('query_started')
+		if started:
+			started.pop()
+
+	def get_endpoint_stats(self):
+		"""Aggregates of every endpoint which has been requested
+
+		Returns:
+			Dict -- Requests, total queries, total time & max queries per request by endpoint
+		"""
+		endpoints = get_extension_state('query_stats')
+		with endpoints.lock:
+			return {endpoint: dict(stats) for endpoint, stats in endpoints.stats.items()}
+
+	def reset(self):
+		"""Remove endpoint aggregates of current app
+		"""
+		endpoints = get_extension_state('query_stats')
+		with endpoints.lock:
+			endpoints.stats.clear()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Rate limiter with sliding window counter. Rejected request is answered before the view runs, \
+so it never touches database or password hasher
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response, current_app
+
+from helpers import normalize_email, get_extension_state
+
+class MemoryBackend(object):
+	"""Per process counters. Every key only keeps counter of current & previous window, \
+and least recently used keys are dropped when there are more than `max_keys`
+	"""
+
+	def __init__(self, max_keys=100000):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			max_keys {Int} -- Max number of tracked keys (default: {100000})
+		"""
+		self.max_keys = max_keys
+		self._counters = OrderedDict()
+		self._lock = threading.Lock()
+
+	def hit(self, key, window):
+		"""Count one hit
+
+		Arguments:
+			key {String} -- Counter key
+			window {Int} -- Window length in seconds
+
+		Returns:
+			Tuple -- Hits of current window & previous window
+		"""
+		index = int(time.time() // window)
+		with self._lock:
+			counter = self._counters.get(key)
+			if counter is None or counter[0] < index - 1:
+				counter = [index, 0, 0]
+			elif counter[0] == index - 1:
+				counter = [index, 0, counter[1]]
+			counter[1] += 1
+			self._counters[key] = counter
+			self._counters.move_to_end(key)
+			while len(self._counters) > self.max_keys:
+				self._counters.popitem(last=False)
+			return counter[1], counter[2]
+
+	def reset(self):
+		"""Remove all counters
+		"""
+		with self._lock:
+			self._counters.clear()
+
+class SharedBackend(object):
+	"""Counters in shared store which support `incr`, `expire`, `get` & `delete`, e.g. redis client, \
+so the limit is shared by all app processes
+	"""
+
+	def __init__(self, client, prefix='ratelimit'):
+		"""Instantiate class object
+
+		Arguments:
+			client {Object} -- Store client, e.g. `redis.Redis`
+
+		Keyword Arguments:
+			prefix {String} -- Prefix of store keys (default: {'ratelimit'})
+		"""
+		self.client = client
+		self.prefix = prefix
+
+	def hit(self, key, window):
+		"""Count one hit
+
+		Arguments:
+			key {String} -- Counter key
+			window {Int} -- Window length in seconds
+
+		Returns:
+			Tuple -- Hits of current window & previous window
+		"""
+		index = int(time.time() // window)
+		current_key = '{0}:{1}:{2}'.format(self.prefix, key, index)
+		current = self.client.incr(current_key)
+		if current == 1:
+			self.client.expire(current_key, window * 2)
+		previous = self.client.get('{0}:{1}:{2}'.format(self.prefix, key, index - 1))
+		return current, int(previous or 0)
+
+	def reset(self):
+		"""Shared counters just expire by themselves
+		"""
+		pass
+
+class RateLimiter(object):
+	"""Rate limiter extension. Backend is `MemoryBackend`, or `SharedBackend` when \
+`RATELIMIT_STORAGE_URL` is set (needs `redis` package). Backend is kept per app in `app.extensions`
+	"""
+
+	def __init__(self, app=None):
+		"""Instantiate class object
+
+		Keyword Arguments:
+			app {Flask} -- Flask app (default: {None})
+		"""
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		"""Create backend from app config
+
+		Arguments:
+			app {Flask} -- Flask app
+		"""
+		app.config.setdefault('RATELIMIT_ENABLED', True)
+		storage_url = app.config.get('RATELIMIT_STORAGE_URL')
+		if storage_url:
+			import redis
+			app.extensions['ratelimit'] = SharedBackend(redis.Redis.from_url(storage_url))
+		else:
+			app.extensions['ratelimit'] = MemoryBackend(app.config.get('RATELIMIT_MAX_KEYS', 100000))
+
+	@property
+	def enabled(self):
+		return current_app.config['RATELIMIT_ENABLED']
+
+	@property
+	def backend(self):
+		"""Backend of current app
+
+		Returns:
+			MemoryBackend|SharedBackend -- Counter backend
+		"""
+		return get_extension_state('ratelimit')
+
+	def is_allowed(self, key, limit, window):
+		"""Count hit then check it with sliding window estimation: hits of previous window \
+weighted by its overlap with last `window` seconds, plus hits of current window
+
+		Arguments:
+			key {String} -- Counter key
+			limit {Int} -- Max hits in `window`
+			window {Int} -- Window length in seconds
+
+		Returns:
+			Boolean -- False when hit is over the limit
+		"""
+		current, previous = self.backend.hit(key, window)
+		overlap = 1 - (time.time() % window) / float(window)
+		return previous * overlap + current <= limit
+
+	def limit(self, name, per_ip=None, per_email=None, methods=('POST',)):
+		"""Decorator to limit view by client IP and by submitted `email` form field
+
+		Arguments:
+			name {String} -- Limit name, used as key prefix
+
+		Keyword Arguments:
+			per_ip {Tuple} -- (limit, window in seconds) per client IP (default: {None})
+			per_email {Tuple} -- (limit, window in seconds) per email (default: {None})
+			methods {Tuple} -- Limited request methods (default: {('POST',)})
+
+		Returns:
+			Function -- Decorator
+		"""
+		def decorator(view):
+			@wraps(view)
+			def wrapper(*args, **kwargs):
+				if self.enabled and request.method in methods:
+					rules = []
+					if per_ip:
+						rules.append(('ip', request.remote_addr, per_ip))
+					email = normalize_email(request.form.get('email'))
+					if per_email and email:
+						rules.append(('email', email, per_email))
+
+					for scope, value, (max_hits, window) in rules:
+						if not self.is_allowed('{0}:{1}:{2}'.format(name, scope, value), max_hits, window):
+							return make_response("Too many requests, please try again later.", 429,
+								{'Retry-After': str(window)})
+				return view(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	def reset(self):
+		"""Remove all counters of backend
+		"""
+		self.backend.reset()
@@ -7,8 +7,12 @@ import os
 
 try:
     import local_settings
-except Exception:
-    print("[WARNING] Local settings not found!")
+except ImportError:
+    local_settings = None
+
+# warned by app.create_app() when not provided
+REQUIRED_SETTINGS = ('SECRET_KEY', 'SQLALCHEMY_DATABASE_URI', 'MAIL_SERVER', 'MAIL_USERNAME',
+    'MAIL_PASSWORD', 'MAIL_DEFAULT_SENDER')
 
 
 class Configuration:
@@ -18,17 +22,122 @@ class Configuration:
     DEBUG = True
     STATIC_DIR = os.path.join(APPLICATION_DIR, 'static')
     IMAGES_DIR = os.path.join(STATIC_DIR, 'images')
+    # max seconds of app.create_app(), warned when exceeded
+    STARTUP_TIME_BUDGET = 0.5
     try:
         SECRET_KEY = local_settings.SECRET_KEY
-    except Exception:
-        print("[WARNING] Secret key not provided!")
+    except AttributeError:
+        pass
 
     # flask_sqlalchemy config
     try:
         SQLALCHEMY_DATABASE_URI = local_settings.SQLALCHEMY_DATABASE_URI
-    except Exception:
-        print("[WARNING] Database setting not valid!")
+    except AttributeError:
+        pass
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # pool sizing is only applied to QueuePool (not SQLite), pre ping & recycle drop stale connections
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+    # read only queries are sent to replicas, session sticks to primary for a few seconds after write
+    try:
+        SQLALCHEMY_REPLICA_URIS = local_settings.SQLALCHEMY_REPLICA_URIS
+    except AttributeError:
+        SQLALCHEMY_REPLICA_URIS = []
+    SQLALCHEMY_REPLICA_STICKY_SECONDS = 5
+
+    # per request SQL statistics, statements slower than threshold (seconds) are logged as warning
+    QUERY_STATS_ENABLED = True
+    QUERY_SLOW_THRESHOLD = 0.5
+    # max queries per endpoint e.g. {'base.signup': 15}, exceeded budget is logged,
+    # or raised as QueryBudgetExceeded in testing when QUERY_BUDGET_ASSERT is True
+    QUERY_BUDGETS = {}
+    QUERY_BUDGET_ASSERT = False
+
+    # metrics in prometheus text format, only answered for direct (not proxied) request from
+    # METRICS_ALLOWED_IPS, or for request with `Authorization: Bearer <METRICS_TOKEN>`. Behind reverse
+    # proxy set METRICS_TOKEN. Set METRICS_DIR to share metrics of all worker processes, every
+    # process writes own file in that directory
+    METRICS_ENABLED = True
+    METRICS_ROUTE = '/metrics'
+    METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+    METRICS_TOKEN = None
+    METRICS_DIR = None
+    METRICS_FLUSH_INTERVAL = 5
+
+    # fingerprinted & precompressed static files, built by `python manage.py base build_assets`.
+    # Templates fall back to /static urls when assets are not built
+    ASSETS_DIR = os.path.join(APPLICATION_DIR, 'static', 'dist')
+    ASSETS_URL_PATH = '/assets'
+
+    # rendered page of anonymous GET (keyed by path & locale) and {% cache %} template fragments,
+    # both cached per process, backend config same as USER_CACHE_*
+    PAGE_CACHE_ENABLED = True
+    PAGE_CACHE_LOCALES = ()
+    PAGE_CACHE_BACKEND = 'memory'
+    PAGE_CACHE_SIZE = 256
+    PAGE_CACHE_TTL = 300
+    FRAGMENT_CACHE_ENABLED = True
+    FRAGMENT_CACHE_BACKEND = 'memory'
+    FRAGMENT_CACHE_SIZE = 256
+    FRAGMENT_CACHE_TTL = 300
+
+    # compiled templates shared by all workers, fill with `python manage.py base warm_templates`
+    # or TEMPLATE_WARMUP_ON_START (compile every template in create_app). Opt-in, set to directory
+    # writable only by app user, e.g. os.path.join(APPLICATION_DIR, '.jinja_cache'). None disables
+    try:
+        JINJA_BYTECODE_CACHE_DIR = local_settings.JINJA_BYTECODE_CACHE_DIR
+    except AttributeError:
+        JINJA_BYTECODE_CACHE_DIR = None
+    TEMPLATE_WARMUP_ON_START = False
+
+    # flask_argon2 config, calibrate with `python manage.py base calibrate_argon2`
+    try:
+        ARGON2_TIME_COST = local_settings.ARGON2_TIME_COST
+        ARGON2_MEMORY_COST = local_settings.ARGON2_MEMORY_COST
+        ARGON2_PARALLELISM = local_settings.ARGON2_PARALLELISM
+    except AttributeError:
+        pass
+
+    # password hashing pool, None = one worker process per CPU, 0 = hash in request thread
+    PASSWORD_HASH_WORKERS = None
+    PASSWORD_HASH_QUEUE_SIZE = None
+    PASSWORD_HASH_TIMEOUT = 10
+    # request which waited PASSWORD_HASH_TIMEOUT for queue gets 503 with this Retry-After (seconds)
+    PASSWORD_HASH_RETRY_AFTER = 5
+
+    # cache of logged in user, backend 'memory' (per process) or 'file' (shared between local processes)
+    USER_CACHE_BACKEND = 'memory'
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60
+    USER_CACHE_DIR = None
+
+    # write-behind of User.last_request_at, flush interval in seconds
+    USER_ACTIVITY_FLUSH_INTERVAL = 60
+    USER_ACTIVITY_MAX_PENDING = 1000
+
+    # bloom filter to skip unique check of unknown value (UniqueValue, e.g. signup email),
+    # filter is per process and warmed again every BLOOM_FILTER_TTL seconds
+    BLOOM_FILTER_ENABLED = False
+    BLOOM_FILTER_ERROR_RATE = 0.01
+    BLOOM_FILTER_TTL = 300
+
+    # rate limit of login, signup & resend verify, set RATELIMIT_STORAGE_URL (redis://...)
+    # to share counters between processes
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORAGE_URL = None
+    RATELIMIT_MAX_KEYS = 100000
+    # number of trusted reverse proxies in front of app. Client IP (rate limit per IP) is read from
+    # X-Forwarded-For of that many hops by ProxyFix, 0 = use socket address. Must match deployment,
+    # with higher value clients can fake their IP, with 0 behind proxy all clients share one IP
+    PROXY_FIX_X_FOR = 0
+
+    # lifetime of verification link, in seconds
+    VERIFY_TOKEN_TTL = 2 * 24 * 3600
 
     # flask_mail config
     try:
@@ -36,7 +145,11 @@ class Configuration:
         MAIL_USERNAME = local_settings.MAIL_USERNAME
         MAIL_PASSWORD = local_settings.MAIL_PASSWORD
         MAIL_DEFAULT_SENDER = local_settings.MAIL_DEFAULT_SENDER
-    except Exception:
-        print("[WARNING] Email setting not valid!")
+    except AttributeError:
+        pass
     MAIL_PORT = 465
     MAIL_USE_SSL = True
+    # failed mail retry, delay in seconds
+    MAIL_RETRY_MAX_ATTEMPTS = 8
+    MAIL_RETRY_BASE_DELAY = 30
+    MAIL_RETRY_MAX_DELAY = 3600
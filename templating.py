@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""Jinja bytecode cache & template warmup. Compiled templates are stored in \
+`JINJA_BYTECODE_CACHE_DIR`, so new worker loads them from disk instead of compiling every template \
+on its first requests. Stale bytecode is detected by source checksum and compiled again
+
+Author:
+	@CakJuice <hd.brandoz@gmail.com>
+"""
+
+import os
+import tempfile
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+class AtomicFileSystemBytecodeCache(FileSystemBytecodeCache):
+	"""Bytecode cache which writes compiled template to temporary file then renames it, so other \
+worker never loads half written file. Failed write only means template is compiled again
+	"""
+
+	def dump_bytecode(self, bucket):
+		filename = self._get_cache_filename(bucket)
+		try:
+			fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+		except OSError:
+			return
+		try:
+			with os.fdopen(fd, 'wb') as tmp_file:
+				bucket.write_bytecode(tmp_file)
+			os.replace(tmp_path, filename)
+		except OSError:
+			try:
+				os.remove(tmp_path)
+			except OSError:
+				pass
+
+def make_bytecode_cache(directory):
+	"""Create bytecode cache which shared by all processes in same machine
+
+	Arguments:
+		directory {String} -- Directory of compiled templates
+
+	Returns:
+		AtomicFileSystemBytecodeCache|None -- Jinja bytecode cache, None when directory can't be created
+	"""
+	try:
+		os.makedirs(directory, mode=0o700, exist_ok=True)
+	except OSError:
+		return None
+	return AtomicFileSystemBytecodeCache(directory)
+
+def warm_templates(app):
+	"""Compile every template of app & blueprint template folders, compiled templates are \
+written to bytecode cache and kept in template cache of this process
+
+	Arguments:
+		app {Flask} -- Flask app
+
+	Returns:
+		Tuple -- (template names, seconds)
+	"""
+	started = time.perf_counter()
+	names = app.jinja_env.list_templates()
+	for name in names:
+		app.jinja_env.get_template(name)
+	return names, time.perf_counter() - started
+
+def measure_template_load(app, bytecode_cache=None):
+	"""Load every template in new environment without compiled templates in memory, like \
+first requests of cold worker
+
+	Arguments:
+		app {Flask} -- Flask app
+
+	Keyword Arguments:
+		bytecode_cache {BytecodeCache} -- Load from this cache, None = compile from source (default: {None})
+
+	Returns:
+		Float -- Seconds to load all templates
+	"""
+	# passing cache_size gives overlay its own template cache, nothing is reused from app environment
+	environment = app.jinja_env.overlay(bytecode_cache=bytecode_cache, cache_size=400)
+	started = time.perf_counter()
+	for name in environment.list_templates():
+		environment.get_template(name)
+	return time.perf_counter() - started
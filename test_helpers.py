@@ -1,26 +1,172 @@
-import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy.pool import StaticPool
+
 from main import app
-from app import db
+from app import create_app, db, mail, hasher, user_cache, limiter, page_cache
+from dummy_smtp import DummySMTPServer
+# every model module, so all tables are created by create_all() in dummy_setup
+import modules.base.models
+from modules.base.activity import activity_tracker
+from modules.base.models.user import admin_registry
+
+class DummyStore(object):
+	"""Local stand-in of shared store (redis) for rate limiter
+	"""
+
+	def __init__(self):
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def incr(self, key):
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + 1
+			return self.values[key]
+
+	def expire(self, key, seconds):
+		return True
+
+	def get(self, key):
+		return self.values.get(key)
+
+class DummyConnection(object):
+	"""In-memory SQLite connection shared by every session of test process. Each test runs in one \
+transaction which is rolled back at the end, and every transaction begun by SQLAlchemy inside it \
+is a savepoint, so commits of the tested code are visible to the test but never persisted
+	"""
+
+	def __init__(self):
+		self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+		# transactions are emitted by this class only
+		self.connection.isolation_level = None
+		self.savepoints = []
+		self.lock = threading.RLock()
+		self.in_test = False
+
+	def __getattr__(self, name):
+		return getattr(self.connection, name)
+
+	def cursor(self, *args, **kwargs):
+		return self.connection.cursor(*args, **kwargs)
+
+	def begin_test(self):
+		with self.lock:
+			self.connection.execute('BEGIN')
+			self.in_test = True
+
+	def rollback_test(self):
+		with self.lock:
+			self.savepoints = []
+			self.in_test = False
+			self.connection.execute('ROLLBACK')
+
+	def begin(self):
+		"""Called when SQLAlchemy begins transaction
+		"""
+		with self.lock:
+			if self.in_test:
+				name = 'dummy_tx_{}'.format(len(self.savepoints))
+				self.savepoints.append(name)
+				self.connection.execute('SAVEPOINT {}'.format(name))
+
+	def commit(self):
+		with self.lock:
+			if self.savepoints:
+				self.connection.execute('RELEASE SAVEPOINT {}'.format(self.savepoints.pop()))
+
+	def rollback(self):
+		with self.lock:
+			if self.savepoints:
+				name = self.savepoints.pop()
+				self.connection.execute('ROLLBACK TO SAVEPOINT {}'.format(name))
+				self.connection.execute('RELEASE SAVEPOINT {}'.format(name))
+
+	def close(self):
+		pass
+
+# one database per test process, so test processes can run in parallel
+dummy_connection = DummyConnection()
+_schema_created = False
+
+def _on_begin(connection):
+	connection.connection.begin()
 
 class DummyTest(object):
-	"""Use for dummy testing
+	"""Use for dummy testing. Schema is created once, every test is rolled back in teardown, \
+and sent mails are recorded in `self.mail_outbox` instead of delivered
 	"""
 
 	def dummy_setup(self):
 		"""Setup / initialize test
 		"""
-		self.test_db = '{}/test.db'.format(app.config['APPLICATION_DIR'])
-		app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(self.test_db)
+		global _schema_created
+		app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+		app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+			'creator': lambda: dummy_connection,
+			'poolclass': StaticPool,
+			'pool_reset_on_return': None,
+		}
 		app.testing = True
 		app.config['WTF_CSRF_ENABLED'] = False
+		app.extensions['mail'].suppress = True
+		admin_registry.invalidate()
 		self.app = app.test_client()
 		with app.app_context():
-			db.create_all()
+			user_cache.clear()
+			limiter.reset()
+			page_cache.clear()
+			if not _schema_created:
+				db.event.listen(db.engine, 'begin', _on_begin)
+				db.create_all()
+				_schema_created = True
+		dummy_connection.begin_test()
+		self._mail_recorder = mail.record_messages()
+		self.mail_outbox = self._mail_recorder.__enter__()
 
 	def dummy_teardown(self):
-		"""Call when test done.
+		"""Call when test done. Everything written by the test is rolled back
 		"""
-		os.unlink(self.test_db)
+		activity_tracker.flush(app)
+		self._mail_recorder.__exit__(None, None, None)
+		db.session.remove()
+		dummy_connection.rollback_test()
+
+	@contextmanager
+	def dummy_create_app(self, config):
+		"""Build other app with `create_app()`, hash pool of other app is shut down on exit
+
+		Arguments:
+			config {Dict} -- Config of other app
+
+		Yields:
+			Flask -- Other app
+		"""
+		other_app = create_app(dict(config, TESTING=True))
+		try:
+			yield other_app
+		finally:
+			hasher.shutdown(other_app)
+
+	@contextmanager
+	def dummy_smtp_server(self):
+		"""Point flask_mail to local stand-in SMTP server while inside this context
+
+		Yields:
+			DummySMTPServer -- Running stand-in server
+		"""
+		state = app.extensions['mail']
+		origin = (state.server, state.port, state.use_ssl, state.use_tls, state.username, state.suppress)
+		with DummySMTPServer() as server:
+			state.server, state.port = server.server_address
+			state.use_ssl = state.use_tls = state.suppress = False
+			state.username = None
+			try:
+				yield server
+			finally:
+				(state.server, state.port, state.use_ssl, state.use_tls, state.username,
+					state.suppress) = origin
 
 	def dummy_get_signup1(self):
 		"""Data dummy for signup test
@@ -35,6 +181,17 @@ class DummyTest(object):
 			'password_confirm': 'cakjuice'
 		}, follow_redirects=True)
 
+	def dummy_login1(self):
+		"""Login as user of `dummy_get_signup1()`
+
+		Returns:
+			Object -- Response of login
+		"""
+		return self.app.post('/login/', data={
+			'email': 'support@cakjuice.com',
+			'password': 'cakjuice'
+		}, follow_redirects=True)
+
 	def dummy_get_signup2(self):
 		"""Data dummy 2 for signup test
 
@@ -9,9 +9,12 @@ Author:
 import os
 
 from flask import request
+from sqlalchemy import or_
 from wtforms import validators
 from wtforms.compat import string_types
 
+from bloom import might_exist
+
 def get_file_size(file):
 	"""Get file size when uploaded file
 
@@ -148,17 +151,47 @@ If this validation fails, it will be raise StopValidation
 					raise validators.StopValidation(message)
 
 class UniqueValue(object):
-	def __init__(self, model, field_name, message=None):
+	"""To check data not used yet by other record. Checked with existence query, or skipped \
+when bloom filter (`BLOOM_FILTER_ENABLED`) knows the value definitely not exists
+	"""
+
+	def __init__(self, model, field_name, message=None, normalizer=None, fallback=None):
 		"""Instantiate class object
 
 		Keyword Arguments:
 			model {Object/Class} -- Model class which will be checking value
 			field_name {String} -- Field name of model which will be checking value
 			message {String} -- Custom message when this validation fails (default: {None})
+			normalizer {Function} -- Convert input value before checking, e.g. helpers.normalize_email (default: {None})
+			fallback {Function} -- Get filter of records which field is not filled yet, called with \
+value. Always queried, bloom filter doesn't know those records (default: {None})
 		"""
 		self.model = model
 		self.field_name = field_name
 		self.message = message
+		self.normalizer = normalizer
+		self.fallback = fallback
+
+	def value_exists(self, value):
+		"""Check value already used in model field, without loading the record
+
+		Arguments:
+			value {Object} -- Value to be checked
+
+		Returns:
+			Boolean -- True when value already used
+		"""
+		if self.normalizer is not None:
+			value = self.normalizer(value)
+		clauses = []
+		if might_exist(self.model, self.field_name, value):
+			clauses.append(getattr(self.model, self.field_name) == value)
+		if self.fallback is not None:
+			clauses.append(self.fallback(value))
+		if not clauses:
+			return False
+		query = self.model.query.filter(or_(*clauses))
+		return query.session.query(query.exists()).scalar()
 
 	def __call__(self, form, field):
 		"""Call when request post data from some form. \
@@ -178,9 +211,7 @@ If this validation fails, it will be raise StopValidation
 
 		if field.data and isinstance(field.data, string_types) and \
 			field.data.strip():
-				obj = getattr(self.model, self.field_name)
-				user = self.model.query.filter(obj == field.data).first()
-				if user:
+				if self.value_exists(field.data):
 					field.errors = []
 					if self.message is None:
 						message = "Data {} sudah ada!".format(self.field_name)